@@ -0,0 +1,177 @@
+import math
+import os
+import threading
+import time
+from collections import deque, Counter
+from typing import Callable
+
+# Jobs processed at the same time - further admitted jobs wait for a free slot
+MAX_RUNNING_JOBS = int(os.getenv("MAX_RUNNING_JOBS", "4"))
+# Jobs allowed to wait for a slot, beyond that new uploads are shed
+MAX_PENDING_JOBS = int(os.getenv("MAX_PENDING_JOBS", "16"))
+# Running plus waiting jobs of a single client
+MAX_JOBS_PER_CLIENT = int(os.getenv("MAX_JOBS_PER_CLIENT", "2"))
+# Uploads are shed when their estimated wait for a slot is longer than this (seconds)
+MAX_QUEUE_WAIT_SEC = float(os.getenv("MAX_QUEUE_WAIT_SEC", "120"))
+# Longest real wait for a slot (seconds) - the estimate above can be wrong, a waiting upload gives up after this
+MAX_QUEUE_TIMEOUT_SEC = float(os.getenv("MAX_QUEUE_TIMEOUT_SEC", "600"))
+# How often a waiting upload checks whether its client is still connected (seconds)
+WAIT_POLL_SEC = 1.0
+# Job duration assumed before any job finished (seconds)
+DEFAULT_JOB_SEC = 30.0
+
+class AdmissionRejected(Exception):
+
+    # Raised when an upload is not admitted - carries the HTTP status and the Retry-After delay
+
+    def __init__(self, status: int, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+class Ticket:
+
+    # Slot of an admitted job - released when the job ends
+
+    def __init__(self, controller: 'AdmissionController', client_id: str):
+        self._controller = controller
+        self.client_id = client_id
+        self.started = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._controller._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class AdmissionController:
+
+    # Bounded admission of jobs: a fixed number runs, a bounded FIFO queue waits, everything else is shed at once
+    # Shedding early keeps the latency of admitted jobs predictable instead of slowing every job down together
+
+    def __init__(self, max_running: int = MAX_RUNNING_JOBS, max_pending: int = MAX_PENDING_JOBS,
+                 per_client: int = MAX_JOBS_PER_CLIENT, max_wait_sec: float = MAX_QUEUE_WAIT_SEC,
+                 wait_timeout_sec: float = MAX_QUEUE_TIMEOUT_SEC):
+        self.max_running = max_running
+        self.max_pending = max_pending
+        self.per_client = per_client
+        self.max_wait_sec = max_wait_sec
+        self.wait_timeout_sec = wait_timeout_sec
+        self.running = 0
+        self._waiters = deque()
+        self._clients = Counter()
+        self._durations = deque(maxlen=50)
+        self._lock = threading.Lock()
+        self.counters = Counter()
+
+    def _average_job_sec(self) -> float:
+        return sum(self._durations) / len(self._durations) if self._durations else DEFAULT_JOB_SEC
+
+    def estimated_wait(self) -> float:
+        # Expected wait of a new job (lock must be held): the queue ahead drains max_running jobs per average job duration
+        if self.running < self.max_running and not self._waiters:
+            return 0.0
+        return (len(self._waiters) // self.max_running + 1) * self._average_job_sec()
+
+    def admit(self, client_id: str, gone: Callable[[], bool] = None) -> Ticket:
+
+        # Admit a job, waiting in line for a slot if needed
+
+        # Args: "client_id": Identity of the caller for the per-client limit,
+        #       "gone": Returns True once the caller disconnected - checked while waiting and before a queued job starts
+
+        # Returns: Ticket to release when the job ends
+
+        # Raises: AdmissionRejected with 429 when the client is over its limit, 503 when the server is overloaded,
+        #         the wait timed out or the caller disconnected while waiting
+
+        with self._lock:
+            if self._clients[client_id] >= self.per_client:
+                self.counters['rejected_client_limit'] += 1
+                raise AdmissionRejected(429, f"Too many jobs for this client (limit {self.per_client})", self._average_job_sec())
+            if self.running < self.max_running and not self._waiters:
+                self.running += 1
+                self._clients[client_id] += 1
+                self.counters['admitted'] += 1
+                return Ticket(self, client_id)
+            wait = self.estimated_wait()
+            if len(self._waiters) >= self.max_pending:
+                self.counters['rejected_queue_full'] += 1
+                raise AdmissionRejected(503, "Server busy, job queue is full", wait)
+            if wait > self.max_wait_sec:
+                self.counters['rejected_wait'] += 1
+                raise AdmissionRejected(503, f"Server busy, estimated wait {wait:.0f}s", wait)
+            turn = threading.Event()
+            self._waiters.append(turn)
+            self._clients[client_id] += 1
+            self.counters['queued'] += 1
+
+        # The releasing job hands its slot directly to the first waiter
+        deadline = time.monotonic() + self.wait_timeout_sec
+        while not turn.wait(min(WAIT_POLL_SEC, max(0.0, deadline - time.monotonic()))):
+            timed_out = time.monotonic() >= deadline
+            if not timed_out and not (gone is not None and gone()):
+                continue
+            with self._lock:
+                # The slot may have been handed over while the lock was free, then the job is admitted after all
+                if not turn.is_set():
+                    self._waiters.remove(turn)
+                    self._forget_client(client_id)
+                    self.counters['timed_out' if timed_out else 'abandoned'] += 1
+                    if timed_out:
+                        raise AdmissionRejected(503, f"Server busy, no slot within {self.wait_timeout_sec:.0f}s", self._average_job_sec())
+                    raise AdmissionRejected(503, "Client disconnected while waiting", 0)
+            break
+        with self._lock:
+            self.counters['admitted'] += 1
+        ticket = Ticket(self, client_id)
+        # Waiting can take minutes, do not start the job of a client that left in the meantime
+        if gone is not None and gone():
+            ticket.release()
+            with self._lock:
+                self.counters['abandoned'] += 1
+            raise AdmissionRejected(503, "Client disconnected while waiting", 0)
+        return ticket
+
+    def _forget_client(self, client_id: str):
+        # Drop one job of a client from the per-client count (lock must be held)
+        self._clients[client_id] -= 1
+        if self._clients[client_id] <= 0:
+            del self._clients[client_id]
+
+    def _release(self, ticket: Ticket):
+        with self._lock:
+            self._durations.append(time.monotonic() - ticket.started)
+            self._forget_client(ticket.client_id)
+            if self._waiters:
+                self._waiters.popleft().set()
+            else:
+                self.running -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'running': self.running,
+                'pending': len(self._waiters),
+                'max_running': self.max_running,
+                'max_pending': self.max_pending,
+                'per_client': self.per_client,
+                'estimated_wait_sec': round(self.estimated_wait(), 2),
+                'avg_job_sec': round(self._average_job_sec(), 2),
+                **{name: self.counters[name] for name in ('admitted', 'queued', 'rejected_client_limit',
+                                                          'rejected_queue_full', 'rejected_wait', 'timed_out', 'abandoned')},
+            }
+
+# Admission of the uploads of this backend
+admission = AdmissionController()
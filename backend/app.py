@@ -1,12 +1,37 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
-from process_frames import transcribe_image, NVIDIA_API_KEY as NVIDIA_API_KEY
-from process_video_text import process_frames_with_gemini, GEMINI_API_KEY
-from video_utils import extract_frames_to_memory, tmp_dir
+from process_frames import transcribe_image, is_transcription_error, OCRFailure, warm_up_connection, FrameResult, stream_stats, NVIDIA_API_KEY as NVIDIA_API_KEY
+from process_video_text import process_frames_with_gemini, RollingRefiner, load_genai, gemini, GEMINI_API_KEY
+from video_utils import (extract_frames_to_memory, extract_frames_at, get_duration, preview_timestamps, format_timestamp,
+                         tmp_dir, check_dependencies, get_capabilities, EXTRACT_EVERY_SEC, PREVIEW_EVERY_SEC)
+from result_cache import get_result_cache, hash_file, save_and_hash, make_cache_key, pipeline_settings
+from stage_store import get_stage_store
+from ocr_engines import ocr_router, is_fallback_text
+from hedging import ocr_hedger, OCR_HEDGING
+from frame_quality import gate_frames, QUALITY_GATING
+from board_mosaic import plan_mosaic, mosaic_available, MOSAIC_ENABLED
+from consolidate import consolidate_frames
+from live_stream import live_sessions, start_live_session, sse_events
+from jobs import jobs, Job, JobCancelled, watch_client_disconnect, client_disconnected
+from checkpoints import get_checkpoints, spool_path
+from singleflight import video_flights
+from search_index import get_search_index
+from task_queue import make_task_queue, encode_image, TASK_GROUP_TTL_SEC
+from admission import admission, AdmissionRejected, Ticket
+from tracing import activate, span, bind, sample_profile, PROFILE_MAX_SEC
+from PIL import Image
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import List, Tuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import hmac
+import io
+import json
+import queue
+import threading
+import zipfile
+from typing import List, Tuple, Optional, Callable, Dict
 import os
+import time
+import uuid
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -14,6 +39,43 @@ load_dotenv()
 
 app = Flask(__name__)
 CORS(app)
+# Largest request body (MB) - bigger uploads are refused with 413 before they are read
+MAX_UPLOAD_BYTES = int(float(os.getenv("MAX_UPLOAD_MB", "4096")) * 1024 * 1024)
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+
+# Extra OCR attempts of a frame that failed
+FRAME_RETRIES = int(os.getenv("FRAME_RETRIES", "1"))
+
+# "local" runs OCR and refinement in this process, "queue" hands them to worker processes (python worker.py) through TASK_QUEUE_URL
+EXECUTION_MODE = os.getenv("EXECUTION_MODE", "local")
+# Longest wait for the workers of one job stage before its unfinished tasks count as failed (seconds)
+QUEUE_WAIT_SEC = float(os.getenv("QUEUE_WAIT_SEC", "3600"))
+QUEUE_POLL_SEC = 0.2
+
+# Refinement mode of video uploads: "full" refines all frames at once, "rolling" refines batches while frames are transcribed,
+# "local" merges the frame texts without Gemini (consolidate.py) in milliseconds
+REFINE_MODE = os.getenv("REFINE_MODE", "full")
+REFINE_MODES = ('full', 'rolling', 'local')
+# Merge the frame texts locally when the Gemini refinement fails, instead of failing the upload
+REFINE_FALLBACK = os.getenv("REFINE_FALLBACK", "true").lower() == "true"
+
+
+# Preview pass of video uploads: a frame every PREVIEW_EVERY_SEC is transcribed first and published on the job as a rough outline
+# The upload form field "preview" overrides it per upload
+PREVIEW_ENABLED = os.getenv("PREVIEW_ENABLED", "false").lower() == "true"
+
+# Image types accepted by the batch endpoint, zip archives of them are unpacked
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+# Maximum number of images in one batch and maximum unpacked size (MB) of a single image from a zip archive
+BATCH_MAX_IMAGES = int(os.getenv("BATCH_MAX_IMAGES", "50"))
+BATCH_MAX_IMAGE_BYTES = int(float(os.getenv("BATCH_MAX_IMAGE_MB", "20")) * 1024 * 1024)
+# Maximum size (MB) of a whole batch request and of all its images once unpacked
+BATCH_MAX_TOTAL_BYTES = int(float(os.getenv("BATCH_MAX_TOTAL_MB", "200")) * 1024 * 1024)
+
+# Token protecting the admin endpoints - when empty the admin endpoints are disabled
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+# Addresses of reverse proxies whose X-Client-Id header is trusted for the per-client job limit
+TRUSTED_PROXIES = {address.strip() for address in os.getenv("TRUSTED_PROXIES", "").split(",") if address.strip()}
 
 def check_api_keys() -> tuple[bool, str]:
     
@@ -23,7 +85,8 @@ def check_api_keys() -> tuple[bool, str]:
     
     errors = []
     
-    if not NVIDIA_API_KEY or NVIDIA_API_KEY == "your_nvidia_api_key_here":
+    # The local OCR policy works without the NVIDIA API
+    if ocr_router.policy != 'local' and (not NVIDIA_API_KEY or NVIDIA_API_KEY == "your_nvidia_api_key_here"):
         errors.append("NVIDIA API key not set.\nPlease set NVIDIA_API_KEY in your .env file.\nGet your API key from https://build.nvidia.com/settings/api-keys")
     
     if not GEMINI_API_KEY or GEMINI_API_KEY == "your_gemini_api_key_here":
@@ -64,22 +127,48 @@ def get_optimal_workers() -> int:
     print(f"System optimization: {cpu_cores} CPU Threads detected, using {optimal_workers} workers")
     return optimal_workers
 
-def process_frame_with_order(frame_data: Tuple[int, any, str]) -> Tuple[int, str, str]:
+def process_frame_with_order(frame_data: Tuple[int, any, str], hedge: bool = False,
+                             cancel_event: threading.Event = None) -> Tuple[int, str, str]:
     
     # Process a single frame and return the result with its original order index and timestamp
-    # Args:frame_data: Tuple of (frame_number, frame_itself, timestamp_str)  
+    # Args:frame_data: Tuple of (frame_number, frame_itself, timestamp_str), hedge: Send a duplicate request if this one is unusually slow,
+    #      cancel_event: Stops waiting for a hedged request when set
 
     # Returns: Tuple of (frame_number, transcribed_text, timestamp_str)
     
     frame_number, frame_image, timestamp_str = frame_data
-    transcribed_text = transcribe_image(frame_image)
+    if hedge:
+        transcribed_text = ocr_hedger.call(transcribe_image, frame_image, cancel_event)
+    else:
+        transcribed_text = transcribe_image(frame_image)
     return frame_number, transcribed_text, timestamp_str
 
-def process_video_frames_parallel(frames: List[Tuple[int, any, str]], max_workers: int = None) -> List[Tuple[str, str]]:
+def ocr_frame(frame_data: Tuple[int, any, str], hedge: bool = False, retries: int = 0,
+              cancel_event: threading.Event = None) -> FrameResult:
+    # Transcribe one frame into a structured result with its latency, an exception becomes a failed result
+    frame_number, _, timestamp_str = frame_data
+    start = time.perf_counter()
+    with span(f"frame {frame_number}", 'frame', timestamp=timestamp_str, retry=retries):
+        try:
+            _, transcribed_text, _ = process_frame_with_order(frame_data, hedge, cancel_event)
+        except Exception as e:
+            transcribed_text = OCRFailure(f"Error processing frame {frame_number}: {str(e)}")
+    return FrameResult.from_text(frame_number, timestamp_str, transcribed_text, time.perf_counter() - start, retries)
+
+def process_video_frames_parallel(frames: List[Tuple[int, any, str]], max_workers: int = None,
+                                  on_result: Callable[[int, str, str], None] = None, hedge: bool = None,
+                                  cancel_event: threading.Event = None, max_retries: int = None,
+                                  missing: List[dict] = None) -> List[Tuple[str, str]]:
 
     # Process video frames in parallel while maintaining chronological order
+    # A failed frame is queued once more behind the remaining frames, so a transient API error does not lose it
     
-    # Args: "frames": List of (frame_number, frame_itself, timestamp_str) tuples, "max_workers": Maximum number of parallel workers (calculated if None)
+    # Args: "frames": List of (frame_number, frame_itself, timestamp_str) tuples, "max_workers": Maximum number of parallel workers (calculated if None),
+    #       "on_result": Called with (frame_number, transcribed_text, timestamp_str) once the final result of each frame is known,
+    #       "hedge": Hedge slow OCR requests (OCR_HEDGING if None),
+    #       "cancel_event": When set, frames not yet started are cancelled and JobCancelled is raised without waiting for running requests,
+    #       "max_retries": Retries of a failed frame (FRAME_RETRIES if None),
+    #       "missing": Filled with the FrameResult dicts of the frames that still failed after their retries
         
     # Returns: List of (transcribed_text, timestamp_str) tuples in chronological order
 
@@ -93,43 +182,594 @@ def process_video_frames_parallel(frames: List[Tuple[int, any, str]], max_worker
     # For small frame counts, use workers equal to frames
     effective_workers = min(max_workers, len(frames))
     
+    if hedge is None:
+        hedge = OCR_HEDGING
+    if max_retries is None:
+        max_retries = FRAME_RETRIES
+    
     print(f"Processing {len(frames)} frames with {effective_workers} parallel workers")
     
     # Process frames in parallel
+    frames_by_number = {frame_data[0]: frame_data for frame_data in frames}
     results = {}
+    job_start = time.perf_counter()
 
-    with ThreadPoolExecutor(max_workers=effective_workers) as executor:
-        # Submit all frames for processing
-        # And remember which frame number belongs to which task for matching results back to their order later
-        future_to_frame = {
-            executor.submit(process_frame_with_order, frame_data): frame_data[0] 
-            for frame_data in frames
-        }
+    executor = ThreadPoolExecutor(max_workers=effective_workers)
+    try:
+        # Submit all frames for processing, every result carries its own frame number back
+        pending = {executor.submit(bind(ocr_frame), frame_data, hedge, 0, cancel_event) for frame_data in frames}
         
-        # Collect results as they complete
-        for future in as_completed(future_to_frame):
-            try:
-                frame_number, transcribed_text, timestamp_str = future.result()
-                results[frame_number] = (transcribed_text, timestamp_str)
-            except Exception as e:
-                frame_number = future_to_frame[future]
-                # Log the error of the frame - use the timestamp from the original frame data
-                original_frame_data = next(fd for fd in frames if fd[0] == frame_number)
-                timestamp_str = original_frame_data[2]
-                results[frame_number] = (f"Error processing frame {frame_number}: {str(e)}", timestamp_str)
-    
-    # Sort results by frame number to maintain chronological order
-    sorted_results = [results[i] for i in sorted(results.keys())]
-    
-    # Filter out failed transcriptions but keep timestamps
-    valid_results = []
-    for text, timestamp in sorted_results:
-        if text and not text.startswith('API request failed') and not text.startswith('Failed to process') and not text.startswith('Error processing'):
-            valid_results.append((text, timestamp))
+        # Collect results as they complete, checking for cancellation while waiting
+        while pending:
+            done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+            if cancel_event is not None and cancel_event.is_set():
+                raise JobCancelled("frame processing stopped")
+            for future in done:
+                result = future.result()
+                if not result.ok and result.retries < max_retries:
+                    pending.add(executor.submit(bind(ocr_frame), frames_by_number[result.frame_number], hedge, result.retries + 1,
+                                                cancel_event))
+                    continue
+                results[result.frame_number] = result
+                if on_result is not None:
+                    on_result(result.frame_number, result.output, result.timestamp)
+    finally:
+        # On cancellation drop every frame that has not started, running requests finish in the background
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    # The job ends with its slowest frame - kept to report the tail latency of whole jobs
+    ocr_hedger.job_latencies.record(time.perf_counter() - job_start)
+
+    # Sort results by frame number to maintain chronological order, keeping only the frames with text
+    ordered = [results[i] for i in sorted(results)]
+    valid_results = [(result.text, result.timestamp) for result in ordered if result.ok]
+    if missing is not None:
+        missing.extend(result.to_dict() for result in ordered if not result.ok)
     
     print(f"Successfully processed {len(valid_results)}/{len(frames)} frames")
     return valid_results
 
+# Shared queue of the queue execution mode, opened on first use
+_task_queue = None
+_task_queue_lock = threading.Lock()
+
+def get_task_queue():
+    global _task_queue
+    with _task_queue_lock:
+        if _task_queue is None:
+            _task_queue = make_task_queue()
+        return _task_queue
+
+def wait_for_tasks(group_id: str, task_ids: List[str], on_done: Callable[[str, dict], None],
+                   cancel_event: threading.Event = None, timeout: float = None):
+
+    # Wait until every task of a group finished, calling on_done(task_id, task_status) as each one finishes
+    # The group is renewed while this node waits and removed from the queue afterwards
+
+    shared_queue = get_task_queue()
+    timeout = QUEUE_WAIT_SEC if timeout is None else timeout
+    deadline = time.monotonic() + timeout
+    renew_at = time.monotonic() + TASK_GROUP_TTL_SEC / 4
+    remaining = set(task_ids)
+    try:
+        while remaining:
+            if time.monotonic() > renew_at:
+                shared_queue.renew_group(group_id)
+                renew_at = time.monotonic() + TASK_GROUP_TTL_SEC / 4
+            if cancel_event is not None and cancel_event.is_set():
+                shared_queue.cancel_group(group_id)
+                raise JobCancelled("queued tasks cancelled")
+            if time.monotonic() > deadline:
+                shared_queue.cancel_group(group_id)
+                for task_id in sorted(remaining):
+                    on_done(task_id, {'status': 'failed', 'error': f'No worker finished the task within {timeout:.0f}s', 'attempts': 0})
+                return
+            statuses = shared_queue.group_status(group_id)
+            for task_id, task_status in statuses.items():
+                if task_id in remaining and task_status['status'] in ('done', 'failed'):
+                    remaining.discard(task_id)
+                    on_done(task_id, task_status)
+            # Tasks gone from the queue expired, e.g. while this node was stalled for longer than the group lifetime
+            for task_id in sorted(remaining - statuses.keys()):
+                remaining.discard(task_id)
+                on_done(task_id, {'status': 'failed', 'error': 'Task expired in the queue', 'attempts': 0})
+            if remaining:
+                time.sleep(QUEUE_POLL_SEC)
+    finally:
+        shared_queue.delete_group(group_id)
+
+def process_frames_queued(frames: List[Tuple[int, any, str]], on_result: Callable[[int, str, str], None] = None,
+                          cancel_event: threading.Event = None, missing: List[dict] = None) -> List[Tuple[str, str]]:
+
+    # Same contract as process_video_frames_parallel, but the frames are transcribed by the worker processes
+    # Workers retry failed frames and take over the frames of crashed workers once their lease ends
+
+    # Returns: List of (transcribed_text, timestamp_str) tuples in chronological order
+
+    if not frames:
+        return []
+    group_id = uuid.uuid4().hex
+    task_ids = get_task_queue().enqueue('ocr', [
+        {'frame_number': frame_number, 'timestamp': timestamp_str, 'image': encode_image(frame_image)}
+        for frame_number, frame_image, timestamp_str in frames], group_id)
+    frame_of_task = {task_id: (frame_number, timestamp_str) for task_id, (frame_number, _, timestamp_str) in zip(task_ids, frames)}
+    print(f"Queued {len(frames)} frames for the workers")
+
+    results = {}
+
+    def on_done(task_id: str, task_status: dict):
+        frame_number, timestamp_str = frame_of_task[task_id]
+        retries = max(0, task_status['attempts'] - 1)
+        if task_status['status'] == 'done':
+            result = FrameResult(frame_number, timestamp_str, 'ok', text=task_status['result']['text'], retries=retries)
+        else:
+            result = FrameResult(frame_number, timestamp_str, 'failed', error=task_status['error'] or 'Task failed', retries=retries)
+        results[frame_number] = result
+        if on_result is not None:
+            on_result(frame_number, result.output, timestamp_str)
+
+    wait_for_tasks(group_id, task_ids, on_done, cancel_event)
+
+    ordered = [results[i] for i in sorted(results)]
+    if missing is not None:
+        missing.extend(result.to_dict() for result in ordered if not result.ok)
+    return [(result.text, result.timestamp) for result in ordered if result.ok]
+
+def transcribe_frames(frames: List[Tuple[int, any, str]], on_result: Callable[[int, str, str], None] = None,
+                      cancel_event: threading.Event = None, missing: List[dict] = None) -> List[Tuple[str, str]]:
+    # Transcribe frames in this process or on the workers, depending on EXECUTION_MODE
+    if EXECUTION_MODE == 'queue':
+        return process_frames_queued(frames, on_result=on_result, cancel_event=cancel_event, missing=missing)
+    return process_video_frames_parallel(frames, on_result=on_result, cancel_event=cancel_event, missing=missing)
+
+def refine_queued(frame_data: List[Tuple[str, str]]) -> str:
+    # Run the Gemini pass on a worker, failures are reported like process_frames_with_gemini reports them
+    group_id = uuid.uuid4().hex
+    task_ids = get_task_queue().enqueue('refine', [{'frame_data': [list(item) for item in frame_data]}], group_id)
+    outcome = {}
+    wait_for_tasks(group_id, task_ids, lambda task_id, task_status: outcome.update(task_status))
+    if outcome.get('status') == 'done':
+        return outcome['result']['text']
+    error = outcome.get('error') or 'Task failed'
+    return error if error.startswith('An unexpected error occurred') else f"An unexpected error occurred: {error}"
+
+def load_video_frames(file_path: Path, video_hash: str, cancel_event: threading.Event = None) -> List[Tuple[int, Optional[any], str]]:
+
+    # Get the frames of a video, running ffmpeg only when the stage store has no manifest for the current sampling settings
+
+    # Args: "file_path": Path to the video file, "video_hash": Content hash of the video, "cancel_event": Stops ffmpeg when set
+
+    # Returns: List of (frame_number, frame_itself, timestamp_str) tuples - frame_itself is None for stored frames, which are loaded on demand
+
+    manifest = get_stage_store().load_manifest(video_hash)
+    if manifest is not None:
+        return [(frame_number, None, timestamp_str) for frame_number, timestamp_str in manifest]
+
+    with span('extract frames', 'ffmpeg'):
+        frames = extract_frames_to_memory(file_path, cancel_event)
+    get_stage_store().save_frames(video_hash, frames)
+    return frames
+
+def ocr_video_frames(file_path: Path, video_hash: str, frames: List[Tuple[int, Optional[any], str]],
+                     on_result: Callable[[int, str, str], None] = None,
+                     cancel_event: threading.Event = None, quality_stats: dict = None,
+                     done_texts: Dict[int, Tuple[str, str]] = None, missing: List[dict] = None,
+                     fallbacks: List[str] = None) -> List[Tuple[str, str]]:
+
+    # OCR the frames of a video, only sending frames without a checkpointed or stored OCR text to the API
+
+    # Args: "file_path": Path to the video file, "video_hash": Content hash of the video, "frames": Output of load_video_frames,
+    #       "on_result": Called with (frame_number, transcribed_text, timestamp_str) for every frame as soon as its text is known,
+    #       "cancel_event": Stops ffmpeg and the OCR requests when set,
+    #       "quality_stats": Filled with the frame quality gating statistics when given,
+    #       "done_texts": Checkpointed frame_number -> (text, timestamp_str) of an interrupted earlier run of the job,
+    #       "missing": Filled with the FrameResult dicts of the frames that have no text after all retries,
+    #       "fallbacks": Filled with the timestamps of the frames only a fallback engine could transcribe - their texts are not stored
+
+    # Returns: List of (transcribed_text, timestamp_str) tuples in chronological order
+
+    texts = {}
+    pending = []
+    done_texts = done_texts or {}
+    for frame_number, frame_image, timestamp_str in frames:
+        checkpointed = done_texts.get(frame_number)
+        stored_text = checkpointed[0] if checkpointed is not None else get_stage_store().load_ocr(video_hash, timestamp_str)
+        if stored_text is not None:
+            texts[frame_number] = (stored_text, timestamp_str)
+            if on_result is not None:
+                on_result(frame_number, stored_text, timestamp_str)
+        else:
+            if frame_image is None:
+                frame_image = get_stage_store().load_frame(video_hash, timestamp_str)
+            pending.append((frame_number, frame_image, timestamp_str))
+
+    # A stored frame was evicted - extract the video again
+    if any(frame_image is None for _, frame_image, _ in pending):
+        with span('extract frames', 'ffmpeg', reason='evicted'):
+            extracted = extract_frames_to_memory(file_path, cancel_event)
+        get_stage_store().save_frames(video_hash, extracted)
+        images = {timestamp_str: frame_image for _, frame_image, timestamp_str in extracted}
+        pending = [(frame_number, images.get(timestamp_str), timestamp_str) for frame_number, _, timestamp_str in pending]
+        for frame_number, frame_image, timestamp_str in pending:
+            if frame_image is None:
+                lost = FrameResult(frame_number, timestamp_str, 'failed', error=f"Error processing frame {frame_number}: frame not found")
+                if missing is not None:
+                    missing.append(lost.to_dict())
+                if on_result is not None:
+                    on_result(frame_number, lost.error, timestamp_str)
+        pending = [frame for frame in pending if frame[1] is not None]
+
+    # Skip blank, blurred and occluded frames before paying for their OCR
+    if pending and QUALITY_GATING:
+        with span('quality gating', 'pipeline', frames=len(pending)):
+            gated, stats = gate_frames(pending)
+        kept_numbers = {frame_number for frame_number, _, _ in gated}
+        for frame_number, _, timestamp_str in pending:
+            if frame_number not in kept_numbers and on_result is not None:
+                on_result(frame_number, "", timestamp_str)
+        if quality_stats is not None:
+            quality_stats.update(stats)
+        if len(gated) < len(pending):
+            print(f"Quality gating skipped {len(pending) - len(gated)}/{len(pending)} frames")
+        pending = gated
+
+    # With a panning camera only the board regions not seen in an earlier frame are transcribed
+    if pending and MOSAIC_ENABLED and mosaic_available():
+        with span('board mosaic', 'pipeline', frames=len(pending)):
+            planned, stats = plan_mosaic(pending)
+        planned_numbers = {frame_number for frame_number, _, _ in planned}
+        for frame_number, _, timestamp_str in pending:
+            if frame_number not in planned_numbers and on_result is not None:
+                on_result(frame_number, "", timestamp_str)
+        if quality_stats is not None:
+            quality_stats['mosaic'] = stats
+        print(f"Board mosaic: {stats['scenes']} scenes, {stats['cropped']} cropped and {stats['skipped']} skipped of {len(pending)} frames")
+        pending = planned
+
+    if pending:
+        print(f"Reusing {len(texts)} stored OCR results, transcribing {len(pending)} frames")
+        frame_numbers = {timestamp_str: frame_number for frame_number, _, timestamp_str in pending}
+        saved = set()
+        degraded = set()
+
+        def save_result(frame_number: int, text: str, timestamp_str: str):
+            # Store every good text as soon as it arrives so a cancelled job keeps the frames it already paid for
+            if is_fallback_text(text):
+                degraded.add(timestamp_str)
+            elif not is_transcription_error(text):
+                get_stage_store().save_ocr(video_hash, timestamp_str, text)
+                saved.add(timestamp_str)
+            if on_result is not None:
+                on_result(frame_number, text, timestamp_str)
+
+        with span('ocr', 'pipeline', frames=len(pending)):
+            transcribed = transcribe_frames(pending, on_result=save_result, cancel_event=cancel_event, missing=missing)
+        for text, timestamp_str in transcribed:
+            if is_fallback_text(text):
+                degraded.add(timestamp_str)
+            elif timestamp_str not in saved:
+                get_stage_store().save_ocr(video_hash, timestamp_str, text)
+            texts[frame_numbers[timestamp_str]] = (text, timestamp_str)
+        if fallbacks is not None:
+            fallbacks.extend(sorted(degraded))
+
+    return [texts[frame_number] for frame_number in sorted(texts)]
+
+def track_frame_progress(frames: List[Tuple[int, Optional[any], str]], job: Job,
+                         refiner: RollingRefiner = None) -> Callable[[int, str, str], None]:
+
+    # Build the per-frame callback that updates the job progress and feeds the rolling refiner
+    # Frames complete out of order, so texts are handed to the refiner only once every earlier frame is done
+
+    # Args: "frames": Frames of the video, "job": Job to update, "refiner": Rolling refiner (None in full refinement mode)
+
+    # Returns: Callback taking (frame_number, transcribed_text, timestamp_str)
+
+    order = [frame_number for frame_number, _, _ in frames]
+    finished = {}
+    position = 0
+
+    def on_result(frame_number: int, text: str, timestamp_str: str):
+        nonlocal position
+        job.update(frames_done=job.frames_done + 1)
+        if refiner is None:
+            return
+        finished[frame_number] = (text, timestamp_str)
+        ready = []
+        while position < len(order) and order[position] in finished:
+            text, timestamp_str = finished.pop(order[position])
+            position += 1
+            if not is_transcription_error(text):
+                ready.append((text, timestamp_str))
+        if ready:
+            # Do not spend a refinement request on a job nobody is waiting for
+            job.check_cancelled()
+            job.update(partial_text=refiner.add_frames(ready))
+
+    return on_result
+
+def is_refinement_error(text: str) -> bool:
+    # process_frames_with_gemini reports a failed API call as its result text
+    return text.startswith('An unexpected error occurred')
+
+def refine_frame_data(frame_data: List[Tuple[str, str]]) -> str:
+    # Refine the OCR texts with Gemini unless the same texts were already refined with the current prompt and model
+    processed_text = get_stage_store().load_refined(frame_data)
+    if processed_text is None:
+        processed_text = refine_queued(frame_data) if EXECUTION_MODE == 'queue' else process_frames_with_gemini(frame_data)
+        if not is_refinement_error(processed_text):
+            get_stage_store().save_refined(frame_data, processed_text)
+    return processed_text
+
+def index_transcript(video_hash: str, filename: str, text: str, frame_data: List[Tuple[str, str]]):
+    # Make a finished transcript searchable - a failing index never fails the upload itself
+    try:
+        sections = get_search_index().index_lecture(video_hash, filename, text, frame_data)
+        print(f"Indexed {sections} sections of {filename}")
+    except Exception as e:
+        print(f"Search indexing failed for {filename}: {str(e)}")
+
+def process_video_upload(file_path: Path, filename: str, job: Job, refine_mode: str = REFINE_MODE,
+                         video_hash: str = None, preview: bool = PREVIEW_ENABLED, checkpoint: bool = False) -> Tuple[dict, int]:
+
+    # Run the video pipeline for an uploaded file
+    # Identical uploads running at the same time attach to the first one and share its result
+
+    # Args: "file_path": Path to the saved upload, "filename": Original file name, "job": Job tracking the progress, "refine_mode": "full" or "rolling",
+    #       "video_hash": Content hash of the upload (computed from the file if None), "preview": Run the preview pass first,
+    #       "checkpoint": Checkpoint the finished frames - only for jobs started through run_video_job, which removes them again
+
+    # Returns: Tuple of (JSON payload, HTTP status)
+
+    # Return the stored transcript if the same video was already processed with the same settings
+    if video_hash is None:
+        video_hash = hash_file(file_path)
+    settings = pipeline_settings(refine_mode)
+    cache_key = make_cache_key(video_hash, settings)
+    cached = get_result_cache().get(cache_key)
+    if cached is not None:
+        return {**cached, 'cached': True}, 200
+
+    while True:
+        try:
+            # The stages, frames and requests of the run are recorded on the trace of the job
+            with activate(job.trace):
+                (payload, status), leader_id = video_flights.do(
+                    cache_key, lambda: run_video_pipeline(file_path, filename, job, refine_mode, video_hash, cache_key, settings, preview,
+                                               checkpoint),
+                    owner=job.job_id, cancel_event=job.cancel_event)
+        except JobCancelled:
+            return {'error': f'Job cancelled: {job.cancel_reason}'}, 409
+        if leader_id is None:
+            return payload, status
+        # The shared run was cancelled by its own client - this upload still wants the result, so run it here
+        if status == 409:
+            continue
+        print(f"Job {job.job_id} shared the result of identical job {leader_id}")
+        job.update(total_frames=payload.get('total_frames', 0), frames_done=payload.get('total_frames', 0))
+        return {**payload, 'coalesced_with': leader_id}, status
+
+def run_preview_pass(file_path: Path, video_hash: str, job: Job) -> Optional[dict]:
+
+    # Transcribe a sparse sample of the video and publish the texts on the job as a rough outline
+    # Frames and OCR texts are stored under their timestamps, so the full pass reuses them instead of transcribing them again
+
+    # Args: "file_path": Path to the video file, "video_hash": Content hash of the video, "job": Job to publish the preview on
+
+    # Returns: The published preview, None when it failed - the full pass runs either way
+
+    start = time.perf_counter()
+    try:
+        frames = []
+        to_extract = []
+        for seconds in preview_timestamps(get_duration(file_path)):
+            timestamp_str = format_timestamp(seconds)
+            image = get_stage_store().load_frame(video_hash, timestamp_str)
+            if image is None:
+                to_extract.append(seconds)
+            else:
+                frames.append((seconds // EXTRACT_EVERY_SEC, image, timestamp_str))
+        for frame_number, image, timestamp_str in extract_frames_at(file_path, to_extract, job.cancel_event):
+            get_stage_store().save_frame(video_hash, timestamp_str, image)
+            frames.append((frame_number, image, timestamp_str))
+        frames.sort(key=lambda frame: frame[0])
+        frame_data = ocr_video_frames(file_path, video_hash, frames, cancel_event=job.cancel_event)
+    except JobCancelled:
+        raise
+    except Exception as e:
+        print(f"Preview pass failed for job {job.job_id}: {str(e)}")
+        return None
+
+    preview = {
+        'text': "\n\n".join(f"[{timestamp_str}] {text.strip()}" for text, timestamp_str in frame_data if text.strip()),
+        'frames': len(frames),
+        'every_sec': PREVIEW_EVERY_SEC,
+        'sec': round(time.perf_counter() - start, 2),
+    }
+    job.update(preview=preview)
+    print(f"Preview of job {job.job_id}: {len(frames)} frames in {preview['sec']}s")
+    return preview
+
+def run_video_pipeline(file_path: Path, filename: str, job: Job, refine_mode: str, video_hash: str,
+                       cache_key: str, settings: dict, preview: bool = False, checkpoint: bool = False) -> Tuple[dict, int]:
+
+    # Extract, OCR and refine a video whose result is not stored yet
+
+    # Args: "file_path": Path to the saved upload, "filename": Original file name, "job": Job tracking the progress, "refine_mode": "full" or "rolling",
+    #       "video_hash": Content hash of the upload, "cache_key": Result cache key, "settings": Pipeline settings of the key,
+    #       "preview": Publish a preview pass on the job before the full pass, "checkpoint": Checkpoint the finished frames
+
+    # Returns: Tuple of (JSON payload, HTTP status)
+
+    try:
+        if preview:
+            with span('preview pass', 'pipeline'):
+                run_preview_pass(file_path, video_hash, job)
+
+        # Extract frames with timestamps, reusing the stored frames when the video was extracted before
+        frames = load_video_frames(file_path, video_hash, job.cancel_event)
+        
+        if not frames:
+            return {'error': 'No frames extracted from video'}, 400
+        job.update(total_frames=len(frames))
+
+        # In rolling mode the notes are refined batch by batch while the frames are transcribed
+        refiner = RollingRefiner() if refine_mode == 'rolling' else None
+
+        # Frames finished before a crash or restart are not transcribed again
+        done_texts = get_checkpoints().load_frames(job.job_id, video_hash) if checkpoint else {}
+        if done_texts:
+            print(f"Resuming job {job.job_id} with {len(done_texts)} checkpointed frames")
+        track_progress = track_frame_progress(frames, job, refiner)
+
+        def checkpoint_result(frame_number: int, text: str, timestamp_str: str):
+            if checkpoint and frame_number not in done_texts and not is_transcription_error(text):
+                get_checkpoints().save_frame(job.job_id, video_hash, frame_number, timestamp_str, text)
+            track_progress(frame_number, text, timestamp_str)
+        
+        # Process frames in parallel with auto-optimized worker count, skipping frames with a stored OCR text
+        quality_stats = {}
+        missing = []
+        fallbacks = []
+        frame_data = ocr_video_frames(file_path, video_hash, frames, on_result=checkpoint_result,
+                                      cancel_event=job.cancel_event, quality_stats=quality_stats, done_texts=done_texts,
+                                      missing=missing, fallbacks=fallbacks)
+        missing_frames = [{'timestamp': m['timestamp'], 'error': m['error'], 'retries': m['retries']} for m in missing]
+        
+        if not frame_data:
+            return {'error': 'No valid text extracted from video frames', 'missing_frames': missing_frames}, 400
+        
+        # Skip the Gemini call if the client went away during OCR
+        job.check_cancelled()
+
+        # Process the combined frame texts with Gemini API, or merge them locally
+        try:
+            with span('refine', 'refine', mode=refine_mode, frames=len(frame_data)):
+                if refine_mode == 'local':
+                    processed_text = consolidate_frames(frame_data)
+                else:
+                    processed_text = refiner.flush() if refiner is not None else refine_frame_data(frame_data)
+            refinement_error = None
+            if is_refinement_error(processed_text) and REFINE_FALLBACK:
+                refinement_error = processed_text
+                print(f"Gemini refinement failed, merging the frame texts locally: {refinement_error}")
+                with span('local fallback', 'refine'):
+                    processed_text = consolidate_frames(frame_data)
+            result = {
+                'text': processed_text,
+                'frames_processed': len(frame_data),
+                'total_frames': len(frames)
+            }
+            if quality_stats:
+                result['quality'] = quality_stats
+            # Frames that failed after their retries - the result is not stored so a later upload tries them again
+            if missing_frames:
+                result['missing_frames'] = missing_frames
+            # Frames transcribed by the fallback engine - not stored so a later upload asks the configured model again
+            if fallbacks:
+                result['fallback_frames'] = len(fallbacks)
+            # A local fallback transcript is not stored, so a later upload tries Gemini again
+            if refinement_error is not None:
+                result['refinement_error'] = refinement_error
+                result['refined_by'] = 'local'
+            if refiner is not None and refiner.unrefined_frames:
+                result['unrefined_frames'] = refiner.unrefined_frames
+            elif not is_refinement_error(processed_text) and refinement_error is None and not missing_frames and not fallbacks:
+                get_result_cache().put(cache_key, result, meta={'filename': filename, 'settings': settings})
+            if not is_refinement_error(processed_text):
+                index_transcript(video_hash, filename, processed_text, frame_data)
+            return result, 200
+        except ValueError as e:
+            return {'error': str(e)}, 500
+        except Exception as e:
+            return {'error': f'Gemini processing failed: {str(e)}'}, 500
+            
+    except JobCancelled:
+        print(f"Job {job.job_id} cancelled: {job.cancel_reason}")
+        return {'error': f'Job cancelled: {job.cancel_reason}'}, 409
+    except ValueError as e:
+        return {'error': str(e)}, 500
+    except RuntimeError as e:
+        return {'error': f'Video processing failed: {str(e)}'}, 500
+    except Exception as e:
+        return {'error': f'Unexpected video processing error: {str(e)}'}, 500
+
+def run_video_job(file_path: Path, filename: str, job: Job, refine_mode: str = REFINE_MODE,
+                  video_hash: str = None, preview: bool = PREVIEW_ENABLED) -> Tuple[dict, int]:
+
+    # Run a checkpointed video job: its frames survive a crash until the job finishes, then the spooled upload is removed
+
+    # Args: "file_path": Spooled upload, "filename": Original file name, "job": Job tracking the progress, "refine_mode": "full" or "rolling",
+    #       "video_hash": Content hash of the upload (computed from the file if None), "preview": Run the preview pass first
+
+    # Returns: Tuple of (JSON payload, HTTP status)
+
+    get_checkpoints().start_job(job.job_id, file_path, filename, refine_mode)
+    payload, status = process_video_upload(file_path, filename, job, refine_mode, video_hash, preview, checkpoint=True)
+    job.finish(result=payload if status == 200 else None, error=payload.get('error'))
+    get_checkpoints().finish_job(job.job_id, job.status, job.error)
+    file_path.unlink(missing_ok=True)
+    return payload, status
+
+def resume_unfinished_jobs() -> List[Job]:
+
+    # Restart the video jobs that were still running when the backend stopped
+    # Their results can be read from /jobs/<job_id> as before
+
+    # Returns: The resumed jobs
+
+    resumed = []
+    for entry in get_checkpoints().unfinished_jobs():
+        file_path = Path(entry['video_path'])
+        if not file_path.exists():
+            get_checkpoints().finish_job(entry['job_id'], 'failed', 'Upload lost before the job could resume')
+            continue
+        try:
+            job = jobs.create(entry['job_id'])
+        except ValueError as e:
+            print(f"Cannot resume job {entry['job_id']}: {e}")
+            continue
+        print(f"Resuming job {job.job_id} ({entry['filename']})")
+        threading.Thread(target=run_video_job, args=(file_path, entry['filename'], job, entry['refine_mode']), daemon=True).start()
+        resumed.append(job)
+    return resumed
+
+def client_id() -> str:
+    # Identity used for the per-client job limit - the remote address, or the X-Client-Id header set by a trusted proxy
+    # Any caller can send the header, taking it from everyone would let a client dodge its limit or use up another's
+    address = request.remote_addr or 'unknown'
+    if address in TRUSTED_PROXIES:
+        return request.headers.get('X-Client-Id') or address
+    return address
+
+def client_gone() -> bool:
+    # Check whether the client of the current request closed its connection
+    # Unread body bytes keep the socket readable with data, so a client that leaves in the middle of its upload
+    # only shows up once the body was read - the routes probe again before they start the job
+    connection = request.environ.get('werkzeug.socket')
+    return connection is not None and client_disconnected(connection)
+
+def admit_request() -> Ticket:
+    # Admit the job of the current request, giving up its place in line when the client disconnects while waiting
+    # Admission runs before the body is read, so while waiting only clients that left before sending a body are noticed
+    return admission.admit(client_id(), client_gone)
+
+def client_gone_response():
+    # Answer for a client that left while its upload was read, the job is never started
+    print("Client disconnected before its job started")
+    return jsonify({'error': 'Client disconnected before the job started'}), 503
+
+def rejection_response(rejection: AdmissionRejected):
+    # Fast answer for an upload that was not admitted
+    response = jsonify({'error': rejection.reason, 'retry_after': float(rejection.retry_after_header)})
+    response.headers['Retry-After'] = rejection.retry_after_header
+    return response, rejection.status
+
+@app.errorhandler(413)
+def request_too_large(e):
+    # Answer oversized uploads in JSON like every other error of the API
+    return jsonify({'error': f'Upload too large (maximum {MAX_UPLOAD_BYTES // (1024 * 1024)} MB)'}), 413
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
     # Handle file upload and transcription requests
@@ -139,75 +779,378 @@ def upload_file():
     
     # Returns: JSON response containing transcribed text or error message
     
+    job = None
     try:
         # Check API keys before any processing
         keys_valid, error_message = check_api_keys()
         if not keys_valid:
             return jsonify({'error': error_message}), 400
 
-        if 'file' not in request.files:
-            return jsonify({'error': 'No file uploaded'}), 400
+        # Shed load before the upload body is read, so a rejected client gets its answer at once
+        try:
+            ticket = admit_request()
+        except AdmissionRejected as e:
+            return rejection_response(e)
 
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({'error': 'No file selected'}), 400
+        with ticket:
+            if 'file' not in request.files:
+                return jsonify({'error': 'No file uploaded'}), 400
+
+            file = request.files['file']
+            if file.filename == '':
+                return jsonify({'error': 'No file selected'}), 400
+            # Parsing the form consumed the body, so the probe now also sees clients that left during the upload
+            if client_gone():
+                return client_gone_response()
+
+            refine_mode = request.form.get('refine_mode', REFINE_MODE)
+            if refine_mode not in REFINE_MODES:
+                return jsonify({'error': f'Invalid refine mode: {refine_mode}'}), 400
+            preview = request.form.get('preview', str(PREVIEW_ENABLED)).lower() in ('1', 'true', 'yes')
+
+            # Register the job so its progress and partial notes can be read from /jobs/<job_id> while it runs
+            try:
+                job = jobs.create(request.form.get('job_id'))
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
 
-        # Create a temporary directory for the uploaded file only
-        with tmp_dir() as temp_dir:
-            temp_path = Path(temp_dir)
-            
-            # Save the uploaded file temporarily
-            file_path = temp_path / file.filename
-            file.save(file_path)
-            
             # Check if it is a video file
             if file.filename.lower().endswith(('.mp4', '.avi', '.mov', '.mkv')):
+                # Keep the video outside the temporary directory until the job finishes, so a restart can resume it
+                # The content hash is computed while the upload is written, so identical uploads are found without a second read
+                video_path = spool_path(job.job_id, file.filename)
+                video_hash = save_and_hash(file.stream, video_path)
+
+                # Cancel the job if the browser goes away while the video is processed
+                response_ready = threading.Event()
+                connection = request.environ.get('werkzeug.socket')
+                if connection is not None:
+                    watch_client_disconnect(connection, job, response_ready)
                 try:
-                    # Extract frames directly to memory for processing with timestamps
-                    frames = extract_frames_to_memory(file_path)
-                    
-                    if not frames:
-                        return jsonify({'error': 'No frames extracted from video'}), 400
-                    
-                    # Process frames in parallel with auto-optimized worker count
-                    frame_data = process_video_frames_parallel(frames)
-                    
-                    if not frame_data:
-                        return jsonify({'error': 'No valid text extracted from video frames'}), 400
-                    
-                    # Process the combined frame texts with Gemini API
-                    try:
-                        processed_text = process_frames_with_gemini(frame_data)
-                        return jsonify({
-                            'text': processed_text,
-                            'frames_processed': len(frame_data),
-                            'total_frames': len(frames)
-                        })
-                    except ValueError as e:
-                        return jsonify({'error': str(e)}), 500
-                    except Exception as e:
-                        return jsonify({'error': f'Gemini processing failed: {str(e)}'}), 500
-                        
-                except RuntimeError as e:
-                    return jsonify({'error': f'Video processing failed: {str(e)}'}), 500
-                except Exception as e:
-                    return jsonify({'error': f'Unexpected video processing error: {str(e)}'}), 500
-                    
-            else:
+                    payload, status = run_video_job(video_path, file.filename, job, refine_mode, video_hash, preview)
+                finally:
+                    response_ready.set()
+                return jsonify({**payload, 'job_id': job.job_id}), status
+
+            # Create a temporary directory for the uploaded image only
+            with tmp_dir() as temp_dir:
+                temp_path = Path(temp_dir)
+                
+                # Save the uploaded file temporarily
+                file_path = temp_path / file.filename
+                file.save(file_path)
+
                 # Process as single image
                 result_text = transcribe_image(file_path)
+                job.finish(result={'text': result_text})
                 return jsonify({'text': result_text})
 
     except Exception as e:
+        if job is not None and job.status == 'running':
+            job.finish(error=f'Processing error: {str(e)}')
         return jsonify({'error': f'Processing error: {str(e)}'}), 500
     
     
 
+def load_batch_images(files) -> List[Tuple[str, Image.Image]]:
+
+    # Open the uploaded images of a batch, unpacking zip archives in upload order
+
+    # Args: files: Uploaded files (images or zip archives of images)
+
+    # Returns: List of (name, image) tuples
+
+    # Raises: ValueError if the batch is empty, too large or holds a file that is not an image
+
+    blobs = []
+    total_bytes = 0
+
+    def read_limited(stream, name: str) -> bytes:
+        # Read at most one byte past the limit - the sizes declared in a zip archive are not trusted
+        nonlocal total_bytes
+        data = stream.read(BATCH_MAX_IMAGE_BYTES + 1)
+        if len(data) > BATCH_MAX_IMAGE_BYTES:
+            raise ValueError(f"Image too large: {name}")
+        total_bytes += len(data)
+        if total_bytes > BATCH_MAX_TOTAL_BYTES:
+            raise ValueError(f"Batch too large (maximum {BATCH_MAX_TOTAL_BYTES // (1024 * 1024)} MB unpacked)")
+        return data
+
+    for file in files:
+        name = file.filename or ''
+        if name.lower().endswith('.zip'):
+            # The upload is already spooled by the request parser, the archive is read from there
+            with zipfile.ZipFile(file.stream) as archive:
+                for info in archive.infolist():
+                    if info.is_dir() or not info.filename.lower().endswith(IMAGE_EXTENSIONS):
+                        continue
+                    entry_name = f"{name}/{info.filename}"
+                    with archive.open(info) as entry:
+                        blobs.append((entry_name, read_limited(entry, entry_name)))
+                    if len(blobs) > BATCH_MAX_IMAGES:
+                        break
+        elif name.lower().endswith(IMAGE_EXTENSIONS):
+            blobs.append((name, read_limited(file.stream, name)))
+        else:
+            raise ValueError(f"Unsupported file in batch: {name}")
+        if len(blobs) > BATCH_MAX_IMAGES:
+            raise ValueError(f"Too many images in batch (maximum {BATCH_MAX_IMAGES})")
+
+    if not blobs:
+        raise ValueError("No images in batch")
+
+    images = []
+    for name, data in blobs:
+        try:
+            image = Image.open(io.BytesIO(data))
+        except Image.DecompressionBombError:
+            raise ValueError(f"Image has too many pixels: {name}")
+        except Exception:
+            raise ValueError(f"Not a valid image: {name}")
+        # The header gives the size before any pixel is decoded, a small file can still decode to gigabytes
+        if Image.MAX_IMAGE_PIXELS and image.width * image.height > Image.MAX_IMAGE_PIXELS:
+            raise ValueError(f"Image has too many pixels: {name}")
+        try:
+            image.load()
+        except Exception:
+            raise ValueError(f"Not a valid image: {name}")
+        images.append((name, image))
+    return images
+
+def stream_batch(images: List[Tuple[str, Image.Image]], job: Job, merge: bool):
+
+    # Transcribe the images of a batch in parallel and yield one NDJSON line per image as soon as it is done
+    # The last lines are the merged notes (if requested) and a summary
+
+    # Args: "images": Output of load_batch_images, "job": Job tracking the batch, "merge": Combine the texts with the Gemini pass
+
+    updates = queue.Queue()
+    # The image name takes the place of the timestamp, so the merged notes refer to the photos
+    frames = [(index, image, name) for index, (name, image) in enumerate(images)]
+    track_progress = track_frame_progress(frames, job)
+
+    def on_result(index: int, text: str, name: str):
+        track_progress(index, text, name)
+        updates.put({'type': 'image', 'index': index, 'name': name, 'text': text, 'error': is_transcription_error(text)})
+
+    def run():
+        with activate(job.trace):
+            run_batch()
+
+    def run_batch():
+        try:
+            frame_data = transcribe_frames(frames, on_result=on_result, cancel_event=job.cancel_event)
+            result = {'texts': [text for text, _ in frame_data], 'images': len(frames), 'failed': len(frames) - len(frame_data)}
+            if merge and frame_data:
+                job.check_cancelled()
+                result['merged'] = refine_frame_data(frame_data)
+                updates.put({'type': 'merged', 'text': result['merged'], 'error': is_refinement_error(result['merged'])})
+            job.finish(result=result)
+        except JobCancelled:
+            job.finish(error=f'Job cancelled: {job.cancel_reason}')
+        except Exception as e:
+            job.finish(error=f'Batch processing failed: {str(e)}')
+        finally:
+            updates.put(None)
+
+    threading.Thread(target=run, daemon=True).start()
+    try:
+        while (update := updates.get()) is not None:
+            yield json.dumps(update) + "\n"
+        summary = {'type': 'done', 'job_id': job.job_id, 'status': job.status, 'error': job.error}
+        if job.result is not None:
+            summary.update(images=job.result['images'], failed=job.result['failed'])
+        yield json.dumps(summary) + "\n"
+    finally:
+        # The client stopped reading - drop the images that have not started
+        job.cancel('client disconnected')
+
+@app.route('/upload/batch', methods=['POST'])
+def upload_batch():
+    # Transcribe several photos of a board (or zip archives of them) in one request
+    # Form fields: "files" (repeated), optional "merge" to combine the texts into one set of notes, optional "job_id"
+    # Streams newline-delimited JSON: one {"type": "image"} line per image as it completes, then "merged" and "done"
+    if request.content_length is not None and request.content_length > BATCH_MAX_TOTAL_BYTES:
+        return jsonify({'error': f'Batch too large (maximum {BATCH_MAX_TOTAL_BYTES // (1024 * 1024)} MB)'}), 413
+    keys_valid, error_message = check_api_keys()
+    if not keys_valid:
+        return jsonify({'error': error_message}), 400
+
+    try:
+        ticket = admit_request()
+    except AdmissionRejected as e:
+        return rejection_response(e)
+
+    # The slot is held until the stream ends, unless the batch is rejected before streaming starts
+    streaming = False
+    try:
+        files = request.files.getlist('files')
+        if not files:
+            return jsonify({'error': 'No file uploaded'}), 400
+        if client_gone():
+            return client_gone_response()
+        merge = request.form.get('merge', '').lower() in ('1', 'true', 'yes')
+
+        try:
+            images = load_batch_images(files)
+        except (ValueError, zipfile.BadZipFile) as e:
+            return jsonify({'error': str(e)}), 400
+
+        try:
+            job = jobs.create(request.form.get('job_id'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        job.update(total_frames=len(images))
+
+        response = Response(stream_with_context(stream_batch(images, job, merge)), mimetype='application/x-ndjson',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no', 'X-Job-Id': job.job_id})
+        response.call_on_close(ticket.release)
+        streaming = True
+        return response
+    finally:
+        if not streaming:
+            ticket.release()
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    # Progress and partial notes of an upload, available while the upload request is still running
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    # Abort a running upload: ffmpeg is stopped, pending frames are dropped and the Gemini pass is skipped
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job.status != 'running':
+        return jsonify({'error': f'Job is already {job.status}'}), 409
+    job.cancel('cancelled by client')
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/trace', methods=['GET'])
+def job_trace(job_id):
+    # Timeline of a job in the Chrome trace-event format - open it in chrome://tracing or ui.perfetto.dev
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.trace.to_chrome())
+
+@app.route('/search', methods=['GET'])
+def search():
+    # Full-text search over every finished transcript, e.g. /search?q=x^2 + 3x
+    # Optional filters: "lecture" (lecture id) and "source" ("notes" or "ocr"), "limit" caps the results
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'Missing search query'}), 400
+    source = request.args.get('source')
+    if source not in (None, 'notes', 'ocr'):
+        return jsonify({'error': f'Invalid source: {source}'}), 400
+    try:
+        limit = int(request.args.get('limit', 20))
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+
+    start = time.perf_counter()
+    results = get_search_index().search(query, limit=max(1, limit), lecture_id=request.args.get('lecture'), source=source)
+    return jsonify({'query': query, 'results': results, 'took_ms': round((time.perf_counter() - start) * 1000, 2)})
+
+@app.route('/live/start', methods=['POST'])
+def start_live():
+    # Start transcribing a live source (RTMP/RTSP/HLS URL on a host of LIVE_ALLOWED_HOSTS) continuously - an admin action
+    # Body: {"source": stream URL}
+    denied = admin_denied()
+    if denied:
+        return denied
+    keys_valid, error_message = check_api_keys()
+    if not keys_valid:
+        return jsonify({'error': error_message}), 400
+
+    body = request.get_json(silent=True) or {}
+    source = body.get('source')
+    if not source:
+        return jsonify({'error': 'No live source given'}), 400
+
+    try:
+        session = start_live_session(source)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except AdmissionRejected as e:
+        # A capacity refusal like the upload admission, the client may try again later
+        return rejection_response(e)
+    except RuntimeError as e:
+        return jsonify({'error': f'Live processing failed: {str(e)}'}), 500
+    return jsonify({'session_id': session.session_id, 'events': f'/live/{session.session_id}/events'})
+
+@app.route('/live/<session_id>', methods=['GET'])
+def live_status(session_id):
+    # Counters and glass-to-text latency of a live session
+    session = live_sessions.get(session_id)
+    if session is None:
+        return jsonify({'error': 'Live session not found'}), 404
+    return jsonify({**session.status(), 'transcript': list(session.updates)})
+
+@app.route('/live/<session_id>/events', methods=['GET'])
+def live_events(session_id):
+    # Push transcript updates of a live session to the client as server-sent events
+    session = live_sessions.get(session_id)
+    if session is None:
+        return jsonify({'error': 'Live session not found'}), 404
+    return Response(stream_with_context(sse_events(session)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/live/<session_id>/stop', methods=['POST'])
+def stop_live(session_id):
+    # Stop ingesting a live source, the collected transcript stays available
+    denied = admin_denied()
+    if denied:
+        return denied
+    session = live_sessions.get(session_id)
+    if session is None:
+        return jsonify({'error': 'Live session not found'}), 404
+    session.stop()
+    return jsonify(session.status())
+
 @app.route('/health', methods=['GET'])
 def health_check():
     # Health check endpoint
     return jsonify({'status': 'healthy', 'message': 'Video transcription service is running'})
 
+# Result of the last warm-up, None until /warmup was called
+warm_up_report = None
+
+def warm_up() -> dict:
+
+    # Do the one-time setup work of the first request ahead of time
+    # Checks ffmpeg, imports the SDK modules and opens the pooled API connections
+
+    # Returns: Dict with the result and duration (seconds) of every step
+
+    steps = {}
+
+    def step(name: str, fn: Callable[[], object]):
+        start = time.perf_counter()
+        try:
+            result = fn()
+            steps[name] = {'ok': result is not False, 'sec': round(time.perf_counter() - start, 4)}
+        except Exception as e:
+            steps[name] = {'ok': False, 'sec': round(time.perf_counter() - start, 4), 'error': str(e)}
+
+    step('ffmpeg', check_dependencies)
+    step('imports', load_genai)
+    step('ocr_connection', warm_up_connection)
+    return {'ready': all(s['ok'] for s in steps.values()), 'steps': steps,
+            'total_sec': round(sum(s['sec'] for s in steps.values()), 4)}
+
+@app.route('/warmup', methods=['POST'])
+def warmup():
+    # Warm the backend before it serves traffic - called by the launcher once /health answers
+    global warm_up_report
+    warm_up_report = warm_up()
+    return jsonify(warm_up_report)
+
 @app.route('/system-info', methods=['GET'])
 def system_info():
     # Get system information and current optimization settings
@@ -217,9 +1160,101 @@ def system_info():
     return jsonify({
         'cpu_cores': cpu_cores,
         'optimal_workers': optimal_workers,
+        'ocr': ocr_router.stats(),
+        'ocr_streaming': stream_stats.stats(),
+        'hedging': {'enabled': OCR_HEDGING, **ocr_hedger.stats()},
+        'coalescing': video_flights.stats(),
+        'gemini': gemini.stats(),
+        'admission': admission.stats(),
+        'warm_up': warm_up_report,
+        'execution_mode': EXECUTION_MODE,
+        'task_queue': get_task_queue().stats() if EXECUTION_MODE == 'queue' else None,
+        'media_tools': {name: capability and {'version': capability['version'],
+                                              'decoders': len(capability.get('decoders', [])),
+                                              'filters': len(capability.get('filters', []))}
+                        for name, capability in get_capabilities().items()},
         'status': 'System optimized for parallel processing'
     })
 
+def admin_denied():
+    # Admin endpoints are disabled until ADMIN_TOKEN is configured, then they require it in the X-Admin-Token header
+    # Returns: Error response to send, None when the request may use the admin endpoint
+    if not ADMIN_TOKEN:
+        return jsonify({'error': 'Admin endpoints are disabled, set ADMIN_TOKEN to enable them'}), 404
+    if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN):
+        return jsonify({'error': 'Unauthorized'}), 401
+    return None
+
+@app.route('/admin/cache', methods=['GET'])
+def list_cache():
+    # Inspect the stored video transcripts
+    denied = admin_denied()
+    if denied:
+        return denied
+    return jsonify({'stats': get_result_cache().stats(), 'entries': get_result_cache().entries()})
+
+@app.route('/admin/stages', methods=['GET'])
+def stage_stats():
+    # Inspect the stored intermediate pipeline artifacts
+    denied = admin_denied()
+    if denied:
+        return denied
+    return jsonify(get_stage_store().stats())
+
+@app.route('/admin/checkpoints', methods=['GET'])
+def checkpoint_stats():
+    # Inspect the checkpointed jobs and frames
+    denied = admin_denied()
+    if denied:
+        return denied
+    return jsonify(get_checkpoints().stats())
+
+@app.route('/admin/profile', methods=['GET'])
+def profile():
+    # Sample the stacks of the running backend for ?seconds=N (default 10), ?format=collapsed returns flame graph input
+    denied = admin_denied()
+    if denied:
+        return denied
+    try:
+        seconds = float(request.args.get('seconds', 10))
+    except ValueError:
+        return jsonify({'error': 'seconds must be a number'}), 400
+    if not 0 < seconds <= PROFILE_MAX_SEC:
+        return jsonify({'error': f'seconds must be between 0 and {PROFILE_MAX_SEC}'}), 400
+    try:
+        report = sample_profile(seconds, include_idle=request.args.get('idle', 'false').lower() == 'true')
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 409
+    if request.args.get('format') == 'collapsed':
+        return Response("\n".join(report['collapsed']) + "\n", mimetype='text/plain')
+    return jsonify(report)
+
+@app.route('/admin/cache', methods=['DELETE'])
+def clear_cache():
+    # Invalidate every stored video transcript
+    denied = admin_denied()
+    if denied:
+        return denied
+    return jsonify({'removed': get_result_cache().clear()})
+
+@app.route('/admin/cache/<key>', methods=['DELETE'])
+def delete_cache_entry(key):
+    # Invalidate a single stored video transcript
+    denied = admin_denied()
+    if denied:
+        return denied
+    try:
+        removed = get_result_cache().delete(key)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not removed:
+        return jsonify({'error': 'Cache entry not found'}), 404
+    return jsonify({'removed': 1})
+
 if __name__ == '__main__': 
+    debug = os.getenv("FLASK_DEBUG", "1") == "1"
+    # Resume interrupted jobs once, in the process that serves requests - with the debug reloader that is the child process
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        resume_unfinished_jobs()
     # Run the app on port 5000 and allow for threading for parallel processing
-    app.run(debug=True, host='0.0.0.0', port=5000, threaded=True)
\ No newline at end of file
+    app.run(debug=debug, host='0.0.0.0', port=5000, threaded=True)
\ No newline at end of file
@@ -0,0 +1,165 @@
+import os
+from typing import List, Tuple
+
+from PIL import Image
+
+# numpy is optional - without it the mosaic stage is skipped and every frame is transcribed whole
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Register the frames of a panning camera into one board per scene and only transcribe the board regions each frame adds
+MOSAIC_ENABLED = os.getenv("MOSAIC_ENABLED", "0") == "1"
+# Frames are registered on a small grayscale copy of this width, shifts are scaled back to the frame size
+MOSAIC_ANALYSIS_WIDTH = 200
+# Phase correlation peak below which two frames do not show the same board (scene cut, zoom or occlusion)
+MOSAIC_MIN_PEAK = float(os.getenv("MOSAIC_MIN_PEAK", "0.2"))
+# Largest shift between consecutive frames as a fraction of the frame size
+MOSAIC_MAX_SHIFT = 0.75
+# Gray level difference of a changed pixel, and the share of changed pixels in the overlap that means new writing
+MOSAIC_CHANGE_DELTA = 40
+MOSAIC_CHANGE_FRACTION = float(os.getenv("MOSAIC_CHANGE_FRACTION", "0.01"))
+# Frames adding less new board than this fraction of the frame are not transcribed
+MOSAIC_MIN_NEW_FRACTION = float(os.getenv("MOSAIC_MIN_NEW_FRACTION", "0.05"))
+# New regions larger than this fraction of the frame are transcribed as the whole frame
+MOSAIC_FULL_FRAME_FRACTION = 0.7
+# Pixels added around a cropped region so strokes on the seam stay complete
+MOSAIC_CROP_MARGIN = 16
+
+def mosaic_available() -> bool:
+    return np is not None
+
+def mosaic_settings() -> dict:
+    # Settings that decide which region of a frame is transcribed - part of the cache keys, empty when the stage does not run
+    if not (MOSAIC_ENABLED and mosaic_available()):
+        return {}
+    return {
+        'analysis_width': MOSAIC_ANALYSIS_WIDTH,
+        'min_peak': MOSAIC_MIN_PEAK,
+        'max_shift': MOSAIC_MAX_SHIFT,
+        'change_delta': MOSAIC_CHANGE_DELTA,
+        'change_fraction': MOSAIC_CHANGE_FRACTION,
+        'min_new_fraction': MOSAIC_MIN_NEW_FRACTION,
+        'full_frame_fraction': MOSAIC_FULL_FRAME_FRACTION,
+        'crop_margin': MOSAIC_CROP_MARGIN,
+    }
+
+def analysis_array(image: Image.Image) -> 'np.ndarray':
+    # Small grayscale copy of a frame as float array
+    gray = image.convert('L')
+    height = max(1, round(gray.height * MOSAIC_ANALYSIS_WIDTH / gray.width))
+    return np.asarray(gray.resize((MOSAIC_ANALYSIS_WIDTH, height), Image.BOX), dtype=np.float32)
+
+def phase_correlate(previous: 'np.ndarray', current: 'np.ndarray') -> Tuple[int, int, float]:
+
+    # Find the translation between two views of the board from the peak of their normalized cross-power spectrum
+
+    # Args: "previous": Analysis array of the earlier frame, "current": Analysis array of the later frame (same shape)
+
+    # Returns: Tuple of (dy, dx, peak) - position of the current view relative to the previous one and the match strength (0..1)
+
+    height, width = previous.shape
+    # The window keeps the frame borders from dominating the spectrum
+    window = np.outer(np.hanning(height), np.hanning(width))
+    spectrum_previous = np.fft.fft2((previous - previous.mean()) * window)
+    spectrum_current = np.fft.fft2((current - current.mean()) * window)
+    cross = spectrum_previous * np.conj(spectrum_current)
+    cross /= np.abs(cross) + 1e-9
+    correlation = np.fft.ifft2(cross).real
+    dy, dx = np.unravel_index(np.argmax(correlation), correlation.shape)
+    peak = float(correlation[dy, dx])
+    # Peaks past the middle are negative shifts
+    if dy > height // 2:
+        dy -= height
+    if dx > width // 2:
+        dx -= width
+    return int(dy), int(dx), peak
+
+def register_frames(arrays: List['np.ndarray']) -> List[List[Tuple[int, int, int]]]:
+
+    # Chain consecutive frames into scenes, placing every frame of a scene on the scene board
+
+    # Args: arrays: Analysis arrays of the frames in chronological order
+
+    # Returns: List of scenes, each a list of (frame_index, top, left) in analysis pixels relative to the first frame of the scene
+
+    scenes = []
+    for index, array in enumerate(arrays):
+        if scenes and array.shape == arrays[index - 1].shape:
+            dy, dx, peak = phase_correlate(arrays[index - 1], array)
+            height, width = array.shape
+            if (peak >= MOSAIC_MIN_PEAK and abs(dy) <= MOSAIC_MAX_SHIFT * height
+                    and abs(dx) <= MOSAIC_MAX_SHIFT * width):
+                _, top, left = scenes[-1][-1]
+                scenes[-1].append((index, top + dy, left + dx))
+                continue
+        scenes.append([(index, 0, 0)])
+    return scenes
+
+def plan_mosaic(frames: List[Tuple[int, Image.Image, str]]) -> Tuple[List[Tuple[int, Image.Image, str]], dict]:
+
+    # Decide per frame what is worth transcribing on the board of its scene, registered from the frames before it
+    # A frame with new writing where the board was already seen is transcribed whole, a frame that only pans onto
+    # unseen board is cropped to the new region, and a frame adding nothing is skipped
+
+    # Args: frames: List of (frame_number, frame_itself, timestamp_str) tuples in chronological order
+
+    # Returns: Tuple of (frames to transcribe - cropped images for panned frames, per-job statistics)
+
+    stats = {'scenes': 0, 'frames': len(frames), 'full': 0, 'cropped': 0, 'skipped': 0, 'ocr_area': 0.0}
+    if not frames:
+        return [], stats
+
+    arrays = [analysis_array(image) for _, image, _ in frames]
+    scenes = register_frames(arrays)
+    stats['scenes'] = len(scenes)
+    planned = {}
+    for scene in scenes:
+        min_top = min(top for _, top, _ in scene)
+        min_left = min(left for _, _, left in scene)
+        height = max(top + arrays[index].shape[0] for index, top, _ in scene) - min_top
+        width = max(left + arrays[index].shape[1] for index, _, left in scene) - min_left
+        # Latest gray level seen at every board position, NaN where the board was not seen yet
+        board = np.full((height, width), np.nan, dtype=np.float32)
+
+        for index, top, left in scene:
+            array = arrays[index]
+            rows = slice(top - min_top, top - min_top + array.shape[0])
+            cols = slice(left - min_left, left - min_left + array.shape[1])
+            seen = board[rows, cols]
+            covered = ~np.isnan(seen)
+            changed = float((np.abs(seen[covered] - array[covered]) > MOSAIC_CHANGE_DELTA).mean()) if covered.any() else 0.0
+            new = ~covered
+            board[rows, cols] = array
+
+            frame_number, image, timestamp_str = frames[index]
+            if changed > MOSAIC_CHANGE_FRACTION or not covered.any():
+                planned[index] = (frame_number, image, timestamp_str)
+                stats['full'] += 1
+                stats['ocr_area'] += 1.0
+                continue
+            if new.mean() < MOSAIC_MIN_NEW_FRACTION:
+                stats['skipped'] += 1
+                continue
+            # Bounding box of the unseen region, scaled to the frame with a margin for strokes on the seam
+            scale = image.width / array.shape[1]
+            new_rows = np.flatnonzero(new.any(axis=1))
+            new_cols = np.flatnonzero(new.any(axis=0))
+            box = (max(0, int(new_cols[0] * scale) - MOSAIC_CROP_MARGIN),
+                   max(0, int(new_rows[0] * scale) - MOSAIC_CROP_MARGIN),
+                   min(image.width, int((new_cols[-1] + 1) * scale) + MOSAIC_CROP_MARGIN),
+                   min(image.height, int((new_rows[-1] + 1) * scale) + MOSAIC_CROP_MARGIN))
+            area = (box[2] - box[0]) * (box[3] - box[1]) / (image.width * image.height)
+            if area > MOSAIC_FULL_FRAME_FRACTION:
+                planned[index] = (frame_number, image, timestamp_str)
+                stats['full'] += 1
+                stats['ocr_area'] += 1.0
+            else:
+                planned[index] = (frame_number, image.crop(box), timestamp_str)
+                stats['cropped'] += 1
+                stats['ocr_area'] += area
+
+    # Share of the frame area that is still transcribed
+    stats['ocr_area'] = round(stats['ocr_area'] / len(frames), 3)
+    return [planned[index] for index in sorted(planned)], stats
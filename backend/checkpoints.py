@@ -0,0 +1,115 @@
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+# SQLite database holding the unfinished jobs and their finished frames
+CHECKPOINT_DB = Path(os.getenv("CHECKPOINT_DB", Path(__file__).parent / "cache" / "checkpoints.db"))
+# Uploaded videos are kept here until their job finishes, so a restarted backend can resume them
+SPOOL_DIR = Path(os.getenv("SPOOL_DIR", Path(__file__).parent / "cache" / "spool"))
+# Finished jobs are kept this long (seconds) for the admin statistics, then their rows are deleted
+CHECKPOINT_JOB_TTL_SEC = int(os.getenv("CHECKPOINT_JOB_TTL_SEC", str(7 * 24 * 3600)))
+
+class CheckpointStore:
+
+    # Durable per-frame results of running jobs
+    # WAL mode lets every finished frame be committed cheaply while other threads keep reading
+
+    def __init__(self, db_path: Path, job_ttl_sec: int = CHECKPOINT_JOB_TTL_SEC):
+        self.db_path = Path(db_path)
+        self.job_ttl_sec = job_ttl_sec
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # NORMAL is durable across application crashes in WAL mode, only a power loss can drop the last commits
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        # Frames used to be keyed by the job id alone - checkpoints are short-lived, so the old table is simply dropped
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(frames)")]
+        if columns and 'video_hash' not in columns:
+            self._conn.execute("DROP TABLE frames")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                video_path TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                refine_mode TEXT NOT NULL,
+                status TEXT NOT NULL,
+                created REAL NOT NULL,
+                updated REAL NOT NULL,
+                error TEXT
+            );
+            CREATE TABLE IF NOT EXISTS frames (
+                job_id TEXT NOT NULL,
+                video_hash TEXT NOT NULL,
+                frame_number INTEGER NOT NULL,
+                timestamp TEXT NOT NULL,
+                text TEXT NOT NULL,
+                PRIMARY KEY (job_id, video_hash, frame_number)
+            );
+        """)
+        self._conn.commit()
+
+    def _execute(self, sql: str, params: tuple = ()) -> List[tuple]:
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+            self._conn.commit()
+            return rows
+
+    def start_job(self, job_id: str, video_path: Path, filename: str, refine_mode: str):
+        # Record a job as running - frames of an earlier attempt with the same id stay, they are keyed by their video
+        now = time.time()
+        self._execute(
+            "INSERT INTO jobs (job_id, video_path, filename, refine_mode, status, created, updated) VALUES (?, ?, ?, ?, 'running', ?, ?) "
+            "ON CONFLICT(job_id) DO UPDATE SET video_path = excluded.video_path, filename = excluded.filename, "
+            "refine_mode = excluded.refine_mode, status = 'running', error = NULL, updated = excluded.updated",
+            (job_id, str(video_path), filename, refine_mode, now, now))
+
+    def save_frame(self, job_id: str, video_hash: str, frame_number: int, timestamp_str: str, text: str):
+        self._execute("INSERT OR REPLACE INTO frames (job_id, video_hash, frame_number, timestamp, text) VALUES (?, ?, ?, ?, ?)",
+                      (job_id, video_hash, frame_number, timestamp_str, text))
+
+    def load_frames(self, job_id: str, video_hash: str) -> Dict[int, Tuple[str, str]]:
+        # Finished frames of a job on this video: frame_number -> (text, timestamp_str)
+        # A reused job id with a different video never sees the frames of the earlier one
+        rows = self._execute("SELECT frame_number, text, timestamp FROM frames WHERE job_id = ? AND video_hash = ?",
+                             (job_id, video_hash))
+        return {frame_number: (text, timestamp_str) for frame_number, text, timestamp_str in rows}
+
+    def finish_job(self, job_id: str, status: str, error: str = None):
+        # Mark a job as finished and drop its frames, the result itself lives in the result cache
+        # Rows of jobs that finished longer than the TTL ago are deleted at the same time
+        now = time.time()
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET status = ?, error = ?, updated = ? WHERE job_id = ?",
+                               (status, error, now, job_id))
+            self._conn.execute("DELETE FROM frames WHERE job_id = ?", (job_id,))
+            self._conn.execute("DELETE FROM jobs WHERE status != 'running' AND updated < ?", (now - self.job_ttl_sec,))
+            self._conn.commit()
+
+    def unfinished_jobs(self) -> List[dict]:
+        rows = self._execute("SELECT job_id, video_path, filename, refine_mode FROM jobs WHERE status = 'running' ORDER BY created")
+        return [{'job_id': r[0], 'video_path': r[1], 'filename': r[2], 'refine_mode': r[3]} for r in rows]
+
+    def stats(self) -> dict:
+        rows = self._execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+        frames = self._execute("SELECT COUNT(*) FROM frames")[0][0]
+        return {'jobs': {status: count for status, count in rows}, 'checkpointed_frames': frames}
+
+def spool_path(job_id: str, filename: str) -> Path:
+    # Where the upload of a job is kept while the job runs
+    SPOOL_DIR.mkdir(parents=True, exist_ok=True)
+    return SPOOL_DIR / f"{job_id}{Path(filename).suffix.lower()}"
+
+# Checkpoints of this backend, opened on first use so importing the backend creates no files
+_checkpoints = None
+_checkpoints_lock = threading.Lock()
+
+def get_checkpoints() -> CheckpointStore:
+    global _checkpoints
+    with _checkpoints_lock:
+        if _checkpoints is None:
+            _checkpoints = CheckpointStore(CHECKPOINT_DB)
+        return _checkpoints
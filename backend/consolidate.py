@@ -0,0 +1,158 @@
+import os
+import re
+from difflib import SequenceMatcher
+from typing import List, Tuple
+
+# Two OCR lines at least this similar are the same board line read twice
+CONSOLIDATE_MATCH_RATIO = float(os.getenv("CONSOLIDATE_MATCH_RATIO", "0.8"))
+# Fuzzy matches are searched among the lines seen in this many preceding frames - the board changes little between neighbors
+CONSOLIDATE_WINDOW_FRAMES = 3
+# A fuzzy match at least this similar is taken without looking at the remaining candidates
+CONSOLIDATE_STRONG_RATIO = 0.9
+# Lines shorter than this after cleaning are OCR noise (stray marks, single letters)
+CONSOLIDATE_MIN_LINE_CHARS = 2
+
+_WHITESPACE = re.compile(r'\s+')
+
+def normalize_line(line: str) -> str:
+    # A line with its whitespace collapsed, OCR spacing varies between frames
+    return _WHITESPACE.sub(' ', line).strip()
+
+def clean_lines(text: str) -> List[str]:
+    # Board lines of an OCR text with whitespace collapsed and noise lines removed
+    lines = (normalize_line(line) for line in text.splitlines())
+    return [line for line in lines if len(line) >= CONSOLIDATE_MIN_LINE_CHARS]
+
+class LineTracker:
+
+    # Board lines seen so far in reading order, each with the timestamp of its most complete version
+    # New lines of a frame are placed after the last line of the same frame that was already known,
+    # so writing added between existing lines keeps its place
+
+    def __init__(self, match_ratio: float = CONSOLIDATE_MATCH_RATIO):
+        self.match_ratio = match_ratio
+        # [text, timestamp_str, last frame that showed the line] in reading order
+        self.entries = []
+        self.frames_seen = 0
+        # Exact text -> entries with that text, most lines repeat unchanged from frame to frame
+        # A board can hold the same line several times (x = 0 in two places), each copy is its own entry
+        self._exact = {}
+        # id(entry) -> index in entries, so an exact repeat is placed without scanning the list
+        self._positions = {}
+
+    def _insert(self, position: int, entry: list):
+        self.entries.insert(position, entry)
+        for index in range(position, len(self.entries)):
+            self._positions[id(self.entries[index])] = index
+        self._exact.setdefault(entry[0], []).append(entry)
+
+    def _rename(self, entry: list, text: str):
+        # Move an entry to the longer text it was completed to
+        copies = self._exact[entry[0]]
+        copies.remove(entry)
+        if not copies:
+            del self._exact[entry[0]]
+        entry[0] = text
+        self._exact.setdefault(text, []).append(entry)
+
+    def find(self, line: str, near: int, after: int = None) -> Tuple[int, float]:
+        # Index and similarity of the most similar known line, (-1, 0.0) if none is similar enough
+        # Lines already matched in the current frame are skipped, so a line written twice stays twice
+        # Exact repeats are found anywhere - the first copy at or after "after" (the line following the previous match),
+        # the first copy at all at the start of a frame - fuzzy matches only among the lines of the last frames,
+        # starting at the expected position "near" since the board keeps its line order
+        current = self.frames_seen - 1
+        copies = [self._positions[id(entry)] for entry in self._exact.get(line, ()) if entry[2] != current]
+        if copies:
+            if after is None:
+                return min(copies), 1.0
+            following = [index for index in copies if index >= after]
+            return (min(following) if following else max(copies)), 1.0
+        best, best_ratio = -1, 0.0
+        matcher = SequenceMatcher(autojunk=False)
+        matcher.set_seq2(line)
+        oldest = self.frames_seen - CONSOLIDATE_WINDOW_FRAMES
+        count = len(self.entries)
+        for offset in range(2 * count):
+            # near, near - 1, near + 1, near - 2, ...
+            index = near + (offset + 1) // 2 * (1 if offset % 2 else -1)
+            if not 0 <= index < count:
+                continue
+            text, _, last_seen = self.entries[index]
+            if last_seen < oldest or last_seen == current:
+                continue
+            matcher.set_seq1(text)
+            # The quick upper bounds skip most pairs before the full comparison
+            if matcher.real_quick_ratio() < self.match_ratio or matcher.quick_ratio() < self.match_ratio:
+                continue
+            ratio = matcher.ratio()
+            if ratio >= self.match_ratio and ratio > best_ratio:
+                best, best_ratio = index, ratio
+                if ratio >= CONSOLIDATE_STRONG_RATIO:
+                    break
+        return best, best_ratio
+
+    def add_frame(self, text: str, timestamp_str: str) -> List[str]:
+
+        # Merge the lines of one frame into the known lines
+
+        # Args: "text": OCR text of the frame, "timestamp_str": Timestamp of the frame
+
+        # Returns: The lines of the frame that were new or more complete than their known version
+
+        added = []
+        cursor = None
+        frame = self.frames_seen
+        self.frames_seen += 1
+        for line in clean_lines(text):
+            index, ratio = self.find(line, len(self.entries) - 1 if cursor is None else cursor, cursor)
+            if index == -1:
+                position = len(self.entries) if cursor is None else cursor
+                self._insert(position, [line, timestamp_str, frame])
+                cursor = position + 1
+                added.append(line)
+                continue
+            # A longer version of a known line is the same line written further
+            entry = self.entries[index]
+            if ratio < 1.0 and len(line) > len(entry[0]):
+                self._rename(entry, line)
+                entry[1] = timestamp_str
+                added.append(line)
+            entry[2] = frame
+            cursor = index + 1
+        return added
+
+def consolidate_frames(frame_data: List[Tuple[str, str]]) -> str:
+
+    # Build a deduplicated transcript from the OCR texts of consecutive frames without an LLM
+
+    # Args: "frame_data": List of (ocr_text, timestamp_str) tuples in chronological order
+
+    # Returns: Transcript with a [h:mm:ss] marker before every run of lines that reached their final form at the same time
+
+    tracker = LineTracker()
+    for text, timestamp_str in frame_data:
+        tracker.add_frame(text, timestamp_str)
+    sections = []
+    for text, timestamp_str, _ in tracker.entries:
+        if sections and sections[-1][0] == timestamp_str:
+            sections[-1][1].append(text)
+        else:
+            sections.append((timestamp_str, [text]))
+    return "\n\n".join(f"[{timestamp_str}] " + "\n".join(lines) for timestamp_str, lines in sections)
+
+def reduce_frames(frame_data: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+
+    # Strip every frame down to the lines it adds to the earlier frames, to shrink the refinement prompt
+
+    # Args: "frame_data": List of (ocr_text, timestamp_str) tuples in chronological order
+
+    # Returns: List of (new_lines_text, timestamp_str) tuples, frames that add nothing are left out
+
+    tracker = LineTracker()
+    reduced = []
+    for text, timestamp_str in frame_data:
+        added = tracker.add_frame(text, timestamp_str)
+        if added:
+            reduced.append(("\n".join(added), timestamp_str))
+    return reduced
@@ -0,0 +1,132 @@
+import os
+from typing import List, Tuple
+
+from PIL import Image, ImageFilter, ImageStat
+
+# Skip blank, blurred and occluded frames before OCR - opt-in, it changes which frames reach the transcript
+QUALITY_GATING = os.getenv("QUALITY_GATING", "0") == "1"
+# Blank board: almost no contrast (grayscale standard deviation) or almost no edges
+BLANK_MAX_STDDEV = float(os.getenv("BLANK_MAX_STDDEV", "4"))
+BLANK_MAX_EDGE_FRACTION = float(os.getenv("BLANK_MAX_EDGE_FRACTION", "0.002"))
+# Motion blur: variance of the Laplacian response below this value
+BLUR_MIN_LAPLACIAN_VAR = float(os.getenv("BLUR_MIN_LAPLACIAN_VAR", "15"))
+# Occlusion: share of grid cells mostly covered by something that is not board (e.g. the lecturer)
+OCCLUSION_MAX_FRACTION = float(os.getenv("OCCLUSION_MAX_FRACTION", "0.25"))
+# A blurred or occluded frame is only skipped when a good frame follows within this many frames,
+# further away the board may have been erased in between
+QUALITY_DEFER_FRAMES = int(os.getenv("QUALITY_DEFER_FRAMES", "1"))
+
+# Frames are scored on a small grayscale copy - enough detail for the heuristics and cheap to compute
+SCORE_SIZE = (320, 320)
+# Gray level difference from the board background that counts as foreground
+FOREGROUND_DELTA = 40
+# Edge magnitude that counts as an edge pixel
+EDGE_THRESHOLD = 40
+# Occlusion grid resolution and the foreground density that marks a cell as covered
+OCCLUSION_GRID = (16, 16)
+OCCLUSION_CELL_DENSITY = 0.5
+
+# 3x3 Laplacian, offset so negative responses are not clipped
+LAPLACIAN = ImageFilter.Kernel((3, 3), [0, 1, 0, 1, -4, 1, 0, 1, 0], scale=1, offset=128)
+
+def gating_settings() -> dict:
+    # Settings that decide which frames are transcribed - part of the OCR stage key and the result cache key while gating is on
+    if not QUALITY_GATING:
+        return {}
+    return {
+        'blank_max_stddev': BLANK_MAX_STDDEV,
+        'blank_max_edge_fraction': BLANK_MAX_EDGE_FRACTION,
+        'blur_min_laplacian_var': BLUR_MIN_LAPLACIAN_VAR,
+        'occlusion_max_fraction': OCCLUSION_MAX_FRACTION,
+        'defer_frames': QUALITY_DEFER_FRAMES,
+    }
+
+def score_frame(image: Image.Image) -> dict:
+
+    # Compute the quality scores of a frame - all operations run inside PIL on whole images
+
+    # Args: image: The frame
+
+    # Returns: Dict with stddev, edge_fraction, laplacian_var and occluded_fraction
+
+    gray = image.convert('L')
+    gray.thumbnail(SCORE_SIZE)
+    stats = ImageStat.Stat(gray)
+
+    # Filters respond to the image border, so their one pixel frame is cut off
+    inner = (1, 1, gray.width - 1, gray.height - 1)
+    edges = gray.filter(ImageFilter.FIND_EDGES).crop(inner).point(lambda v: 255 if v > EDGE_THRESHOLD else 0)
+    edge_fraction = ImageStat.Stat(edges).mean[0] / 255
+
+    laplacian_var = ImageStat.Stat(gray.filter(LAPLACIAN).crop(inner)).var[0]
+
+    # Pen strokes are thin, so only large solid regions that differ from the board fill whole grid cells
+    background = stats.median[0]
+    foreground = gray.point(lambda v: 255 if abs(v - background) > FOREGROUND_DELTA else 0)
+    cells = foreground.resize(OCCLUSION_GRID, Image.BOX)
+    covered = cells.point(lambda v: 255 if v > OCCLUSION_CELL_DENSITY * 255 else 0)
+    occluded_fraction = ImageStat.Stat(covered).mean[0] / 255
+
+    return {
+        'stddev': stats.stddev[0],
+        'edge_fraction': edge_fraction,
+        'laplacian_var': laplacian_var,
+        'occluded_fraction': occluded_fraction,
+    }
+
+def classify_frame(scores: dict) -> str:
+    # Name the problem of a frame, or "ok"
+    if scores['stddev'] <= BLANK_MAX_STDDEV:
+        return 'blank'
+    if scores['occluded_fraction'] > OCCLUSION_MAX_FRACTION:
+        return 'occluded'
+    # Blur is checked before the edge count - a heavily blurred board has no sharp edges either
+    if scores['laplacian_var'] < BLUR_MIN_LAPLACIAN_VAR:
+        return 'blurred'
+    if scores['edge_fraction'] <= BLANK_MAX_EDGE_FRACTION:
+        return 'blank'
+    return 'ok'
+
+def gate_frames(frames: List[Tuple[int, Image.Image, str]],
+                defer_frames: int = None) -> Tuple[List[Tuple[int, Image.Image, str]], dict]:
+
+    # Drop frames that are not worth an OCR request
+    # A blurred or occluded frame with a good frame at most defer_frames later is deferred to it - the later frame shows
+    # the same board in a usable state; without a good frame that close it is kept, the board may be erased before the next one
+    # Blank frames have nothing to transcribe and are always dropped
+    # If no frame passes at all every frame is kept, so gating never empties a job
+
+    # Args: "frames": List of (frame_number, frame_itself, timestamp_str) tuples in chronological order,
+    #       "defer_frames": How close the next good frame must be (QUALITY_DEFER_FRAMES if None)
+
+    # Returns: Tuple of (frames to transcribe, per-job statistics)
+
+    labels = [classify_frame(score_frame(image)) for _, image, _ in frames]
+    stats = {'checked': len(frames), 'blank': 0, 'blurred': 0, 'occluded': 0, 'deferred': 0, 'dropped': 0, 'kept': 0}
+
+    if frames and all(label != 'ok' for label in labels):
+        stats['kept'] = len(frames)
+        return list(frames), stats
+
+    if defer_frames is None:
+        defer_frames = QUALITY_DEFER_FRAMES
+    kept = []
+    # Walk backwards so every frame knows how many frames later the next good frame comes, None if none follows
+    good_distance = None
+    for frame, label in zip(reversed(frames), reversed(labels)):
+        if label == 'ok':
+            kept.append(frame)
+            good_distance = 0
+            continue
+        if good_distance is not None:
+            good_distance += 1
+        stats[label] += 1
+        if good_distance is not None and good_distance <= defer_frames:
+            stats['deferred'] += 1
+        elif label == 'blank':
+            stats['dropped'] += 1
+        else:
+            kept.append(frame)
+    kept.reverse()
+    stats['kept'] = len(kept)
+    return kept, stats
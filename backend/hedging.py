@@ -0,0 +1,211 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Optional
+
+from process_frames import is_transcription_error
+from jobs import JobCancelled
+from tracing import bind
+
+# Hedged OCR requests are opt-in
+OCR_HEDGING = os.getenv("OCR_HEDGING", "0") == "1"
+# A duplicate request is sent when a request runs longer than this percentile of the recent latencies
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+# No hedging until this many latencies were seen, the percentile would be meaningless before
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+# Never hedge earlier than this (seconds), even when recent requests were very fast
+HEDGE_MIN_DELAY_SEC = float(os.getenv("HEDGE_MIN_DELAY_SEC", "1.0"))
+# Duplicate requests may be at most this fraction of all requests (plus a small burst allowance)
+HEDGE_BUDGET_RATIO = float(os.getenv("HEDGE_BUDGET_RATIO", "0.05"))
+HEDGE_BUDGET_BURST = int(os.getenv("HEDGE_BUDGET_BURST", "2"))
+# Duplicate requests running at once - a hedge is only sent when it can start right away
+HEDGE_MAX_INFLIGHT = int(os.getenv("HEDGE_MAX_INFLIGHT", "4"))
+# How often a waiting call checks whether its job was cancelled (seconds)
+CANCEL_POLL_SEC = 0.5
+# Number of recent latencies kept
+LATENCY_WINDOW = 1000
+
+class LatencyTracker:
+
+    # Sliding window of recent latencies (seconds)
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._values = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._values.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def percentile(self, percent: float) -> Optional[float]:
+        with self._lock:
+            ordered = sorted(self._values)
+        if not ordered:
+            return None
+        index = min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+class HedgeBudget:
+
+    # Global cap on duplicate requests: hedges <= ratio * primary requests + burst
+
+    def __init__(self, ratio: float = HEDGE_BUDGET_RATIO, burst: int = HEDGE_BUDGET_BURST):
+        self.ratio = ratio
+        self.burst = burst
+        self.primaries = 0
+        self.hedges = 0
+        self._lock = threading.Lock()
+
+    def record_primary(self):
+        with self._lock:
+            self.primaries += 1
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self.hedges + 1 > self.ratio * self.primaries + self.burst:
+                return False
+            self.hedges += 1
+            return True
+
+class Hedger:
+
+    # Runs a request and, if it is slower than the percentile deadline of recent requests,
+    # fires one duplicate request and returns whichever good answer arrives first
+
+    def __init__(self, max_workers: int = 32, percentile: float = HEDGE_PERCENTILE,
+                 min_samples: int = HEDGE_MIN_SAMPLES, min_delay: float = HEDGE_MIN_DELAY_SEC,
+                 budget: HedgeBudget = None, max_hedges: int = HEDGE_MAX_INFLIGHT):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.budget = budget or HedgeBudget()
+        self.request_latencies = LatencyTracker()
+        self.job_latencies = LatencyTracker()
+        self.hedge_wins = 0
+        self.budget_denied = 0
+        self.hedges_busy = 0
+        # Primary requests run on their own pool so the calling worker can wait on two requests at once
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="primary")
+        # Hedges have a separate small pool, so a duplicate never queues behind the primaries it should overtake
+        self._hedge_executor = ThreadPoolExecutor(max_workers=max_hedges, thread_name_prefix="hedge")
+        self._hedge_slots = threading.Semaphore(max_hedges)
+        self._lock = threading.Lock()
+
+    def deadline(self) -> Optional[float]:
+        # Time after which a request counts as slow, None while there are too few samples
+        if len(self.request_latencies) < self.min_samples:
+            return None
+        return max(self.min_delay, self.request_latencies.percentile(self.percentile))
+
+    def _timed(self, fn: Callable, arg, started: threading.Event = None):
+        if started is not None:
+            started.set()
+        start = time.perf_counter()
+        try:
+            return fn(arg)
+        finally:
+            self.request_latencies.record(time.perf_counter() - start)
+
+    def _timed_hedge(self, fn: Callable, arg):
+        try:
+            return self._timed(fn, arg)
+        finally:
+            self._hedge_slots.release()
+
+    @staticmethod
+    def _wait(futures: set, timeout: Optional[float], cancel_event: threading.Event = None):
+        # wait() for the first finished future, raising JobCancelled as soon as the job is cancelled
+        end = None if timeout is None else time.perf_counter() + timeout
+        while True:
+            remaining = None if end is None else max(0.0, end - time.perf_counter())
+            step = remaining
+            if cancel_event is not None:
+                step = CANCEL_POLL_SEC if remaining is None else min(CANCEL_POLL_SEC, remaining)
+            done, pending = wait(futures, timeout=step, return_when=FIRST_COMPLETED)
+            if cancel_event is not None and cancel_event.is_set():
+                raise JobCancelled("hedged request stopped")
+            if done or (end is not None and time.perf_counter() >= end):
+                return done, pending
+
+    def _result(self, future, cancel_event: threading.Event = None):
+        self._wait({future}, None, cancel_event)
+        return future.result()
+
+    def call(self, fn: Callable, arg, cancel_event: threading.Event = None):
+
+        # Call fn(arg) with hedging, fn must be safe to run twice for the same argument
+
+        # Args: "fn": Request function, "arg": Its argument, "cancel_event": When set, stop waiting and drop a hedge that has not started
+
+        # Returns: The first good answer, or the last answer when both requests failed
+
+        # Raises: JobCancelled when cancel_event is set while waiting
+
+        self.budget.record_primary()
+        started = threading.Event()
+        primary = self._executor.submit(bind(self._timed), fn, arg, started)
+        deadline = self.deadline()
+        if deadline is None:
+            return self._result(primary, cancel_event)
+
+        # The deadline counts from the start of the request - time spent waiting for a free worker is not a slow request
+        while not started.wait(CANCEL_POLL_SEC):
+            if cancel_event is not None and cancel_event.is_set():
+                primary.cancel()
+                raise JobCancelled("hedged request stopped")
+        done, _ = self._wait({primary}, deadline, cancel_event)
+        if done:
+            return primary.result()
+        if not self._hedge_slots.acquire(blocking=False):
+            with self._lock:
+                self.hedges_busy += 1
+            return self._result(primary, cancel_event)
+        if not self.budget.try_acquire():
+            self._hedge_slots.release()
+            with self._lock:
+                self.budget_denied += 1
+            return self._result(primary, cancel_event)
+
+        hedge = self._hedge_executor.submit(bind(self._timed_hedge), fn, arg)
+        pending = {primary, hedge}
+        result = None
+        try:
+            while pending:
+                done, pending = self._wait(pending, None, cancel_event)
+                for future in done:
+                    result = future.result()
+                    # An error answer only wins if the other request fails as well
+                    if not is_transcription_error(result):
+                        if future is hedge:
+                            with self._lock:
+                                self.hedge_wins += 1
+                        return result
+            return result
+        finally:
+            # A hedge that has not started yet is not needed anymore
+            if hedge.cancel():
+                self._hedge_slots.release()
+
+    def stats(self) -> dict:
+        primaries = self.budget.primaries
+        return {
+            'requests': primaries,
+            'hedged_requests': self.budget.hedges,
+            'extra_request_rate': self.budget.hedges / primaries if primaries else 0.0,
+            'hedge_wins': self.hedge_wins,
+            'budget_denied': self.budget_denied,
+            'hedges_busy': self.hedges_busy,
+            'deadline_sec': self.deadline(),
+            'request_p50_sec': self.request_latencies.percentile(50),
+            'request_p99_sec': self.request_latencies.percentile(99),
+            'job_p99_sec': self.job_latencies.percentile(99),
+            'jobs': len(self.job_latencies),
+        }
+
+# Shared hedger of the OCR requests
+ocr_hedger = Hedger()
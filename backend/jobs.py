@@ -0,0 +1,153 @@
+import os
+import re
+import select
+import socket
+import threading
+import time
+import uuid
+from typing import Optional
+
+from tracing import Trace
+
+# Finished jobs are kept this long (seconds) so clients can still read their final state
+JOB_TTL_SEC = int(os.getenv("JOB_TTL_SEC", "3600"))
+# Client supplied job ids must be short and URL safe
+JOB_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+class JobCancelled(Exception):
+    # Raised inside the pipeline once its job was cancelled
+    pass
+
+class Job:
+
+    # Progress and partial results of one upload, readable while the upload request is still running
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.status = 'running'
+        self.created = time.time()
+        self.updated = self.created
+        self.total_frames = 0
+        self.frames_done = 0
+        self.partial_text = ""
+        # Rough outline of the preview pass, replaced by the result of the full pass
+        self.preview = None
+        self.result = None
+        self.error = None
+        # Set when the client disconnects or the job is aborted - checked cooperatively by every pipeline stage
+        self.cancel_event = threading.Event()
+        self.cancel_reason = None
+        # Timeline of the pipeline stages, frames and API requests of the job
+        self.trace = Trace(job_id)
+
+    def cancel(self, reason: str = 'cancelled by client'):
+        if self.status == 'running' and not self.cancel_event.is_set():
+            self.cancel_reason = reason
+            self.cancel_event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def check_cancelled(self):
+        # Stop the current stage if the job was cancelled
+        if self.cancel_event.is_set():
+            raise JobCancelled(self.cancel_reason)
+
+    def update(self, **fields):
+        for name, value in fields.items():
+            setattr(self, name, value)
+        self.updated = time.time()
+
+    def finish(self, result: dict = None, error: str = None):
+        if self.cancelled:
+            status = 'cancelled'
+        else:
+            status = 'failed' if error else 'done'
+        fields = {'preview': None} if result is not None else {}
+        self.update(status=status, result=result, error=error, **fields)
+
+    def to_dict(self) -> dict:
+        return {
+            'job_id': self.job_id,
+            'status': self.status,
+            'created': self.created,
+            'updated': self.updated,
+            'total_frames': self.total_frames,
+            'frames_done': self.frames_done,
+            'partial_text': self.partial_text,
+            'preview': self.preview,
+            'result': self.result,
+            'error': self.error,
+            'cancel_reason': self.cancel_reason,
+        }
+
+class JobRegistry:
+
+    # In-memory registry of the jobs of this backend process
+
+    def __init__(self, ttl_sec: int = JOB_TTL_SEC):
+        self.ttl_sec = ttl_sec
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def create(self, job_id: str = None) -> Job:
+        # Register a new job, a client supplied id lets the client poll the job while its upload is running
+        if job_id is None:
+            job_id = uuid.uuid4().hex
+        elif not JOB_ID_PATTERN.match(job_id):
+            raise ValueError("Invalid job id")
+        with self._lock:
+            self._prune()
+            existing = self._jobs.get(job_id)
+            if existing is not None and existing.status == 'running':
+                raise ValueError("Job id already in use")
+            job = Job(job_id)
+            self._jobs[job_id] = job
+            return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self) -> list:
+        with self._lock:
+            self._prune()
+            return list(self._jobs.values())
+
+    def _prune(self):
+        # Forget finished jobs older than the TTL (lock must be held)
+        cutoff = time.time() - self.ttl_sec
+        for job_id in [j.job_id for j in self._jobs.values() if j.status != 'running' and j.updated < cutoff]:
+            del self._jobs[job_id]
+
+def client_disconnected(connection: socket.socket) -> bool:
+    # Check without blocking whether the client closed its connection
+    try:
+        readable, _, _ = select.select([connection], [], [], 0)
+        # A readable socket without any data means the client sent FIN
+        return bool(readable) and connection.recv(1, socket.MSG_PEEK) == b''
+    except (OSError, ValueError):
+        return True
+
+def watch_client_disconnect(connection: socket.socket, job: Job, done: threading.Event, interval: float = 1.0) -> threading.Thread:
+
+    # Cancel the job when the client closes its connection before the response is sent
+    # Must be started after the request body was read, otherwise body bytes would look like pending data
+
+    # Args: "connection": Client socket of the request, "job": Job to cancel, "done": Set when the response is ready, "interval": Poll interval in seconds
+
+    # Returns: The started watcher thread
+
+    def watch():
+        while not done.wait(interval):
+            if client_disconnected(connection):
+                job.cancel('client disconnected')
+                return
+
+    thread = threading.Thread(target=watch, daemon=True)
+    thread.start()
+    return thread
+
+# Jobs of this backend process
+jobs = JobRegistry()
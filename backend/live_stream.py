@@ -0,0 +1,378 @@
+import json
+import os
+import queue
+import subprocess
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Callable, Iterator, List, Optional
+from urllib.parse import urlsplit
+
+from PIL import Image, ImageChops, ImageStat
+
+from admission import AdmissionRejected
+from process_frames import transcribe_image, is_transcription_error
+from video_utils import FFMPEG, FRAME_SIZE, check_dependencies, format_timestamp
+
+# Sampling interval of live sources (seconds)
+LIVE_SAMPLE_EVERY_SEC = float(os.getenv("LIVE_SAMPLE_EVERY_SEC", "5"))
+# Mean grayscale difference (0-255) below which a sampled frame counts as a duplicate of the last transcribed one
+LIVE_DEDUP_THRESHOLD = float(os.getenv("LIVE_DEDUP_THRESHOLD", "4"))
+# Frames waiting longer than this before OCR are dropped so the transcript never falls behind the board
+LIVE_MAX_LATENCY_SEC = float(os.getenv("LIVE_MAX_LATENCY_SEC", "20"))
+# Size of the grayscale thumbnails compared for deduplication
+DEDUP_THUMBNAIL_SIZE = (64, 64)
+# Number of recent frame latencies kept for the latency report
+LATENCY_WINDOW = 500
+# Hosts live sources may be read from (comma separated) - live ingestion is disabled while the list is empty
+LIVE_ALLOWED_HOSTS = {host.strip().lower() for host in os.getenv("LIVE_ALLOWED_HOSTS", "").split(",") if host.strip()}
+# URL schemes accepted as live sources, and the ffmpeg protocols their streams may use (HLS segments, TLS, RTP)
+LIVE_SCHEMES = ('rtmp', 'rtmps', 'rtsp', 'http', 'https')
+LIVE_PROTOCOLS = "tcp,udp,rtp,tls,crypto,http,https,httpproxy,rtmp,rtmps,rtsp"
+# Live sessions running at once, and how long a session may run and stay readable after it ended (seconds)
+LIVE_MAX_SESSIONS = int(os.getenv("LIVE_MAX_SESSIONS", "4"))
+LIVE_MAX_SESSION_SEC = float(os.getenv("LIVE_MAX_SESSION_SEC", "14400"))
+LIVE_SESSION_TTL_SEC = int(os.getenv("LIVE_SESSION_TTL_SEC", "3600"))
+# Retry-After of a session refused because all slots are taken (seconds)
+LIVE_RETRY_AFTER_SEC = 60
+# Transcript updates kept per session, older updates are only counted
+LIVE_MAX_UPDATES = int(os.getenv("LIVE_MAX_UPDATES", "1000"))
+# Last ffmpeg error lines kept to explain a failed source
+STDERR_TAIL_LINES = 20
+
+def validate_live_source(source: str) -> str:
+
+    # Accept only stream URLs on an allowed host, so callers cannot make ffmpeg read local files, devices or arbitrary URLs
+
+    # Args: "source": Requested live source
+
+    # Returns: The source
+
+    # Raises: ValueError describing why the source is not accepted
+
+    if not LIVE_ALLOWED_HOSTS:
+        raise ValueError("Live ingestion is disabled, set LIVE_ALLOWED_HOSTS to enable it")
+    parts = urlsplit(source)
+    if parts.scheme.lower() not in LIVE_SCHEMES:
+        raise ValueError(f"Live sources must be {', '.join(LIVE_SCHEMES)} URLs")
+    if (parts.hostname or '').lower() not in LIVE_ALLOWED_HOSTS:
+        raise ValueError("Live source host is not allowed")
+    return source
+
+def iter_stream_frames(source: str, every_sec: float = LIVE_SAMPLE_EVERY_SEC, loop: bool = False,
+                       on_start: Callable = None) -> Iterator[Image.Image]:
+
+    # Read sampled frames from a live source (RTMP/RTSP/HLS URL, or a local file while developing) through ffmpeg as they arrive
+
+    # Args: "source": ffmpeg input, "every_sec": Sampling interval, "loop": Replay a file forever in real time (stands in for a camera),
+    #       "on_start": Called with the ffmpeg process so it can be stopped
+
+    # Returns: Iterator of FRAME_SIZE x FRAME_SIZE RGB images
+
+    # Raises: RuntimeError with the last ffmpeg error lines when ffmpeg fails
+
+    cmd = [FFMPEG, "-hide_banner", "-loglevel", "error"]
+    if "://" in source:
+        # A playlist of a URL source must not point ffmpeg at local files
+        cmd += ["-protocol_whitelist", LIVE_PROTOCOLS]
+    if loop:
+        # Read the file at its native frame rate and restart it at the end
+        cmd += ["-stream_loop", "-1", "-re"]
+    cmd += [
+        "-i", source,
+        "-vf", (
+            f"fps=1/{every_sec},"
+            f"scale={FRAME_SIZE}:{FRAME_SIZE}:force_original_aspect_ratio=decrease,"
+            f"pad={FRAME_SIZE}:{FRAME_SIZE}:(ow-iw)/2:(oh-ih)/2"
+        ),
+        # Raw RGB frames have a fixed size so they can be cut from the pipe without parsing
+        "-f", "rawvideo",
+        "-pix_fmt", "rgb24",
+        "pipe:1"
+    ]
+
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if on_start:
+        on_start(process)
+
+    # Drain stderr in the background so ffmpeg never blocks on a full pipe, its last lines explain a failure
+    stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+    reader = threading.Thread(target=lambda: stderr_tail.extend(
+        line.decode(errors='replace').strip() for line in process.stderr), daemon=True)
+    reader.start()
+
+    frame_bytes = FRAME_SIZE * FRAME_SIZE * 3
+    try:
+        while True:
+            data = process.stdout.read(frame_bytes)
+            if len(data) < frame_bytes:
+                break
+            yield Image.frombytes('RGB', (FRAME_SIZE, FRAME_SIZE), data)
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        reader.join(timeout=1)
+
+    # A negative code means the process was killed because the session was stopped
+    if process.returncode > 0:
+        details = " | ".join(line for line in stderr_tail if line) or "no error output"
+        raise RuntimeError(f"ffmpeg exited with code {process.returncode}: {details}")
+
+def frame_difference(first: Image.Image, second: Image.Image) -> float:
+    # Mean absolute difference of small grayscale thumbnails - cheap enough to run on every sampled frame
+    a = first.convert('L').resize(DEDUP_THUMBNAIL_SIZE)
+    b = second.convert('L').resize(DEDUP_THUMBNAIL_SIZE)
+    return ImageStat.Stat(ImageChops.difference(a, b)).mean[0]
+
+def _percentile(values: List[float], percent: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+class LiveSession:
+
+    # Continuously samples a live source, skips frames that did not change and transcribes the rest
+    # Only the newest pending frame is kept for OCR, so end-to-end latency stays bounded when OCR is slower than the board changes
+    # Every transcript update is pushed to the subscribed clients
+
+    def __init__(self, source: str, loop: bool = False,
+                 every_sec: float = LIVE_SAMPLE_EVERY_SEC, frame_source: Callable[[], Iterator[Image.Image]] = None,
+                 transcribe: Callable = transcribe_image, max_updates: int = LIVE_MAX_UPDATES,
+                 max_duration_sec: float = LIVE_MAX_SESSION_SEC):
+        self.session_id = uuid.uuid4().hex
+        self.source = source
+        self.every_sec = every_sec
+        self.started_at = None
+        self.ended_at = None
+        self.max_duration_sec = max_duration_sec
+        self.transcribe = transcribe
+        # The frame source can be replaced, e.g. with a list of images in tests
+        self.frame_source = frame_source or (lambda: iter_stream_frames(
+            source, every_sec=every_sec, loop=loop, on_start=self._set_process))
+
+        # Most recent transcript updates, every update has a sequence number counting all updates of the session
+        self.updates = deque(maxlen=max_updates)
+        self.updates_published = 0
+        self.latencies = []
+        self.frames_captured = 0
+        self.duplicates_skipped = 0
+        self.frames_dropped = 0
+        self.frames_failed = 0
+        self.error = None
+
+        self._process = None
+        self._pending = queue.Queue(maxsize=1)
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._capture_done = threading.Event()
+        self._threads = []
+        self._ended = False
+
+    def _set_process(self, process):
+        self._process = process
+
+    def start(self):
+        self.started_at = time.time()
+        for target in (self._capture_loop, self._ocr_loop):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        if self._process is not None and self._process.poll() is None:
+            self._process.kill()
+
+    def join(self, timeout: float = None):
+        for thread in self._threads:
+            thread.join(timeout)
+
+    @property
+    def running(self) -> bool:
+        return any(thread.is_alive() for thread in self._threads)
+
+    def _capture_loop(self):
+        last_frame = None
+        try:
+            for frame_index, image in enumerate(self.frame_source()):
+                if self._stop.is_set():
+                    break
+                captured_at = time.time()
+                if captured_at - self.started_at > self.max_duration_sec:
+                    self.error = f"Live session stopped after the maximum duration of {self.max_duration_sec:.0f}s"
+                    break
+                self.frames_captured += 1
+
+                # Skip frames where the board did not change since the last frame sent to OCR
+                if last_frame is not None and frame_difference(last_frame, image) < LIVE_DEDUP_THRESHOLD:
+                    self.duplicates_skipped += 1
+                    continue
+                last_frame = image
+
+                # Keep only the newest frame - an older frame still waiting would only add latency
+                item = (frame_index, image, captured_at)
+                try:
+                    self._pending.put_nowait(item)
+                except queue.Full:
+                    try:
+                        self._pending.get_nowait()
+                        self.frames_dropped += 1
+                    except queue.Empty:
+                        pass
+                    self._pending.put_nowait(item)
+        except Exception as e:
+            self.error = f"Live capture failed: {str(e)}"
+        finally:
+            self._capture_done.set()
+
+    def _ocr_loop(self):
+        while not self._stop.is_set():
+            try:
+                frame_index, image, captured_at = self._pending.get(timeout=0.2)
+            except queue.Empty:
+                if self._capture_done.is_set() and self._pending.empty():
+                    break
+                continue
+
+            if time.time() - captured_at > LIVE_MAX_LATENCY_SEC:
+                self.frames_dropped += 1
+                continue
+
+            text = self.transcribe(image)
+            # Glass-to-text latency: from the frame leaving ffmpeg until its text is ready
+            latency = time.time() - captured_at
+            if is_transcription_error(text):
+                self.frames_failed += 1
+                continue
+
+            update = {
+                'seq': self.updates_published,
+                'timestamp': format_timestamp(frame_index * self.every_sec),
+                'text': text,
+                'latency_sec': round(latency, 3),
+            }
+            self._publish(update, latency)
+
+        self._publish_end()
+
+    def _publish(self, update: dict, latency: float):
+        with self._lock:
+            self.updates.append(update)
+            self.updates_published += 1
+            self.latencies.append(latency)
+            del self.latencies[:-LATENCY_WINDOW]
+            for subscriber in self._subscribers:
+                subscriber.put(update)
+
+    def _publish_end(self):
+        with self._lock:
+            self._ended = True
+            self.ended_at = time.time()
+            for subscriber in self._subscribers:
+                subscriber.put(None)
+            self._subscribers = []
+
+    def subscribe(self) -> queue.Queue:
+        # Queue receiving the kept past updates and every future update, followed by None when the session ends
+        subscriber = queue.Queue()
+        with self._lock:
+            for update in self.updates:
+                subscriber.put(update)
+            if self._ended:
+                subscriber.put(None)
+            else:
+                self._subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: queue.Queue):
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+
+    def latency_report(self) -> dict:
+        with self._lock:
+            latencies = list(self.latencies)
+        return {
+            'samples': len(latencies),
+            'p50_sec': _percentile(latencies, 50),
+            'p95_sec': _percentile(latencies, 95),
+            'max_sec': max(latencies) if latencies else None,
+        }
+
+    def status(self) -> dict:
+        return {
+            'session_id': self.session_id,
+            'source': self.source,
+            'running': self.running,
+            'error': self.error,
+            'frames_captured': self.frames_captured,
+            'duplicates_skipped': self.duplicates_skipped,
+            'frames_dropped': self.frames_dropped,
+            'frames_failed': self.frames_failed,
+            'updates': self.updates_published,
+            'latency': self.latency_report(),
+        }
+
+def sse_events(session: LiveSession, keepalive_sec: float = 15.0) -> Iterator[str]:
+    # Server-sent events stream of the transcript updates of a session
+    subscriber = session.subscribe()
+    try:
+        while True:
+            try:
+                update = subscriber.get(timeout=keepalive_sec)
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            if update is None:
+                yield f"event: end\ndata: {json.dumps(session.status())}\n\n"
+                return
+            yield f"data: {json.dumps(update)}\n\n"
+    finally:
+        session.unsubscribe(subscriber)
+
+class LiveSessionRegistry:
+
+    # Live sessions of this backend process - a bounded number runs at once, ended sessions are forgotten after a TTL
+
+    def __init__(self, max_running: int = LIVE_MAX_SESSIONS, ttl_sec: int = LIVE_SESSION_TTL_SEC):
+        self.max_running = max_running
+        self.ttl_sec = ttl_sec
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def add(self, session: LiveSession):
+        # Register a session that is about to start, AdmissionRejected (503) when too many sessions are running
+        with self._lock:
+            self._prune()
+            if sum(1 for s in self._sessions.values() if s.ended_at is None) >= self.max_running:
+                raise AdmissionRejected(503, f"Too many live sessions running (limit {self.max_running})", LIVE_RETRY_AFTER_SEC)
+            self._sessions[session.session_id] = session
+
+    def get(self, session_id: str) -> Optional[LiveSession]:
+        with self._lock:
+            self._prune()
+            return self._sessions.get(session_id)
+
+    def _prune(self):
+        # Forget ended sessions older than the TTL (lock must be held)
+        cutoff = time.time() - self.ttl_sec
+        for session_id in [s.session_id for s in self._sessions.values() if s.ended_at is not None and s.ended_at < cutoff]:
+            del self._sessions[session_id]
+
+# Live sessions by id
+live_sessions = LiveSessionRegistry()
+
+def start_live_session(source: str) -> LiveSession:
+    # Start ingesting an allowed live source and register the session
+    # Raises ValueError for a rejected source, AdmissionRejected when every session slot is taken
+    validate_live_source(source)
+    check_dependencies()
+    session = LiveSession(source)
+    live_sessions.add(session)
+    session.start()
+    return session
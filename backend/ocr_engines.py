@@ -0,0 +1,325 @@
+import os
+import shutil
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Dict, List
+
+from PIL import Image, ImageOps
+
+import process_frames
+from process_frames import OCRFailure, is_transcription_error, frame_complexity, choose_route, is_low_confidence
+
+# Which engines transcribe_image uses:
+#   "remote"       - NVIDIA API only (default)
+#   "local"        - local CPU engine only, works offline
+#   "local-first"  - local engine, falling back to the NVIDIA API when it fails or finds almost no text
+#   "remote-first" - NVIDIA API, falling back to the local engine when the API fails (e.g. network down)
+#   "routed"       - simple frames (little ink, few edges) go to the fast engine first and are escalated to the
+#                    NVIDIA API model on an unusable or low-confidence result, complex frames go to the NVIDIA API model
+OCR_POLICY = os.getenv("OCR_POLICY", "remote")
+OCR_POLICIES = ('remote', 'local', 'local-first', 'remote-first', 'routed')
+# Fast engine of the routed policy: "fast-model" (FAST_MODEL_NAME on the NVIDIA API) or "local" (Tesseract)
+ROUTE_SIMPLE_ENGINE = os.getenv("ROUTE_SIMPLE_ENGINE", "fast-model")
+# Local results shorter than this are treated as empty in the local-first policy
+LOCAL_OCR_MIN_CHARS = int(os.getenv("LOCAL_OCR_MIN_CHARS", "3"))
+# Tesseract page segmentation mode 6 - a single uniform block of text, the usual whiteboard layout
+TESSERACT_CONFIG = os.getenv("TESSERACT_CONFIG", "--psm 6")
+
+def _load_image(image_input) -> Image.Image:
+    # Accept the same inputs as prepare_image: a PIL image, a path or a file object
+    if isinstance(image_input, Image.Image):
+        return image_input
+    return Image.open(image_input)
+
+class OCRText(str):
+
+    # Text returned by the router, remembering the engine that produced it
+    # A fallback text (remote-first answered by the local engine) is a degraded result that must not be stored
+    # in place of the configured model's text
+
+    def __new__(cls, text: str, engine: str, fallback: bool = False):
+        tagged = super().__new__(cls, text)
+        tagged.engine = engine
+        tagged.fallback = fallback
+        return tagged
+
+def is_fallback_text(text: str) -> bool:
+    return getattr(text, 'fallback', False)
+
+class OCREngine(ABC):
+
+    # Interface of an OCR backend - transcribe returns the text or an error message, like transcribe_image
+
+    name = "base"
+    local = False
+
+    def available(self) -> bool:
+        return True
+
+    @abstractmethod
+    def transcribe(self, image_input) -> str:
+        pass
+
+class NvidiaEngine(OCREngine):
+
+    # Remote engine using the NVIDIA API
+
+    name = "nvidia"
+
+    def __init__(self, model: str = None, name: str = None, cost: float = 1.0):
+        self.model = model
+        self.name = name or self.name
+        # Cost of one request relative to a MODEL_NAME request
+        self.cost = cost
+
+    def available(self) -> bool:
+        return bool(process_frames.NVIDIA_API_KEY)
+
+    def transcribe(self, image_input) -> str:
+        if self.model is None:
+            return process_frames.transcribe_image_remote(image_input)
+        return process_frames.transcribe_image_remote(image_input, model=self.model)
+
+class TesseractEngine(OCREngine):
+
+    # CPU-only local engine using Tesseract (needs the pytesseract package and the tesseract binary)
+
+    name = "tesseract"
+    local = True
+
+    def __init__(self):
+        self._available = None
+
+    def available(self) -> bool:
+        # Probe once, the result does not change while the server runs
+        if self._available is None:
+            try:
+                import pytesseract  # noqa: F401
+                self._available = shutil.which("tesseract") is not None
+            except ImportError:
+                self._available = False
+        return self._available
+
+    def transcribe(self, image_input) -> str:
+        try:
+            import pytesseract
+            img = _load_image(image_input)
+            if img.width > process_frames.MAX_IMAGE_SIZE[0] * 2 or img.height > process_frames.MAX_IMAGE_SIZE[1] * 2:
+                img = img.copy()
+                img.thumbnail((process_frames.MAX_IMAGE_SIZE[0] * 2, process_frames.MAX_IMAGE_SIZE[1] * 2), Image.LANCZOS)
+            # Grayscale with stretched contrast reads markers on a whiteboard much better
+            img = ImageOps.autocontrast(img.convert('L'))
+            return pytesseract.image_to_string(img, config=TESSERACT_CONFIG).strip()
+        except Exception as e:
+            return OCRFailure(f"Failed to process image: {str(e)}")
+
+class OCRRouter:
+
+    # Routes every transcription through the engines in the order given by the policy
+    # and keeps per-engine call, failure and latency counters
+    # The routed policy additionally keeps per-route counters with the relative cost of the requests
+
+    def __init__(self, engines: Dict[str, OCREngine], policy: str = OCR_POLICY, fast_engine: OCREngine = None):
+        if policy not in OCR_POLICIES:
+            raise ValueError(f"Invalid OCR policy: {policy}")
+        self.engines = engines
+        self.policy = policy
+        # Only used by the simple route of the routed policy
+        self.fast_engine = fast_engine
+        self._lock = threading.Lock()
+        named = {**engines, **({fast_engine.name: fast_engine} if fast_engine is not None else {})}
+        self._stats = {name: {'calls': 0, 'failures': 0, 'fallbacks': 0, 'total_sec': 0.0} for name in named}
+        self._routes = {route: {'frames': 0, 'escalations': 0, 'total_sec': 0.0, 'cost': 0.0} for route in ('simple', 'complex')}
+
+    def engine_order(self) -> List[OCREngine]:
+        remote = [e for e in self.engines.values() if not e.local]
+        local = [e for e in self.engines.values() if e.local]
+        return {
+            'remote': remote,
+            'local': local,
+            'local-first': local + remote,
+            'remote-first': remote + local,
+            'routed': remote,
+        }[self.policy]
+
+    def route_order(self, route: str) -> List[OCREngine]:
+        # Engines of a route of the routed policy - the simple route escalates to the complex one
+        complex_route = [e for e in self.engines.values() if not e.local]
+        if route == 'complex':
+            return complex_route
+        if ROUTE_SIMPLE_ENGINE == 'local':
+            return [e for e in self.engines.values() if e.local] + complex_route
+        return ([self.fast_engine] if self.fast_engine is not None else []) + complex_route
+
+    def usable(self, engine: OCREngine, text: str) -> bool:
+        if is_transcription_error(text):
+            return False
+        # A local engine finding almost nothing is worth a second opinion from the remote model
+        if engine.local and self.policy == 'local-first' and len(text.strip()) < LOCAL_OCR_MIN_CHARS:
+            return False
+        return True
+
+    def transcribe(self, image_input) -> str:
+        # Transcribe with the first engine that gives a usable result, otherwise return the last error
+        if self.policy == 'routed':
+            return self.transcribe_routed(image_input)
+        order = [engine for engine in self.engine_order() if engine.available()]
+        if not order:
+            # Keep the behavior of the plain remote call when nothing is configured
+            if self.policy == 'remote':
+                return process_frames.transcribe_image_remote(image_input)
+            return OCRFailure("Failed to process image: no OCR engine available")
+
+        text = ""
+        for position, engine in enumerate(order):
+            start = time.perf_counter()
+            text = engine.transcribe(image_input)
+            elapsed = time.perf_counter() - start
+            ok = self.usable(engine, text)
+            with self._lock:
+                stats = self._stats[engine.name]
+                stats['calls'] += 1
+                stats['total_sec'] += elapsed
+                if not ok:
+                    stats['failures'] += 1
+                if position > 0:
+                    stats['fallbacks'] += 1
+            if ok:
+                break
+        if is_transcription_error(text):
+            return text
+        # Only remote-first falls back to a weaker engine, the other policies fall back or escalate to the remote model
+        return OCRText(text, engine.name, fallback=self.policy == 'remote-first' and engine.local)
+
+    def transcribe_routed(self, image_input) -> str:
+
+        # Send the frame to the cheapest engine its complexity allows, escalating on an unusable or low-confidence result
+
+        # Args: image_input: PIL image, path or file object
+
+        # Returns: Transcribed text or the error of the last engine
+
+        try:
+            complexity = frame_complexity(_load_image(image_input))
+        except Exception as e:
+            return OCRFailure(f"Failed to process image: {str(e)}")
+        route = choose_route(complexity)
+        order = [engine for engine in self.route_order(route) if engine.available()]
+        if not order:
+            return process_frames.transcribe_image_remote(image_input)
+
+        text = ""
+        start = time.perf_counter()
+        cost = 0.0
+        for position, engine in enumerate(order):
+            engine_start = time.perf_counter()
+            text = engine.transcribe(image_input)
+            elapsed = time.perf_counter() - engine_start
+            cost += 0.0 if engine.local else getattr(engine, 'cost', 1.0)
+            last = position == len(order) - 1
+            ok = self.usable(engine, text) and (last or not is_low_confidence(text, complexity))
+            with self._lock:
+                stats = self._stats[engine.name]
+                stats['calls'] += 1
+                stats['total_sec'] += elapsed
+                if not ok:
+                    stats['failures'] += 1
+                if position > 0:
+                    stats['fallbacks'] += 1
+            if ok:
+                break
+        with self._lock:
+            route_stats = self._routes[route]
+            route_stats['frames'] += 1
+            route_stats['escalations'] += position
+            route_stats['total_sec'] += time.perf_counter() - start
+            route_stats['cost'] += cost
+        return text if is_transcription_error(text) else OCRText(text, engine.name)
+
+    def stats(self) -> dict:
+        with self._lock:
+            engines = {**self.engines, **({self.fast_engine.name: self.fast_engine} if self.fast_engine is not None else {})}
+            return {
+                'policy': self.policy,
+                'engines': {
+                    name: {**stats, 'available': engines[name].available(),
+                           'avg_latency_sec': stats['total_sec'] / stats['calls'] if stats['calls'] else None}
+                    for name, stats in self._stats.items()
+                },
+                # Cost is counted in MODEL_NAME requests, local engines are free
+                'routes': {
+                    route: {**stats, 'avg_latency_sec': stats['total_sec'] / stats['frames'] if stats['frames'] else None,
+                            'avg_cost': stats['cost'] / stats['frames'] if stats['frames'] else None}
+                    for route, stats in self._routes.items()
+                },
+            }
+
+def benchmark_engines(images: list, engines: Dict[str, OCREngine] = None, repeat: int = 1) -> dict:
+
+    # Compare throughput and latency of OCR engines on the same images
+
+    # Args: "images": PIL images or image paths, "engines": Engines to compare (every available engine if None), "repeat": Passes over the images
+
+    # Returns: Dict of engine name to {frames, failures, total_sec, avg_latency_sec, p95_latency_sec, frames_per_sec}
+
+    if engines is None:
+        engines = {name: engine for name, engine in default_engines().items() if engine.available()}
+
+    report = {}
+    for name, engine in engines.items():
+        latencies = []
+        failures = 0
+        for _ in range(repeat):
+            for image in images:
+                start = time.perf_counter()
+                text = engine.transcribe(image)
+                latencies.append(time.perf_counter() - start)
+                if is_transcription_error(text):
+                    failures += 1
+        total = sum(latencies)
+        ordered = sorted(latencies)
+        report[name] = {
+            'frames': len(latencies),
+            'failures': failures,
+            'total_sec': round(total, 4),
+            'avg_latency_sec': round(total / len(latencies), 4) if latencies else None,
+            'p95_latency_sec': round(ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))], 4) if ordered else None,
+            'frames_per_sec': round(len(latencies) / total, 2) if total > 0 else None,
+        }
+    return report
+
+def default_engines() -> Dict[str, OCREngine]:
+    return {'nvidia': NvidiaEngine(), 'tesseract': TesseractEngine()}
+
+# Router used by transcribe_image
+ocr_router = OCRRouter(default_engines(), OCR_POLICY,
+                       fast_engine=NvidiaEngine(process_frames.FAST_MODEL_NAME, 'nvidia-fast', process_frames.FAST_MODEL_COST))
+
+def ocr_settings() -> dict:
+    # Settings that decide which engine transcribes a frame - part of the OCR stage key and of the result cache key
+    settings = {'policy': ocr_router.policy}
+    if ocr_router.policy != 'remote':
+        settings['tesseract_config'] = TESSERACT_CONFIG
+    if ocr_router.policy == 'local-first':
+        settings['local_min_chars'] = LOCAL_OCR_MIN_CHARS
+    if ocr_router.policy == 'routed':
+        # The route thresholds decide which frames the fast engine answers
+        settings['routing'] = {
+            'simple_engine': ROUTE_SIMPLE_ENGINE,
+            'fast_model': process_frames.FAST_MODEL_NAME,
+            'simple_max_ink': process_frames.ROUTE_SIMPLE_MAX_INK,
+            'simple_max_edges': process_frames.ROUTE_SIMPLE_MAX_EDGES,
+            'min_chars_per_ink': process_frames.ROUTE_MIN_CHARS_PER_INK,
+        }
+    return settings
+
+if __name__ == '__main__':
+    # Benchmark every available engine: python ocr_engines.py [image ...] (defaults to the images in uploads/)
+    paths = [Path(p) for p in sys.argv[1:]] or sorted(
+        p for p in (Path(__file__).parent / "uploads").iterdir() if p.suffix.lower() in ('.jpg', '.jpeg', '.png'))
+    for engine_name, result in benchmark_engines(paths).items():
+        print(f"{engine_name:>10}: {result['frames']} frames, {result['failures']} failed, "
+              f"avg {result['avg_latency_sec']}s, p95 {result['p95_latency_sec']}s, {result['frames_per_sec']} frames/s")
@@ -3,11 +3,17 @@ import io
 import json
 import requests
 import os
-from PIL import Image
+import threading
+import time
+from collections import Counter
+from PIL import Image, ImageFilter, ImageStat
 from typing import Union
 from pathlib import Path
 from dotenv import load_dotenv
 
+from tracing import span
+from frame_quality import SCORE_SIZE, FOREGROUND_DELTA, EDGE_THRESHOLD
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -20,6 +26,223 @@ API_URL = "https://integrate.api.nvidia.com/v1/chat/completions"
 # Load NVIDIA API key from environment variable or use fallback
 NVIDIA_API_KEY = os.getenv("NVIDIA_API_KEY")
 MODEL_NAME = 'meta/llama-4-scout-17b-16e-instruct'
+# Faster and cheaper model for simple frames (OCR_POLICY=routed), and its cost per request relative to MODEL_NAME
+FAST_MODEL_NAME = os.getenv("OCR_FAST_MODEL", "meta/llama-3.2-11b-vision-instruct")
+FAST_MODEL_COST = float(os.getenv("OCR_FAST_MODEL_COST", "0.25"))
+# Frames with at most this ink density and edge density are simple enough for the fast route
+ROUTE_SIMPLE_MAX_INK = float(os.getenv("ROUTE_SIMPLE_MAX_INK", "0.03"))
+ROUTE_SIMPLE_MAX_EDGES = float(os.getenv("ROUTE_SIMPLE_MAX_EDGES", "0.05"))
+# A fast route result shorter than ink density x this many characters is low confidence and escalated to MODEL_NAME
+ROUTE_MIN_CHARS_PER_INK = float(os.getenv("ROUTE_MIN_CHARS_PER_INK", "1000"))
+# The prompt for the API model - the image is appended to it
+OCR_PROMPT = 'Transcribe the handwritten text in this image exactly as written. Only output the text content and nothing else.'
+
+# Longest OCR completion requested from the API (tokens)
+OCR_MAX_TOKENS = 512
+# Stream OCR completions and close them early when the model loops or writes past OCR_MAX_OUTPUT_CHARS
+OCR_STREAMING = os.getenv("OCR_STREAMING", "false").lower() == "true"
+# A safety net above what OCR_MAX_TOKENS allows (a token is rarely longer than 8 characters), full answers are never cut
+OCR_MAX_OUTPUT_CHARS = int(os.getenv("OCR_MAX_OUTPUT_CHARS", str(OCR_MAX_TOKENS * 8)))
+# A block of lines (or a short phrase within a line) repeated this many times in a row is a repetition loop
+# Boards legitimately repeat a line a few times (matrix rows, tables), a loop runs far longer
+OCR_REPEAT_LIMIT = int(os.getenv("OCR_REPEAT_LIMIT", "8"))
+# Longest repeated block checked, in lines and in characters
+REPEAT_MAX_LINES = 4
+REPEAT_MAX_CHARS = 40
+# Shortest run of a phrase looping inside a line, so numbers like 1000000 are not taken for a loop
+REPEAT_MIN_RUN_CHARS = 24
+
+# Connections kept open to the API - one per parallel OCR worker is enough
+API_POOL_SIZE = int(os.getenv("API_POOL_SIZE", "32"))
+
+# Shared session so every frame reuses an open TLS connection instead of doing a new handshake
+api_session = requests.Session()
+api_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=API_POOL_SIZE))
+
+# Prefixes of the error messages of engines that return plain strings
+ERROR_PREFIXES = ('API request failed', 'Failed to process', 'Error processing')
+
+class OCRFailure(str):
+
+    # Error message returned in place of the text of a frame that could not be transcribed
+    # The type is the status, so messages like "No transcription result." are never taken for board text
+
+    pass
+
+def is_transcription_error(text: str) -> bool:
+    # Check if a transcription result is an error message instead of board text
+    return not text or isinstance(text, OCRFailure) or text.startswith(ERROR_PREFIXES)
+
+class FrameResult:
+
+    # Outcome of the OCR of one frame - the error text of transcribe_image is classified once, here
+    # Slots keep the record small, a long lecture holds thousands of them
+
+    __slots__ = ('frame_number', 'timestamp', 'status', 'text', 'error', 'latency', 'retries')
+
+    def __init__(self, frame_number: int, timestamp: str, status: str, text: str = "", error: str = None,
+                 latency: float = 0.0, retries: int = 0):
+        self.frame_number = frame_number
+        self.timestamp = timestamp
+        self.status = status  # "ok" or "failed"
+        self.text = text
+        self.error = error
+        self.latency = latency
+        self.retries = retries
+
+    @classmethod
+    def from_text(cls, frame_number: int, timestamp: str, text: str, latency: float = 0.0, retries: int = 0) -> 'FrameResult':
+        # Build the record from the return value of transcribe_image
+        if is_transcription_error(text):
+            return cls(frame_number, timestamp, 'failed', error=text or "Empty transcription", latency=latency, retries=retries)
+        return cls(frame_number, timestamp, 'ok', text=text, latency=latency, retries=retries)
+
+    @property
+    def ok(self) -> bool:
+        return self.status == 'ok'
+
+    @property
+    def output(self) -> str:
+        # The text for callers that expect the plain transcribe_image result
+        return self.text if self.ok else self.error
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self) -> str:
+        return f"FrameResult({self.frame_number}, {self.timestamp!r}, {self.status!r}, retries={self.retries})"
+
+def frame_complexity(image: Image.Image) -> dict:
+
+    # Measure how much writing a frame holds, on the same small grayscale copy as the quality scores
+
+    # Args: image: The frame
+
+    # Returns: Dict with ink (share of pixels that differ from the board) and edges (share of edge pixels)
+
+    gray = image.convert('L')
+    gray.thumbnail(SCORE_SIZE)
+    background = ImageStat.Stat(gray).median[0]
+    ink = ImageStat.Stat(gray.point(lambda v: 255 if abs(v - background) > FOREGROUND_DELTA else 0)).mean[0] / 255
+    inner = (1, 1, gray.width - 1, gray.height - 1)
+    edges = gray.filter(ImageFilter.FIND_EDGES).crop(inner).point(lambda v: 255 if v > EDGE_THRESHOLD else 0)
+    return {'ink': ink, 'edges': ImageStat.Stat(edges).mean[0] / 255}
+
+def choose_route(complexity: dict) -> str:
+    # "simple" frames go to the fast model first, "complex" frames straight to MODEL_NAME
+    if complexity['ink'] <= ROUTE_SIMPLE_MAX_INK and complexity['edges'] <= ROUTE_SIMPLE_MAX_EDGES:
+        return 'simple'
+    return 'complex'
+
+def is_low_confidence(text: str, complexity: dict) -> bool:
+    # A short answer for a frame with a lot of ink usually means the fast model missed most of the writing
+    return len(text.strip()) < complexity['ink'] * ROUTE_MIN_CHARS_PER_INK
+
+def warm_up_connection(timeout: float = 5.0) -> bool:
+    # Open a pooled connection to the API before the first frame needs it, any HTTP answer means the connection is up
+    try:
+        api_session.head(API_URL, timeout=timeout)
+        return True
+    except requests.exceptions.RequestException:
+        return False
+
+def streaming_settings() -> dict:
+    # Settings that change the text of a streamed transcription - part of the OCR cache keys, empty when streaming is off
+    if not OCR_STREAMING:
+        return {}
+    return {'repeat_limit': OCR_REPEAT_LIMIT, 'max_output_chars': OCR_MAX_OUTPUT_CHARS}
+
+def find_repetition(text: str, repeats: int = OCR_REPEAT_LIMIT) -> int:
+
+    # Detect a repetition loop at the end of a partial OCR output
+
+    # Args: "text": Output received so far, "repeats": Number of back to back copies that count as a loop
+
+    # Returns: Length of the text to keep (the detected run of copies reduced to its first copy), or -1 if the output does not loop
+
+    # Whole lines: the last complete lines are one block of up to REPEAT_MAX_LINES lines repeated
+    complete = text[:text.rfind("\n") + 1]
+    lines = complete.split("\n")[:-1]
+    for size in range(1, REPEAT_MAX_LINES + 1):
+        if len(lines) < size * repeats:
+            break
+        block = lines[-size:]
+        if any(line.strip() for line in block) and all(lines[-size * (i + 1):len(lines) - size * i] == block
+                                                       for i in range(1, repeats)):
+            kept = lines[:len(lines) - size * (repeats - 1)]
+            return len("\n".join(kept)) + 1
+    # A short phrase looping inside one line, e.g. "= 0 = 0 = 0 ..."
+    for size in range(1, REPEAT_MAX_CHARS + 1):
+        copies = max(repeats, -(-REPEAT_MIN_RUN_CHARS // size))
+        if len(text) < size * copies:
+            break
+        unit = text[-size:]
+        if unit.strip() and text.endswith(unit * copies):
+            return len(text) - size * (copies - 1)
+    return -1
+
+class StreamStats:
+
+    # Counters of the streamed OCR completions - time to first token, total latency and the tokens saved by early cutoffs
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = Counter()
+        self.first_token_sec = 0.0
+        self.total_sec = 0.0
+
+    def record(self, tokens: int, first_token: float, total: float, cutoff: str = None):
+        with self._lock:
+            self.counters['frames'] += 1
+            self.counters['tokens_received'] += tokens
+            if cutoff is not None:
+                self.counters[f'cut_{cutoff}'] += 1
+                self.counters['tokens_saved'] += max(0, OCR_MAX_TOKENS - tokens)
+            self.first_token_sec += first_token
+            self.total_sec += total
+
+    def stats(self) -> dict:
+        with self._lock:
+            frames = self.counters['frames']
+            return {
+                'enabled': OCR_STREAMING,
+                'frames': frames,
+                'avg_first_token_sec': round(self.first_token_sec / frames, 3) if frames else None,
+                'avg_latency_sec': round(self.total_sec / frames, 3) if frames else None,
+                **{name: self.counters[name] for name in ('tokens_received', 'tokens_saved', 'cut_repetition', 'cut_length')},
+            }
+
+# Streaming statistics of this backend
+stream_stats = StreamStats()
+
+def read_ocr_stream(lines, max_chars: int = OCR_MAX_OUTPUT_CHARS) -> tuple[str, int, str]:
+
+    # Collect the text of a streamed (server-sent events) completion, stopping at a repetition loop or the length budget
+
+    # Args: "lines": Decoded SSE lines of the response, "max_chars": Longest output kept
+
+    # Returns: Tuple of (text, tokens received, cutoff reason "repetition"/"length" or None when the stream ended normally)
+
+    text = ""
+    tokens = 0
+    for line in lines:
+        if not line or not line.startswith("data:"):
+            continue
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            break
+        choices = json.loads(data).get("choices") or [{}]
+        delta = (choices[0].get("delta") or {}).get("content") or ""
+        if not delta:
+            continue
+        tokens += 1
+        text += delta
+        keep = find_repetition(text)
+        if keep != -1:
+            return text[:keep].rstrip(), tokens, 'repetition'
+        if len(text) > max_chars:
+            return text[:max_chars], tokens, 'length'
+    return text, tokens, None
 
 def prepare_image(image_input) -> tuple[bool, Union[str, bytes]]:
     
@@ -69,16 +292,29 @@ def prepare_image(image_input) -> tuple[bool, Union[str, bytes]]:
 
 def transcribe_image(image_input) -> str:
     
-    # Transcribe handwritten text from an image using NVIDIA's API
+    # Transcribe handwritten text from an image with the OCR engines selected by OCR_POLICY
+    # (the NVIDIA API by default, see ocr_engines.py for the local engine and the fallback policies)
     
     # Args: "image_input": PIL Image object - the image itself, or path to the image file
         
     # Returns: Transcribed text or error message
     
+    from ocr_engines import ocr_router
+    return ocr_router.transcribe(image_input)
+
+def transcribe_image_remote(image_input, model: str = None) -> str:
+    
+    # Transcribe handwritten text from an image using NVIDIA's API
+    
+    # Args: "image_input": PIL Image object - the image itself, or path to the image file, "model": Vision model (MODEL_NAME if None)
+        
+    # Returns: Transcribed text or an OCRFailure error message
+    
     # Prepare image
-    success, result = prepare_image(image_input)
+    with span('encode', 'ocr'):
+        success, result = prepare_image(image_input)
     if not success:
-        return result
+        return OCRFailure(result)
     
     # Prepare API request
     headers = {
@@ -87,35 +323,81 @@ def transcribe_image(image_input) -> str:
     }
     
     payload = {
-        "model": MODEL_NAME,
+        "model": model or MODEL_NAME,
         "messages": [
             {
                 "role": "user",
                 # The prompt for the API model
-                "content": f'Transcribe the handwritten text in this image exactly as written. Only output the text content and nothing else. <img src="data:image/jpeg;base64,{result}" />'
+                "content": f'{OCR_PROMPT} <img src="data:image/jpeg;base64,{result}" />'
             }
         ],
-        "max_tokens": 512, # Sets the maximum number of tokens (words/word pieces) the model can generate in its response
+        "max_tokens": OCR_MAX_TOKENS, # Sets the maximum number of tokens (words/word pieces) the model can generate in its response
         "temperature": 0.2, # Controls randomness in the model's output - low for accurate results
         "top_p": 1.00, # Nucleus Sampling controls diversity of the output - 1.00 for accurate results for full transcription
-        "stream": False # Streaming is not needed
+        "stream": OCR_STREAMING # Streamed completions can be closed as soon as the output runs away
     }
+
+    if OCR_STREAMING:
+        headers["Accept"] = "text/event-stream"
+        return transcribe_streamed(headers, payload)
     
     try:
         # Send the request to the API
-        response = requests.post(API_URL, headers=headers, json=payload)
-        response.raise_for_status()
+        with span('request', 'ocr', model=payload["model"]):
+            response = api_session.post(API_URL, headers=headers, json=payload)
+            response.raise_for_status()
+            result = response.json()
         
-        result = response.json()
         if "choices" in result and len(result["choices"]) > 0:
             return result["choices"][0]["message"]["content"]
         
         # If no transcription result then return an error message
-        return "No transcription result."
+        return OCRFailure("No transcription result.")
         
     except requests.exceptions.RequestException as e:
-        return f"API request failed: {str(e)}"
+        return OCRFailure(f"API request failed: {str(e)}")
+    except json.JSONDecodeError:
+        return OCRFailure("Invalid response from API")
+    except Exception as e:
+        return OCRFailure(f"Unexpected error: {str(e)}")
+
+def transcribe_streamed(headers: dict, payload: dict) -> str:
+
+    # Send a streaming OCR request and read the completion as it arrives
+    # Closing the response early stops the generation, so a looping model costs only the tokens until the loop is seen
+
+    # Args: "headers": Request headers, "payload": Request body with "stream" set
+
+    # Returns: Transcribed text or an OCRFailure error message
+
+    start = time.perf_counter()
+    first_token = None
+    response = None
+
+    def timed_lines():
+        nonlocal first_token
+        for line in response.iter_lines(decode_unicode=True):
+            if first_token is None and line:
+                first_token = time.perf_counter() - start
+            yield line
+
+    try:
+        with span('request', 'ocr', model=payload["model"], stream=True):
+            response = api_session.post(API_URL, headers=headers, json=payload, stream=True)
+            response.raise_for_status()
+            text, tokens, cutoff = read_ocr_stream(timed_lines())
+        total = time.perf_counter() - start
+        stream_stats.record(tokens, first_token or total, total, cutoff)
+        if cutoff is not None:
+            print(f"OCR stream closed early ({cutoff}) after {tokens} tokens")
+        return text if tokens else OCRFailure("No transcription result.")
+
+    except requests.exceptions.RequestException as e:
+        return OCRFailure(f"API request failed: {str(e)}")
     except json.JSONDecodeError:
-        return "Invalid response from API"
+        return OCRFailure("Invalid response from API")
     except Exception as e:
-        return f"Unexpected error: {str(e)}"
+        return OCRFailure(f"Unexpected error: {str(e)}")
+    finally:
+        if response is not None:
+            response.close()
@@ -1,38 +1,41 @@
+import math
 import os
+import threading
 import time
+from collections import Counter
+from functools import partial
 from typing import List, Tuple
-from google import genai
-from google.genai import types
 from dotenv import load_dotenv
 
+from consolidate import reduce_frames, normalize_line
+from tracing import span
+
 # Load Gemini API key from environment variable or use fallback
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+# Gemini model used for refining the OCR output
+GEMINI_MODEL = "gemini-2.0-flash"
+# Rolling refinement: number of new frames per request and size of the previous notes tail sent as context
+ROLLING_BATCH_FRAMES = int(os.getenv("ROLLING_BATCH_FRAMES", "4"))
+ROLLING_CONTEXT_CHARS = int(os.getenv("ROLLING_CONTEXT_CHARS", "2000"))
+# Prompt budget of one Gemini request in estimated tokens - longer lectures are split into windows that each fit it
+GEMINI_PROMPT_BUDGET_TOKENS = int(os.getenv("GEMINI_PROMPT_BUDGET_TOKENS", "60000"))
+# Longest OCR text kept per frame in estimated tokens, longer texts are cut (usually repeated OCR output)
+GEMINI_FRAME_MAX_TOKENS = int(os.getenv("GEMINI_FRAME_MAX_TOKENS", "1500"))
+# Frames repeated at the start of the next window, so content written across a window boundary is seen whole
+GEMINI_WINDOW_OVERLAP_FRAMES = int(os.getenv("GEMINI_WINDOW_OVERLAP_FRAMES", "1"))
+# Strip every frame down to the lines it adds to the earlier frames before sending them to Gemini (consolidate.py)
+GEMINI_PRE_REDUCE = os.getenv("GEMINI_PRE_REDUCE", "false").lower() == "true"
+# Lifetime of the cached instructions on the Gemini side (seconds), refreshed when less than GEMINI_CACHE_REFRESH_SEC is left
+GEMINI_CACHE_TTL_SEC = int(os.getenv("GEMINI_CACHE_TTL_SEC", "3600"))
+GEMINI_CACHE_REFRESH_SEC = 300
+# Average characters per token of mixed English and LaTeX text
+CHARS_PER_TOKEN = 4
+# Version of the refinement prompt assembly - the instruction texts are hashed into the cache keys, bump this when the
+# way prompts are built from them changes
+PROMPT_VERSION = 2
 
-def process_frames_with_gemini(frame_data: List[Tuple[str, str]]) -> str:
-    # Process a list of OCR texts with timestamps from video frames using Gemini API
-    
-    # Args: "frame_data": List of (OCR_text, timestamp_str) tuples from individual frames that are ordered chronologically
-        
-    # Returns: Processed and cleaned transcription from Gemini giving the final result with timestamps
-    
-    if not GEMINI_API_KEY:
-        raise ValueError("GEMINI_API_KEY environment variable is not set")
-    
-    if not frame_data:
-        return "No frame data provided for processing"
-    
-    # Combine all frame texts with timestamps and frame markers for context
-    combined_text = ""
-    for i, (text, timestamp) in enumerate(frame_data, 1):
-        if text.strip():  # Only include non-empty texts
-            combined_text += f"Frame {i} [Timestamp: {timestamp}]:\n{text}\n\n==================================================\n\n"
-    
-    if not combined_text.strip():
-        return "No valid text content found in frames"
-    
-    # Define the AI prompt for processing the OCR results with timestamp preservation
-    ai_prompt = (
-        """**Role:** You are an expert AI assistant specializing in processing and refining OCR (Optical Character Recognition) output from whiteboard lectures. These lectures are captured frame by frame, and the content is mathematical, including formulas, definitions, and explanations.
+# Instructions for refining the OCR results with timestamp preservation - the combined frame texts are appended to them
+GEMINI_INSTRUCTIONS = """**Role:** You are an expert AI assistant specializing in processing and refining OCR (Optical Character Recognition) output from whiteboard lectures. These lectures are captured frame by frame, and the content is mathematical, including formulas, definitions, and explanations.
 
 **Context:** The provided input is a collation of OCR text from sequential frames of a whiteboard with exact timestamps. This means:
 * Content is generally added incrementally.
@@ -78,19 +81,317 @@ Content describing the first concept...
 Content describing the second concept...
 
 **Input Text:**
-""" + combined_text
-    )
+"""
+
+# Instructions for the rolling refinement mode - the existing notes tail and the new frame texts are appended to them
+ROLLING_INSTRUCTIONS = """**Role:** You are an expert AI assistant refining OCR output from whiteboard lectures into clean lecture notes while the lecture is still being processed.
+
+**Input:** The end of the notes written so far, followed by the OCR text of the next frames in chronological order with timestamps. Frames often repeat content that is already in the notes.
+
+**Instructions:**
+1.  Output ONLY the notes that continue the existing notes: content from the new frames that is not already covered.
+2.  Do not repeat or rewrite the existing notes. If the new frames add nothing, output nothing.
+3.  If a new frame completes a partially written formula or definition, output the completed version.
+4.  Start each new concept with its timestamp formatted as [h:mm:ss].
+5.  Preserve all mathematical notation, keeping LaTeX-style syntax if present.
+6.  Do not include frame markers, frame numbers, separators or any commentary.
+
+"""
+
+def combine_frame_texts(frame_data: List[Tuple[str, str]], first_frame: int = 1) -> str:
+    # Join frame texts with their timestamps and frame markers, skipping empty texts
+    combined_text = ""
+    for i, (text, timestamp) in enumerate(frame_data, first_frame):
+        if text.strip():  # Only include non-empty texts
+            combined_text += f"Frame {i} [Timestamp: {timestamp}]:\n{text}\n\n==================================================\n\n"
+    return combined_text
+
+def estimate_tokens(text: str) -> int:
+    # Rough token count of a text, close enough to keep requests under the budget without a tokenizer call
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def fit_frames_to_budget(frame_data: List[Tuple[str, str]], budget_tokens: int, frame_max_tokens: int = GEMINI_FRAME_MAX_TOKENS,
+                         overlap_frames: int = GEMINI_WINDOW_OVERLAP_FRAMES) -> Tuple[List[Tuple[int, List[Tuple[str, str]]]], int]:
+
+    # Cut overlong frame texts and split the frames into chronological windows that each fit the budget
+
+    # Args: "frame_data": (ocr_text, timestamp_str) tuples in order, "budget_tokens": Tokens available for the frame texts of one request,
+    #       "frame_max_tokens": Longest text kept per frame, "overlap_frames": Last frames of a window repeated at the start of the next one
+
+    # Returns: (windows, trimmed) - list of (index of the first frame, frame_data) windows and the number of cut frame texts
+
+    max_chars = frame_max_tokens * CHARS_PER_TOKEN
+    windows, window, costs, start, trimmed = [], [], [], 0, 0
+    for index, (text, timestamp) in enumerate(frame_data):
+        if len(text) > max_chars:
+            text = text[:max_chars]
+            trimmed += 1
+        cost = estimate_tokens(combine_frame_texts([(text, timestamp)]))
+        if window and sum(costs) + cost > budget_tokens:
+            windows.append((start, window))
+            # Carry the last frames over as far as they leave room for the new one
+            carried = 0
+            while (carried < min(overlap_frames, len(window))
+                   and sum(costs[len(costs) - carried - 1:]) + cost <= budget_tokens):
+                carried += 1
+            window, costs = window[len(window) - carried:], costs[len(costs) - carried:]
+            start = index - carried
+        window.append((text, timestamp))
+        costs.append(cost)
+    if window:
+        windows.append((start, window))
+    return windows, trimmed
+
+def window_settings() -> dict:
+    # Settings that decide how the frames are split into requests - part of the refined text cache keys
+    return {'budget_tokens': GEMINI_PROMPT_BUDGET_TOKENS, 'frame_max_tokens': GEMINI_FRAME_MAX_TOKENS,
+            'overlap_frames': GEMINI_WINDOW_OVERLAP_FRAMES}
+
+def drop_seam_repeats(previous: str, notes: str) -> str:
+    # Drop the opening lines of a window's notes that the previous window's notes already hold
+    # Windows share their seam frames, so the next window usually starts by writing out the same content again
+    seen = {normalize_line(line) for line in previous.splitlines()}
+    lines = notes.splitlines()
+    start = 0
+    while start < len(lines) and (not lines[start].strip() or normalize_line(lines[start]) in seen):
+        start += 1
+    return "\n".join(lines[start:])
+
+def process_frames_with_gemini(frame_data: List[Tuple[str, str]], budget_tokens: int = None) -> str:
+    # Process a list of OCR texts with timestamps from video frames using Gemini API
+    
+    # Args: "frame_data": List of (OCR_text, timestamp_str) tuples from individual frames that are ordered chronologically,
+    #       "budget_tokens": Prompt budget of one request (GEMINI_PROMPT_BUDGET_TOKENS if None)
+        
+    # Returns: Processed and cleaned transcription from Gemini giving the final result with timestamps
+    
+    if not GEMINI_API_KEY:
+        raise ValueError("GEMINI_API_KEY environment variable is not set")
+    
+    if not frame_data:
+        return "No frame data provided for processing"
+    
+    if not any(text.strip() for text, _ in frame_data):
+        return "No valid text content found in frames"
+
+    # Repeated board lines are dropped locally, Gemini then only orders and cleans the remaining lines
+    if GEMINI_PRE_REDUCE:
+        reduced = reduce_frames(frame_data)
+        print(f"Pre-reduced {len(frame_data)} frames to {len(reduced)} frames, "
+              f"{sum(len(text) for text, _ in reduced)}/{sum(len(text) for text, _ in frame_data)} characters")
+        frame_data = reduced
+
+    # The instructions are sent once as cached content, only the frame texts count against the budget of each request
+    budget_tokens = budget_tokens or GEMINI_PROMPT_BUDGET_TOKENS
+    windows, trimmed = fit_frames_to_budget(frame_data, budget_tokens - estimate_tokens(GEMINI_INSTRUCTIONS))
+    gemini.count(trimmed_frames=trimmed, windows=len(windows))
+    if len(windows) > 1 or trimmed:
+        print(f"Gemini refinement: {len(frame_data)} frames in {len(windows)} requests, {trimmed} frame texts trimmed")
 
     try:
         # Make the API request with exponential backoff retry logic
         # Google AI Studio API can sometimes be unstable so we need to retry
-        result = make_api_request_with_retry(ai_prompt)
-        return result
+        results = []
+        for start, window in windows:
+            # Combine the frame texts with timestamps and frame markers for context
+            combined_text = combine_frame_texts(window, first_frame=start + 1)
+            if combined_text.strip():
+                notes = make_api_request_with_retry(combined_text, instructions=GEMINI_INSTRUCTIONS)
+                if results:
+                    notes = drop_seam_repeats(results[-1], notes)
+                if notes.strip():
+                    results.append(notes)
+        return "\n\n".join(results)
         
     except Exception as e:
         return f"An unexpected error occurred: {str(e)}"
 
-def make_api_request_with_retry(prompt: str, max_retries: int = 3, initial_delay: float = 1.0) -> str:
+class RollingRefiner:
+
+    # Keeps a running cleaned transcript while frames are still being transcribed
+    # Every batch of new OCR texts is sent together with only a bounded tail of the notes written so far,
+    # so each request has the same size no matter how long the lecture already is
+
+    # request: Callable(prompt) -> notes, sends ROLLING_INSTRUCTIONS as system instruction if None
+
+    def __init__(self, batch_frames: int = ROLLING_BATCH_FRAMES, context_chars: int = ROLLING_CONTEXT_CHARS,
+                 request=None):
+        if not GEMINI_API_KEY:
+            raise ValueError("GEMINI_API_KEY environment variable is not set")
+        self.batch_frames = batch_frames
+        self.context_chars = context_chars
+        self.request = request or partial(make_api_request_with_retry, instructions=ROLLING_INSTRUCTIONS)
+        self.transcript = ""
+        self.frames_seen = 0
+        self.batches_refined = 0
+        self.last_error = None
+        self._pending = []
+
+    def add_frames(self, frame_data: List[Tuple[str, str]]) -> str:
+        # Queue new frame texts (chronological) and refine every full batch, returns the current transcript
+        self._pending.extend(frame for frame in frame_data if frame[0].strip())
+        while len(self._pending) >= self.batch_frames:
+            if not self._refine(self._pending[:self.batch_frames]):
+                # Keep the batch and try again together with the next frames
+                break
+            del self._pending[:self.batch_frames]
+        return self.transcript
+
+    def flush(self) -> str:
+        # Refine every remaining frame text and return the final transcript
+        if self._pending and self._refine(self._pending):
+            self._pending = []
+        if self._pending and not self.transcript:
+            return f"An unexpected error occurred: {self.last_error}"
+        return self.transcript
+
+    @property
+    def unrefined_frames(self) -> int:
+        # Frames whose refinement failed and that are missing from the transcript
+        return len(self._pending)
+
+    def context_tail(self) -> str:
+        # The end of the notes written so far, cut at a line start
+        if len(self.transcript) <= self.context_chars:
+            return self.transcript
+        tail = self.transcript[-self.context_chars:]
+        newline = tail.find("\n")
+        return tail[newline + 1:] if newline != -1 else tail
+
+    def _refine(self, batch: List[Tuple[str, str]]) -> bool:
+        prompt = ("**Existing Notes (end):**\n" + (self.context_tail() or "(none yet)") + "\n\n"
+                  + "**New OCR Frames:**\n" + combine_frame_texts(batch, first_frame=self.frames_seen + 1))
+        try:
+            new_notes = self.request(prompt).strip()
+        except Exception as e:
+            self.last_error = str(e)
+            return False
+        if new_notes:
+            self.transcript = f"{self.transcript}\n\n{new_notes}" if self.transcript else new_notes
+        self.frames_seen += len(batch)
+        self.batches_refined += 1
+        return True
+
+def __getattr__(name: str):
+    # google.genai takes most of the import time of the backend, so it is only loaded once a request needs it
+    # Module attribute access (process_video_text.genai) loads it as well
+    if name in ('genai', 'types', 'errors'):
+        load_genai()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def load_genai():
+    # Import the Gemini SDK on first use
+    if 'genai' not in globals():
+        from google import genai
+        from google.genai import errors, types
+        globals().update(genai=genai, types=types, errors=errors)
+
+class GeminiSession:
+
+    # One Gemini client for the whole backend plus a cache handle per instruction block
+    # Each instruction block is uploaded once as cached content and referenced by name, so requests only carry the frame texts
+    # When the model refuses the cache (instructions below its minimum cache size) they are sent as system instruction instead
+
+    def __init__(self, client_factory=None, ttl_sec: int = GEMINI_CACHE_TTL_SEC, refresh_sec: int = GEMINI_CACHE_REFRESH_SEC):
+        self.client_factory = client_factory
+        self.ttl_sec = ttl_sec
+        self.refresh_sec = refresh_sec
+        self._client = None
+        self._client_key = None
+        # instructions -> {'name': cache name or None, 'expires': monotonic time}
+        self._handles = {}
+        self._lock = threading.RLock()
+        self.counters = Counter()
+
+    @property
+    def client(self):
+        # Created on first use and again when the API key changes
+        with self._lock:
+            if self._client is None or self._client_key != GEMINI_API_KEY:
+                load_genai()
+                factory = self.client_factory or genai.Client
+                self._client = factory(api_key=GEMINI_API_KEY)
+                self._client_key = GEMINI_API_KEY
+                self._handles.clear()
+            return self._client
+
+    def cached_instructions(self, instructions: str):
+
+        # Name of the cached content holding the instructions, created or refreshed when needed
+
+        # Args: instructions: Fixed instruction block
+
+        # Returns: Cache name, or None when caching is unavailable (retried after ttl_sec)
+
+        with self._lock:
+            client = self.client
+            now = time.monotonic()
+            handle = self._handles.get(instructions)
+            if handle is not None and now < handle['expires'] - self.refresh_sec:
+                if handle['name'] is not None:
+                    self.counters['cache_hits'] += 1
+                return handle['name']
+            ttl = f"{self.ttl_sec}s"
+            if handle is not None and handle['name'] is not None:
+                try:
+                    client.caches.update(name=handle['name'], config=types.UpdateCachedContentConfig(ttl=ttl))
+                    handle['expires'] = now + self.ttl_sec
+                    self.counters['cache_refreshed'] += 1
+                    return handle['name']
+                except Exception as e:
+                    print(f"Refreshing cached instructions failed, creating them again: {str(e)}")
+            try:
+                cache = client.caches.create(model=GEMINI_MODEL, config=types.CreateCachedContentConfig(
+                    system_instruction=instructions, ttl=ttl, display_name="boardcast-instructions"))
+                self._handles[instructions] = {'name': cache.name, 'expires': now + self.ttl_sec}
+                self.counters['cache_created'] += 1
+                return cache.name
+            except Exception as e:
+                print(f"Instruction caching unavailable, sending them as system instruction: {str(e)}")
+                self._handles[instructions] = {'name': None, 'expires': now + self.ttl_sec}
+                self.counters['cache_unavailable'] += 1
+                return None
+
+    def invalidate(self, instructions: str):
+        # Forget the cache handle, e.g. after the cache was deleted on the Gemini side
+        with self._lock:
+            self._handles.pop(instructions, None)
+
+    def generation_config(self, instructions: str = None):
+        # Request config referencing the cached instructions, or carrying them inline as fallback
+        if instructions is None:
+            return types.GenerateContentConfig(response_mime_type="text/plain")
+        name = self.cached_instructions(instructions)
+        if name is not None:
+            return types.GenerateContentConfig(response_mime_type="text/plain", cached_content=name)
+        return types.GenerateContentConfig(response_mime_type="text/plain", system_instruction=instructions)
+
+    def count(self, **amounts: int):
+        # Add to the counters - requests of several jobs finish at the same time, so updates hold the lock
+        with self._lock:
+            self.counters.update(amounts)
+
+    def record(self, prompt: str, instructions: str = None):
+        self.count(requests=1, prompt_tokens=estimate_tokens(prompt),
+                   instruction_tokens=estimate_tokens(instructions) if instructions is not None else 0)
+
+    def stats(self) -> dict:
+        with self._lock:
+            cached = sum(1 for handle in self._handles.values() if handle['name'] is not None)
+            counters = {name: self.counters[name] for name in ('requests', 'prompt_tokens', 'instruction_tokens', 'windows',
+                                                               'trimmed_frames', 'cache_created', 'cache_refreshed',
+                                                               'cache_hits', 'cache_unavailable')}
+        return {
+            'prompt_budget_tokens': GEMINI_PROMPT_BUDGET_TOKENS,
+            'cached_instructions': cached,
+            **counters,
+        }
+
+# Gemini client and cached instructions of this backend
+gemini = GeminiSession()
+
+def make_api_request_with_retry(prompt: str, max_retries: int = 3, initial_delay: float = 1.0, instructions: str = None) -> str:
     
     # Make an API request with exponential backoff retry logic for rate limiting. 
     # Google AI Studio API can sometimes be unstable so we need to retry
@@ -99,19 +400,19 @@ def make_api_request_with_retry(prompt: str, max_retries: int = 3, initial_delay
     #     prompt: The text prompt to send to Gemini
     #     max_retries: Maximum number of retry attempts
     #     initial_delay: Initial delay in seconds before first retry
+    #     instructions: Fixed instructions sent through the cached content of the session instead of the prompt
         
     # Returns: str: The API response content
 
+    load_genai()
     delay = initial_delay
     
     for attempt in range(max_retries):
         try:
-            # Create the Gemini client
-            client = genai.Client(
-                api_key=GEMINI_API_KEY,
-            )
+            # Reuse the Gemini client of the session
+            client = gemini.client
 
-            model = "gemini-2.0-flash"
+            model = GEMINI_MODEL
             contents = [
                 types.Content(
                     role="user",
@@ -120,24 +421,27 @@ def make_api_request_with_retry(prompt: str, max_retries: int = 3, initial_delay
                     ],
                 ),
             ]
-            generate_content_config = types.GenerateContentConfig(
-                response_mime_type="text/plain",
-            )
+            generate_content_config = gemini.generation_config(instructions)
 
-            # Collect the streaming response
+            # Collect the streaming response, every attempt is one span of the job trace
             result = ""
-            for chunk in client.models.generate_content_stream(
-                model=model,
-                contents=contents,
-                config=generate_content_config,
-            ):
-                if chunk.text:
-                    result += chunk.text
+            with span('gemini request', 'refine', attempt=attempt, prompt_chars=len(prompt)):
+                for chunk in client.models.generate_content_stream(
+                    model=model,
+                    contents=contents,
+                    config=generate_content_config,
+                ):
+                    if chunk.text:
+                        result += chunk.text
             
             # Return the complete result
+            gemini.record(prompt, instructions)
             return result
             
         except Exception as e:
+            # An expired or deleted cache is answered with 404 (403 once it belongs to nobody), the retry creates it again
+            if instructions is not None and isinstance(e, errors.ClientError) and e.code in (403, 404):
+                gemini.invalidate(instructions)
             if attempt == max_retries - 1:  # Last attempt
                 raise e
             time.sleep(delay)
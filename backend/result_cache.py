@@ -0,0 +1,224 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Optional, List
+
+from process_frames import MODEL_NAME, MAX_IMAGE_SIZE, OCR_PROMPT, streaming_settings
+from process_video_text import (GEMINI_MODEL, PROMPT_VERSION, GEMINI_PRE_REDUCE, GEMINI_INSTRUCTIONS,
+                                ROLLING_INSTRUCTIONS, window_settings)
+from board_mosaic import mosaic_settings
+from ocr_engines import ocr_settings
+from frame_quality import gating_settings
+from video_utils import EXTRACT_EVERY_SEC, FRAME_SIZE
+
+# Directory of the persistent result store
+RESULT_CACHE_DIR = Path(os.getenv("RESULT_CACHE_DIR", Path(__file__).parent / "cache" / "results"))
+# Maximum total size of the result store before the least recently used entries are evicted
+RESULT_CACHE_MAX_BYTES = int(float(os.getenv("RESULT_CACHE_MAX_MB", "200")) * 1024 * 1024)
+# Read size used when hashing uploaded files
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def hash_file(file_path: Path, chunk_size: int = HASH_CHUNK_SIZE) -> str:
+
+    # Hash a file in fixed size chunks so large videos are never loaded into memory at once
+
+    # Args: "file_path": Path to the file, "chunk_size": Number of bytes read per step
+
+    # Returns: Hex encoded SHA-256 digest of the file content
+
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def save_and_hash(stream, file_path: Path, chunk_size: int = HASH_CHUNK_SIZE) -> str:
+
+    # Write an upload stream to disk and hash it in the same pass
+
+    # Args: "stream": Readable binary stream of the upload, "file_path": Destination file, "chunk_size": Number of bytes copied per step
+
+    # Returns: Hex encoded SHA-256 digest of the file content, equal to hash_file of the written file
+
+    digest = hashlib.sha256()
+    with open(file_path, 'wb') as f:
+        for chunk in iter(lambda: stream.read(chunk_size), b''):
+            digest.update(chunk)
+            f.write(chunk)
+    return digest.hexdigest()
+
+def prompts_hash() -> str:
+    # Hash of every prompt text of the pipeline, so editing a prompt invalidates the stored transcripts without a version bump
+    material = json.dumps([OCR_PROMPT, GEMINI_INSTRUCTIONS, ROLLING_INSTRUCTIONS])
+    return hashlib.sha256(material.encode()).hexdigest()
+
+def pipeline_settings(refine_mode: str = 'full') -> dict:
+    # Settings that change the output of the video pipeline - part of every cache key
+    return {
+        'refine_mode': refine_mode,
+        'extract_every_sec': EXTRACT_EVERY_SEC,
+        'frame_size': FRAME_SIZE,
+        'max_image_size': list(MAX_IMAGE_SIZE),
+        'ocr_model': MODEL_NAME,
+        'ocr': ocr_settings(),
+        'quality_gating': gating_settings(),
+        'ocr_streaming': streaming_settings(),
+        'gemini_model': GEMINI_MODEL,
+        'prompt_version': PROMPT_VERSION,
+        'prompts': prompts_hash(),
+        'mosaic': mosaic_settings(),
+        'pre_reduce': GEMINI_PRE_REDUCE,
+        'gemini_windows': window_settings(),
+    }
+
+def make_cache_key(content_hash: str, settings: dict = None) -> str:
+
+    # Combine the content hash of the upload with the pipeline settings into a single key
+
+    # Args: "content_hash": Hash of the uploaded file, "settings": Pipeline settings (current settings if None)
+
+    # Returns: Hex encoded cache key
+
+    if settings is None:
+        settings = pipeline_settings()
+    material = json.dumps({'content': content_hash, 'settings': settings}, sort_keys=True)
+    return hashlib.sha256(material.encode()).hexdigest()
+
+class DiskCache:
+
+    # Persistent JSON store with one file per entry and size based LRU eviction
+    # The modification time of an entry file is refreshed on every hit and is used as its last access time
+
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self.root.mkdir(parents=True, exist_ok=True)
+        # Running total of the entry sizes so eviction only scans the directory when the store is full
+        self._size = sum(p.stat().st_size for p in self.root.glob('*.json'))
+
+    def _path(self, key: str) -> Path:
+        # Keys are hex digests so they are always safe to use as file names
+        if not key or not all(c in '0123456789abcdef' for c in key):
+            raise ValueError(f"Invalid cache key: {key}")
+        return self.root / f"{key}.json"
+
+    def get(self, key: str) -> Optional[dict]:
+        # Return the stored value or None on a miss
+        path = self._path(key)
+        with self._lock:
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    entry = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                self.misses += 1
+                return None
+            # Mark as recently used
+            os.utime(path)
+            self.hits += 1
+            return entry['value']
+
+    def put(self, key: str, value: dict, meta: dict = None):
+        # Store a value and evict old entries if the store grew too large
+        path = self._path(key)
+        entry = {'key': key, 'created': time.time(), 'meta': meta or {}, 'value': value}
+        tmp_path = path.with_suffix('.tmp')
+        with self._lock:
+            old_size = path.stat().st_size if path.exists() else 0
+            # Write to a temporary file first so readers never see a partial entry
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)
+            self._size += path.stat().st_size - old_size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def delete(self, key: str) -> bool:
+        # Remove one entry, returns True if it existed
+        path = self._path(key)
+        with self._lock:
+            try:
+                size = path.stat().st_size
+                path.unlink()
+            except FileNotFoundError:
+                return False
+            self._size -= size
+            return True
+
+    def clear(self) -> int:
+        # Remove every entry, returns the number of removed entries
+        with self._lock:
+            removed = 0
+            for path in self.root.glob('*.json'):
+                path.unlink(missing_ok=True)
+                removed += 1
+            self._size = 0
+            return removed
+
+    def entries(self) -> List[dict]:
+        # Describe every entry, most recently used first
+        result = []
+        for path in self.root.glob('*.json'):
+            try:
+                stat = path.stat()
+                with open(path, 'r', encoding='utf-8') as f:
+                    entry = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue
+            result.append({
+                'key': path.stem,
+                'size_bytes': stat.st_size,
+                'created': entry.get('created'),
+                'last_access': stat.st_mtime,
+                'meta': entry.get('meta', {}),
+            })
+        result.sort(key=lambda e: e['last_access'], reverse=True)
+        return result
+
+    def stats(self) -> dict:
+        # Summary counters of the store
+        files = list(self.root.glob('*.json'))
+        return {
+            'entries': len(files),
+            'size_bytes': sum(p.stat().st_size for p in files if p.exists()),
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def _evict(self):
+        # Remove least recently used entries until the store fits into max_bytes (lock must be held)
+        files = []
+        total = 0
+        for path in self.root.glob('*.json'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        files.sort()
+        while total > self.max_bytes and files:
+            _, size, path = files.pop(0)
+            path.unlink(missing_ok=True)
+            total -= size
+            self.evictions += 1
+        self._size = total
+
+# Shared store for finished video transcripts, created on first use so importing the backend creates no directories
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+def get_result_cache() -> DiskCache:
+    global _result_cache
+    with _result_cache_lock:
+        if _result_cache is None:
+            _result_cache = DiskCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES)
+        return _result_cache
@@ -0,0 +1,146 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+# SQLite database of the full-text index over finished transcripts
+SEARCH_DB = Path(os.getenv("SEARCH_DB", Path(__file__).parent / "cache" / "search.db"))
+# Upper bound of results per query
+SEARCH_MAX_RESULTS = int(os.getenv("SEARCH_MAX_RESULTS", "50"))
+
+# Timestamp markers written by the Gemini refinement, e.g. [0:01:30]
+TIMESTAMP_MARKER = re.compile(r'\[(\d+:\d{2}:\d{2})\]')
+
+def parse_timestamp(timestamp_str: str) -> int:
+    # Convert h:mm:ss to seconds
+    hours, minutes, seconds = (int(part) for part in timestamp_str.split(':'))
+    return hours * 3600 + minutes * 60 + seconds
+
+def split_transcript(text: str) -> List[Tuple[str, str]]:
+
+    # Split refined notes into their timestamped sections
+
+    # Args: text: Notes with [h:mm:ss] markers
+
+    # Returns: List of (timestamp_str, section_text) tuples - text before the first marker belongs to 0:00:00
+
+    segments = []
+    parts = TIMESTAMP_MARKER.split(text)
+    # split() alternates text and captured timestamps: [before, ts1, text1, ts2, text2, ...]
+    if parts[0].strip():
+        segments.append(("0:00:00", parts[0].strip()))
+    for timestamp_str, section in zip(parts[1::2], parts[2::2]):
+        if section.strip():
+            segments.append((timestamp_str, section.strip()))
+    return segments
+
+def build_match_query(query: str) -> str:
+    # Quote every word so formula characters (^, *, -, parentheses) are searched as text instead of parsed as FTS syntax
+    terms = [term.replace('"', '""') for term in query.split()]
+    return " ".join(f'"{term}"' for term in terms if term.strip('"'))
+
+class SearchIndex:
+
+    # FTS5 index of refined notes and per-frame OCR text, one row per timestamped section
+    # Re-indexing a lecture replaces its rows, so finished jobs update the index incrementally
+
+    def __init__(self, db_path: Path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS lectures (
+                lecture_id TEXT PRIMARY KEY,
+                filename TEXT NOT NULL,
+                indexed REAL NOT NULL,
+                sections INTEGER NOT NULL
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS segments USING fts5(
+                text,
+                lecture_id UNINDEXED,
+                source UNINDEXED,
+                timestamp UNINDEXED,
+                seconds UNINDEXED,
+                tokenize = 'unicode61'
+            );
+        """)
+        self._conn.commit()
+
+    def index_lecture(self, lecture_id: str, filename: str, transcript: str, frame_data: List[Tuple[str, str]] = ()) -> int:
+
+        # Add or replace the searchable text of a lecture
+
+        # Args: "lecture_id": Content hash of the video, "filename": Name shown in the results,
+        #       "transcript": Refined notes with [h:mm:ss] markers, "frame_data": (ocr_text, timestamp_str) of every frame
+
+        # Returns: Number of indexed sections
+
+        rows = [(text, lecture_id, 'notes', ts, parse_timestamp(ts)) for ts, text in split_transcript(transcript)]
+        rows += [(text, lecture_id, 'ocr', ts, parse_timestamp(ts)) for text, ts in frame_data if text.strip()]
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM segments WHERE lecture_id = ?", (lecture_id,))
+                self._conn.executemany(
+                    "INSERT INTO segments (text, lecture_id, source, timestamp, seconds) VALUES (?, ?, ?, ?, ?)", rows)
+                self._conn.execute("INSERT OR REPLACE INTO lectures (lecture_id, filename, indexed, sections) VALUES (?, ?, ?, ?)",
+                                   (lecture_id, filename, time.time(), len(rows)))
+        return len(rows)
+
+    def search(self, query: str, limit: int = SEARCH_MAX_RESULTS, lecture_id: str = None, source: str = None) -> List[dict]:
+
+        # Find the sections containing every word of the query, best match first (BM25)
+
+        # Args: "query": Words or formula to find, "limit": Maximum number of results,
+        #       "lecture_id": Only search one lecture, "source": Only search "notes" or "ocr" sections
+
+        # Returns: List of {lecture_id, filename, source, timestamp, seconds, snippet, score}
+
+        match = build_match_query(query)
+        if not match:
+            return []
+        sql = ("SELECT s.lecture_id, l.filename, s.source, s.timestamp, s.seconds, "
+               "snippet(segments, 0, '[', ']', '...', 16), bm25(segments) "
+               "FROM segments s JOIN lectures l ON l.lecture_id = s.lecture_id WHERE segments MATCH ?")
+        params = [match]
+        if lecture_id is not None:
+            sql += " AND s.lecture_id = ?"
+            params.append(lecture_id)
+        if source is not None:
+            sql += " AND s.source = ?"
+            params.append(source)
+        sql += " ORDER BY bm25(segments) LIMIT ?"
+        params.append(min(limit, SEARCH_MAX_RESULTS))
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [{
+            'lecture_id': row[0],
+            'filename': row[1],
+            'source': row[2],
+            'timestamp': row[3],
+            'seconds': row[4],
+            'snippet': row[5],
+            # bm25 is lower for better matches, flip it so higher scores rank first
+            'score': round(-row[6], 4),
+        } for row in rows]
+
+    def stats(self) -> dict:
+        with self._lock:
+            lectures, sections = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(sections), 0) FROM lectures").fetchone()
+        return {'lectures': lectures, 'sections': sections}
+
+# Search index of this backend, opened on first use so importing the backend creates no database
+_search_index = None
+_search_index_lock = threading.Lock()
+
+def get_search_index() -> SearchIndex:
+    global _search_index
+    with _search_index_lock:
+        if _search_index is None:
+            _search_index = SearchIndex(SEARCH_DB)
+        return _search_index
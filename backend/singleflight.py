@@ -0,0 +1,81 @@
+import threading
+from typing import Any, Callable, Optional, Tuple
+
+from jobs import JobCancelled
+
+class Flight:
+
+    # One running call that later identical calls attach to
+
+    def __init__(self, owner: str = None):
+        self.owner = owner
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+class SingleFlight:
+
+    # Runs at most one call per key at a time - callers arriving while it runs wait for it and share its result
+    # Nothing is stored once the call returns, finished results belong in the result cache
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key: str, fn: Callable[[], Any], owner: str = None,
+           cancel_event: threading.Event = None) -> Tuple[Any, Optional[str]]:
+
+        # Run fn for the key, or wait for the identical call that is already running
+
+        # Args: "key": Identity of the call, "fn": The call itself, "owner": Name of the caller (e.g. its job id),
+        #       "cancel_event": Stops a waiting caller when set
+
+        # Returns: Tuple of (result, owner of the shared call - None if this caller ran fn itself)
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = Flight(owner)
+                self._flights[key] = flight
+                self.leaders += 1
+            else:
+                flight.followers += 1
+                self.coalesced += 1
+
+        if leader:
+            try:
+                flight.result = fn()
+                return flight.result, None
+            except BaseException as e:
+                flight.error = e
+                raise
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+
+        # A waiting caller can still go away without affecting the running call
+        while not flight.done.wait(0.5):
+            if cancel_event is not None and cancel_event.is_set():
+                with self._lock:
+                    flight.followers -= 1
+                raise JobCancelled('cancelled while waiting for an identical job')
+        if flight.error is not None:
+            raise flight.error
+        return flight.result, flight.owner
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'in_flight': len(self._flights),
+                'waiting': sum(flight.followers for flight in self._flights.values()),
+                'leaders': self.leaders,
+                'coalesced': self.coalesced,
+            }
+
+# Identical video uploads running at the same time share one pipeline run
+video_flights = SingleFlight()
@@ -0,0 +1,141 @@
+import base64
+import hashlib
+import io
+import json
+import os
+import threading
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from PIL import Image
+
+from process_frames import MODEL_NAME, MAX_IMAGE_SIZE, OCR_PROMPT, streaming_settings
+from process_video_text import GEMINI_MODEL, GEMINI_INSTRUCTIONS, GEMINI_PRE_REDUCE, window_settings
+from board_mosaic import mosaic_settings
+from ocr_engines import ocr_settings
+from frame_quality import gating_settings
+from result_cache import DiskCache
+from video_utils import EXTRACT_EVERY_SEC, PREVIEW_EVERY_SEC, FRAME_SIZE
+
+# Directory of the per-stage artifact store
+STAGE_CACHE_DIR = Path(os.getenv("STAGE_CACHE_DIR", Path(__file__).parent / "cache" / "stages"))
+# Maximum size of each stage before its least recently used artifacts are evicted
+STAGE_CACHE_MAX_BYTES = int(float(os.getenv("STAGE_CACHE_MAX_MB", "500")) * 1024 * 1024)
+
+# Pipeline stages with their own artifacts
+MANIFEST_STAGE = "manifest"   # Frame numbers and timestamps extracted from a video
+FRAMES_STAGE = "frames"       # Extracted frame images
+OCR_STAGE = "ocr"             # OCR text of a single frame
+REFINED_STAGE = "refined"     # Gemini output for a list of frame texts
+STAGES = (MANIFEST_STAGE, FRAMES_STAGE, OCR_STAGE, REFINED_STAGE)
+
+def _text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def stage_key(stage: str, **inputs) -> str:
+
+    # Build the key of a stage artifact from everything the stage output depends on
+
+    # Args: "stage": Stage name, "inputs": Input hashes and parameters of the stage
+
+    # Returns: Hex encoded key
+
+    material = json.dumps({'stage': stage, **inputs}, sort_keys=True)
+    return hashlib.sha256(material.encode()).hexdigest()
+
+class StageStore:
+
+    # Stores the intermediate artifacts of the video pipeline so a rerun only recomputes
+    # the stages whose inputs or parameters changed
+    # Frames and OCR texts are keyed by timestamp, so changing the sampling interval reuses
+    # every frame that falls on the same timestamp, and changing the Gemini prompt reuses every OCR text
+
+    def __init__(self, root: Path, max_bytes: int):
+        self.stores = {stage: DiskCache(Path(root) / stage, max_bytes) for stage in STAGES}
+
+    def load_manifest(self, video_hash: str) -> Optional[List[Tuple[int, str]]]:
+        # Frame numbers and timestamps of a video extracted with the current sampling settings
+        value = self.stores[MANIFEST_STAGE].get(self._manifest_key(video_hash))
+        if value is None:
+            return None
+        return [(frame_number, timestamp) for frame_number, timestamp in value['frames']]
+
+    def save_frames(self, video_hash: str, frames: List[Tuple[int, Image.Image, str]]):
+        # Store the extracted frame images followed by the manifest that lists them
+        for _, image, timestamp in frames:
+            self.save_frame(video_hash, timestamp, image)
+        self.stores[MANIFEST_STAGE].put(self._manifest_key(video_hash),
+                                        {'frames': [[frame_number, timestamp] for frame_number, _, timestamp in frames]})
+
+    def save_frame(self, video_hash: str, timestamp: str, image: Image.Image):
+        # Store one frame image without touching the manifest, e.g. a frame of the preview pass
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=95)
+        self.stores[FRAMES_STAGE].put(self._frame_key(video_hash, timestamp),
+                                      {'jpeg': base64.b64encode(buffer.getvalue()).decode()})
+
+    def load_frame(self, video_hash: str, timestamp: str) -> Optional[Image.Image]:
+        # Decode a stored frame image, None if it was evicted
+        value = self.stores[FRAMES_STAGE].get(self._frame_key(video_hash, timestamp))
+        if value is None:
+            return None
+        image = Image.open(io.BytesIO(base64.b64decode(value['jpeg'])))
+        return image.convert('RGB')
+
+    def load_ocr(self, video_hash: str, timestamp: str) -> Optional[str]:
+        value = self.stores[OCR_STAGE].get(self._ocr_key(video_hash, timestamp))
+        return None if value is None else value['text']
+
+    def save_ocr(self, video_hash: str, timestamp: str, text: str):
+        # The engine that produced the text is kept with it for inspection
+        self.stores[OCR_STAGE].put(self._ocr_key(video_hash, timestamp), {'text': text, 'engine': getattr(text, 'engine', None)})
+
+    def load_refined(self, frame_data: List[Tuple[str, str]]) -> Optional[str]:
+        value = self.stores[REFINED_STAGE].get(self._refined_key(frame_data))
+        return None if value is None else value['text']
+
+    def save_refined(self, frame_data: List[Tuple[str, str]], text: str):
+        self.stores[REFINED_STAGE].put(self._refined_key(frame_data), {'text': text})
+
+    def stats(self) -> dict:
+        return {stage: store.stats() for stage, store in self.stores.items()}
+
+    def _manifest_key(self, video_hash: str) -> str:
+        return stage_key(MANIFEST_STAGE, video=video_hash, extract_every_sec=EXTRACT_EVERY_SEC, frame_size=FRAME_SIZE)
+
+    def _frame_key(self, video_hash: str, timestamp: str) -> str:
+        return stage_key(FRAMES_STAGE, video=video_hash, timestamp=timestamp, frame_size=FRAME_SIZE)
+
+    def _ocr_key(self, video_hash: str, timestamp: str) -> str:
+        # Mosaic texts may cover only the new region of a frame, so they never mix with whole frame texts
+        # The region depends on the thresholds and on the frames before it, which the sampling intervals of the passes decide
+        mosaic = {'mosaic': {**mosaic_settings(), 'extract_every_sec': EXTRACT_EVERY_SEC,
+                             'preview_every_sec': PREVIEW_EVERY_SEC}} if mosaic_settings() else {}
+        # Texts of other engine policies (local engine, fallbacks) never mix with the texts of the remote model
+        settings = ocr_settings()
+        engines = {'ocr': settings} if settings['policy'] != 'remote' else {}
+        # Gated runs only reuse texts of gated runs, otherwise the frames a run transcribes would depend on what was stored before
+        gating = {'quality_gating': gating_settings()} if gating_settings() else {}
+        # Streamed texts may be cut at a repetition loop or the length limit
+        streaming = {'streaming': streaming_settings()} if streaming_settings() else {}
+        return stage_key(OCR_STAGE, frame=self._frame_key(video_hash, timestamp), model=MODEL_NAME,
+                         prompt=_text_hash(OCR_PROMPT), max_image_size=list(MAX_IMAGE_SIZE),
+                         **mosaic, **engines, **gating, **streaming)
+
+    def _refined_key(self, frame_data: List[Tuple[str, str]]) -> str:
+        # Pre-reduced frames give Gemini a different prompt for the same frame texts
+        pre_reduce = {'pre_reduce': True} if GEMINI_PRE_REDUCE else {}
+        # The prompt budget decides how the frames are windowed and cut, so it changes the refined text as well
+        return stage_key(REFINED_STAGE, frames=_text_hash(json.dumps(frame_data)), model=GEMINI_MODEL,
+                         prompt=_text_hash(GEMINI_INSTRUCTIONS), windows=window_settings(), **pre_reduce)
+
+# Shared store for the intermediate video pipeline artifacts, created on first use
+_stage_store = None
+_stage_store_lock = threading.Lock()
+
+def get_stage_store() -> StageStore:
+    global _stage_store
+    with _stage_store_lock:
+        if _stage_store is None:
+            _stage_store = StageStore(STAGE_CACHE_DIR, STAGE_CACHE_MAX_BYTES)
+        return _stage_store
@@ -0,0 +1,359 @@
+import base64
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from PIL import Image
+
+# Queue shared by the API node and the workers: sqlite:///<path> (default, one machine) or redis://<host>:<port>/<db>
+TASK_QUEUE_URL = os.getenv("TASK_QUEUE_URL", f"sqlite:///{Path(__file__).parent / 'cache' / 'tasks.db'}")
+# A claimed task returns to the queue when its worker does not finish it within the lease (seconds)
+TASK_LEASE_SEC = float(os.getenv("TASK_LEASE_SEC", "120"))
+# Attempts of a task before it is marked as failed (claims by crashed workers count as attempts)
+TASK_MAX_ATTEMPTS = int(os.getenv("TASK_MAX_ATTEMPTS", "3"))
+# A group expires when its API node stops renewing it for this long (seconds) - the node died, workers drop its tasks
+TASK_GROUP_TTL_SEC = float(os.getenv("TASK_GROUP_TTL_SEC", "300"))
+
+# Redis claim of one task, run as a single script so a cancel or a second worker never lands between its steps
+# KEYS: queued list, leased set of the kind - ARGV: task key prefix, lease expiry, worker id
+# Returns [task_id, group_id, payload, attempts] or nil when no queued task is left
+REDIS_CLAIM_SCRIPT = """
+while true do
+    local task_id = redis.call('LPOP', KEYS[1])
+    if not task_id then
+        return nil
+    end
+    local key = ARGV[1] .. task_id
+    -- Ids of tasks cancelled, deleted or expired while queued are dropped
+    if redis.call('HGET', key, 'status') == 'queued' then
+        redis.call('ZADD', KEYS[2], ARGV[2], task_id)
+        local attempts = redis.call('HINCRBY', key, 'attempts', 1)
+        redis.call('HSET', key, 'status', 'leased', 'worker', ARGV[3])
+        return {task_id, redis.call('HGET', key, 'group_id'), redis.call('HGET', key, 'payload'), attempts}
+    end
+end
+"""
+
+# Redis cancel of one task, a claim of the same task runs either wholly before or wholly after it
+# KEYS: task hash - ARGV: leased set prefix, task id
+REDIS_CANCEL_SCRIPT = """
+local status = redis.call('HGET', KEYS[1], 'status')
+if status == 'queued' or status == 'leased' then
+    redis.call('HSET', KEYS[1], 'status', 'cancelled')
+    redis.call('ZREM', ARGV[1] .. redis.call('HGET', KEYS[1], 'kind'), ARGV[2])
+end
+"""
+
+def encode_image(image: Image.Image) -> str:
+    # Frames travel through the queue as base64 JPEG, the same encoding the stage store uses
+    buffer = io.BytesIO()
+    image.convert('RGB').save(buffer, format='JPEG', quality=95)
+    return base64.b64encode(buffer.getvalue()).decode()
+
+def decode_image(data: str) -> Image.Image:
+    image = Image.open(io.BytesIO(base64.b64decode(data)))
+    image.load()
+    return image
+
+class Task:
+
+    # A claimed unit of work
+
+    __slots__ = ('task_id', 'group_id', 'kind', 'payload', 'attempts')
+
+    def __init__(self, task_id: str, group_id: str, kind: str, payload: dict, attempts: int):
+        self.task_id = task_id
+        self.group_id = group_id
+        self.kind = kind
+        self.payload = payload
+        self.attempts = attempts
+
+class TaskQueue(ABC):
+
+    # Interface of the shared queue
+    # Tasks belong to a group (one job stage), a worker claims a task for a lease and completes or fails it
+    # Task states: queued -> leased -> done | failed | cancelled, a failed attempt goes back to queued while attempts remain
+    # The API node waiting for a group renews it, groups left alone for ttl_sec are deleted by the next claim
+
+    @abstractmethod
+    def enqueue(self, kind: str, payloads: List[dict], group_id: str, max_attempts: int = TASK_MAX_ATTEMPTS,
+                ttl_sec: float = TASK_GROUP_TTL_SEC) -> List[str]:
+        # Add the tasks of one group, returns their task ids in payload order
+        pass
+
+    @abstractmethod
+    def renew_group(self, group_id: str, ttl_sec: float = TASK_GROUP_TTL_SEC):
+        # Keep the group alive for another ttl_sec
+        pass
+
+    @abstractmethod
+    def claim(self, worker_id: str, kinds: List[str], lease_sec: float = TASK_LEASE_SEC) -> Optional[Task]:
+        pass
+
+    @abstractmethod
+    def complete(self, task: Task, result: dict):
+        pass
+
+    @abstractmethod
+    def fail(self, task: Task, error: str):
+        pass
+
+    @abstractmethod
+    def group_status(self, group_id: str) -> Dict[str, dict]:
+        # task_id -> {status, result, error, attempts} of every task of the group (payloads stay in the queue)
+        pass
+
+    @abstractmethod
+    def cancel_group(self, group_id: str):
+        pass
+
+    @abstractmethod
+    def delete_group(self, group_id: str):
+        pass
+
+    @abstractmethod
+    def stats(self) -> dict:
+        pass
+
+class SQLiteTaskQueue(TaskQueue):
+
+    # Queue in a local SQLite file - any number of worker processes on the same machine can share it
+
+    def __init__(self, db_path: Path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS tasks (
+                    task_id TEXT PRIMARY KEY,
+                    group_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    max_attempts INTEGER NOT NULL,
+                    lease_until REAL,
+                    worker TEXT,
+                    result TEXT,
+                    error TEXT,
+                    created REAL NOT NULL,
+                    expires REAL
+                )""")
+            # Queues created before groups expired lack the column
+            if 'expires' not in [row[1] for row in conn.execute("PRAGMA table_info(tasks)")]:
+                conn.execute("ALTER TABLE tasks ADD COLUMN expires REAL")
+            conn.execute("CREATE INDEX IF NOT EXISTS tasks_claim ON tasks (kind, status, created)")
+            conn.execute("CREATE INDEX IF NOT EXISTS tasks_group ON tasks (group_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS tasks_expires ON tasks (expires)")
+
+    def _connect(self) -> sqlite3.Connection:
+        # One connection per thread, transactions are started explicitly
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.db_path), timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self, fn):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers never claim the same task
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn)
+            conn.execute("COMMIT")
+            return result
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def enqueue(self, kind: str, payloads: List[dict], group_id: str, max_attempts: int = TASK_MAX_ATTEMPTS,
+                ttl_sec: float = TASK_GROUP_TTL_SEC) -> List[str]:
+        now = time.time()
+        rows = [(uuid.uuid4().hex, group_id, kind, json.dumps(payload), max_attempts, now + position * 1e-6, now + ttl_sec)
+                for position, payload in enumerate(payloads)]
+        self._transaction(lambda conn: conn.executemany(
+            "INSERT INTO tasks (task_id, group_id, kind, payload, status, max_attempts, created, expires) "
+            "VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)", rows))
+        return [row[0] for row in rows]
+
+    def renew_group(self, group_id: str, ttl_sec: float = TASK_GROUP_TTL_SEC):
+        self._transaction(lambda conn: conn.execute(
+            "UPDATE tasks SET expires = ? WHERE group_id = ?", (time.time() + ttl_sec, group_id)))
+
+    def claim(self, worker_id: str, kinds: List[str], lease_sec: float = TASK_LEASE_SEC) -> Optional[Task]:
+        marks = ",".join("?" * len(kinds))
+
+        def claim_one(conn):
+            now = time.time()
+            # Groups nobody waits for any more - their API node died, the results would never be read
+            conn.execute("DELETE FROM tasks WHERE expires < ?", (now,))
+            # Leases of crashed workers ran out - retry the task, or give up once its attempts are used
+            conn.execute("UPDATE tasks SET status = 'failed', error = 'lease expired' "
+                         "WHERE status = 'leased' AND lease_until < ? AND attempts >= max_attempts", (now,))
+            row = conn.execute(
+                f"SELECT task_id, group_id, kind, payload, attempts FROM tasks WHERE kind IN ({marks}) "
+                "AND (status = 'queued' OR (status = 'leased' AND lease_until < ?)) ORDER BY created LIMIT 1",
+                (*kinds, now)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE tasks SET status = 'leased', attempts = attempts + 1, lease_until = ?, worker = ? WHERE task_id = ?",
+                         (now + lease_sec, worker_id, row[0]))
+            return Task(row[0], row[1], row[2], json.loads(row[3]), row[4] + 1)
+
+        return self._transaction(claim_one)
+
+    def complete(self, task: Task, result: dict):
+        # A task whose lease ran out may have been claimed again, the first result wins
+        self._transaction(lambda conn: conn.execute(
+            "UPDATE tasks SET status = 'done', result = ?, lease_until = NULL WHERE task_id = ? AND status = 'leased'",
+            (json.dumps(result), task.task_id)))
+
+    def fail(self, task: Task, error: str):
+        self._transaction(lambda conn: conn.execute(
+            "UPDATE tasks SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'queued' END, "
+            "error = ?, lease_until = NULL WHERE task_id = ? AND status = 'leased'", (error, task.task_id)))
+
+    def group_status(self, group_id: str) -> Dict[str, dict]:
+        rows = self._connect().execute(
+            "SELECT task_id, status, result, error, attempts FROM tasks WHERE group_id = ?", (group_id,)).fetchall()
+        return {row[0]: {'status': row[1], 'result': json.loads(row[2]) if row[2] else None,
+                         'error': row[3], 'attempts': row[4]} for row in rows}
+
+    def cancel_group(self, group_id: str):
+        self._transaction(lambda conn: conn.execute(
+            "UPDATE tasks SET status = 'cancelled' WHERE group_id = ? AND status IN ('queued', 'leased')", (group_id,)))
+
+    def delete_group(self, group_id: str):
+        self._transaction(lambda conn: conn.execute("DELETE FROM tasks WHERE group_id = ?", (group_id,)))
+
+    def stats(self) -> dict:
+        rows = self._connect().execute("SELECT kind, status, COUNT(*) FROM tasks GROUP BY kind, status").fetchall()
+        stats = {}
+        for kind, status, count in rows:
+            stats.setdefault(kind, {})[status] = count
+        return stats
+
+class RedisTaskQueue(TaskQueue):
+
+    # Queue on a Redis server (or any server speaking its protocol) for workers on several machines
+    # Tasks are hashes, every kind has a list of queued ids and a sorted set of leases scored by their expiry
+
+    def __init__(self, url: str, prefix: str = "boardcast"):
+        import redis  # Optional dependency, only needed for this queue
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self._claim_script = self._redis.register_script(REDIS_CLAIM_SCRIPT)
+        self._cancel_script = self._redis.register_script(REDIS_CANCEL_SCRIPT)
+
+    def _key(self, *parts: str) -> str:
+        return ":".join((self.prefix,) + parts)
+
+    def enqueue(self, kind: str, payloads: List[dict], group_id: str, max_attempts: int = TASK_MAX_ATTEMPTS,
+                ttl_sec: float = TASK_GROUP_TTL_SEC) -> List[str]:
+        task_ids = [uuid.uuid4().hex for _ in payloads]
+        pipe = self._redis.pipeline()
+        pipe.zadd(self._key("groups"), {group_id: time.time() + ttl_sec})
+        for task_id, payload in zip(task_ids, payloads):
+            pipe.hset(self._key("task", task_id), mapping={
+                'group_id': group_id, 'kind': kind, 'payload': json.dumps(payload), 'status': 'queued',
+                'attempts': 0, 'max_attempts': max_attempts})
+            pipe.sadd(self._key("group", group_id), task_id)
+            pipe.rpush(self._key("queued", kind), task_id)
+        pipe.execute()
+        return task_ids
+
+    def renew_group(self, group_id: str, ttl_sec: float = TASK_GROUP_TTL_SEC):
+        self._redis.zadd(self._key("groups"), {group_id: time.time() + ttl_sec}, xx=True)
+
+    def _delete_expired_groups(self):
+        # Groups nobody waits for any more - their API node died, the results would never be read
+        for group_id in self._redis.zrangebyscore(self._key("groups"), 0, time.time()):
+            if self._redis.zrem(self._key("groups"), group_id):
+                self.delete_group(group_id)
+
+    def _requeue_expired(self, kind: str):
+        # Move tasks with an expired lease back to the queue, or fail them once their attempts are used
+        for task_id in self._redis.zrangebyscore(self._key("leased", kind), 0, time.time()):
+            if not self._redis.zrem(self._key("leased", kind), task_id):
+                continue  # Another worker handled it
+            if not self._redis.exists(self._key("task", task_id)):
+                continue  # Its group expired
+            attempts, max_attempts = self._redis.hmget(self._key("task", task_id), 'attempts', 'max_attempts')
+            if int(attempts or 0) >= int(max_attempts or 0):
+                self._redis.hset(self._key("task", task_id), mapping={'status': 'failed', 'error': 'lease expired'})
+            else:
+                self._redis.hset(self._key("task", task_id), 'status', 'queued')
+                self._redis.rpush(self._key("queued", kind), task_id)
+
+    def claim(self, worker_id: str, kinds: List[str], lease_sec: float = TASK_LEASE_SEC) -> Optional[Task]:
+        self._delete_expired_groups()
+        for kind in kinds:
+            self._requeue_expired(kind)
+            claimed = self._claim_script(keys=[self._key("queued", kind), self._key("leased", kind)],
+                                         args=[self._key("task", ""), time.time() + lease_sec, worker_id])
+            if claimed:
+                task_id, group_id, payload, attempts = claimed
+                return Task(task_id, group_id, kind, json.loads(payload), int(attempts))
+        return None
+
+    def complete(self, task: Task, result: dict):
+        if self._redis.zrem(self._key("leased", task.kind), task.task_id):
+            self._redis.hset(self._key("task", task.task_id), mapping={'status': 'done', 'result': json.dumps(result)})
+
+    def fail(self, task: Task, error: str):
+        if not self._redis.zrem(self._key("leased", task.kind), task.task_id):
+            return
+        key = self._key("task", task.task_id)
+        attempts, max_attempts = self._redis.hmget(key, 'attempts', 'max_attempts')
+        if int(attempts) >= int(max_attempts):
+            self._redis.hset(key, mapping={'status': 'failed', 'error': error})
+        else:
+            self._redis.hset(key, mapping={'status': 'queued', 'error': error})
+            self._redis.rpush(self._key("queued", task.kind), task.task_id)
+
+    def group_status(self, group_id: str) -> Dict[str, dict]:
+        status = {}
+        for task_id in self._redis.smembers(self._key("group", group_id)):
+            fields = self._redis.hmget(self._key("task", task_id), 'status', 'result', 'error', 'attempts')
+            if fields[0] is not None:
+                status[task_id] = {'status': fields[0], 'result': json.loads(fields[1]) if fields[1] else None,
+                                   'error': fields[2], 'attempts': int(fields[3])}
+        return status
+
+    def cancel_group(self, group_id: str):
+        for task_id in self._redis.smembers(self._key("group", group_id)):
+            self._cancel_script(keys=[self._key("task", task_id)], args=[self._key("leased", ""), task_id])
+
+    def delete_group(self, group_id: str):
+        task_ids = self._redis.smembers(self._key("group", group_id))
+        for task_id in task_ids:
+            kind = self._redis.hget(self._key("task", task_id), 'kind')
+            if kind is not None:
+                self._redis.zrem(self._key("leased", kind), task_id)
+        if task_ids:
+            self._redis.delete(*(self._key("task", task_id) for task_id in task_ids))
+        self._redis.delete(self._key("group", group_id))
+        self._redis.zrem(self._key("groups"), group_id)
+
+    def stats(self) -> dict:
+        kinds = [key.rsplit(":", 1)[-1] for key in self._redis.scan_iter(self._key("queued", "*"))]
+        return {kind: {'queued': self._redis.llen(self._key("queued", kind)),
+                       'leased': self._redis.zcard(self._key("leased", kind))} for kind in kinds}
+
+def make_task_queue(url: str = TASK_QUEUE_URL) -> TaskQueue:
+    # Build the queue named by a URL
+    if url.startswith("sqlite:///"):
+        return SQLiteTaskQueue(Path(url[len("sqlite:///"):]))
+    if url.startswith(("redis://", "rediss://")):
+        return RedisTaskQueue(url)
+    raise ValueError(f"Unsupported task queue URL: {url}")
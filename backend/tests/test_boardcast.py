@@ -7,18 +7,20 @@ from pathlib import Path
 from PIL import Image
 import io
 import base64
+import time
 import requests
 
 # Import the modules to test
 import sys
+import types
 sys.path.append('..')
 from app import (
     app, check_api_keys, get_optimal_workers, 
-    process_frame_with_order, process_video_frames_parallel
+    process_frame_with_order, process_video_frames_parallel, run_video_job
 )
 from process_frames import prepare_image, transcribe_image, NVIDIA_API_KEY
 from process_video_text import process_frames_with_gemini, make_api_request_with_retry, GEMINI_API_KEY
-from video_utils import check_dependencies, extract_frames_to_memory, DependencyError
+from video_utils import check_dependencies, extract_frames_to_memory, DependencyError, clear_capabilities
 
 # UNIT TESTS 
 
@@ -90,7 +92,7 @@ class TestNVIDIAOCRUnit:
     # Test NVIDIA OCR functionality with mocked API calls
     
     # Test 7: Successful NVIDIA OCR transcription (mocked)
-    @patch('requests.post')
+    @patch('requests.Session.post')
     @patch('process_frames.NVIDIA_API_KEY', 'valid_nvidia_key')
     def test_nvidia_transcribe_image_success(self, mock_post):
         # Test successful image transcription with mocked NVIDIA API response
@@ -109,7 +111,7 @@ class TestNVIDIAOCRUnit:
         mock_post.assert_called_once()
     
     # Test 8: NVIDIA API request failure
-    @patch('requests.post')
+    @patch('requests.Session.post')
     @patch('process_frames.NVIDIA_API_KEY', 'valid_nvidia_key')
     def test_nvidia_transcribe_image_api_failure(self, mock_post):
         # Test NVIDIA OCR handling when API request fails
@@ -120,7 +122,26 @@ class TestNVIDIAOCRUnit:
         
         assert "API request failed" in result
         assert "Connection error" in result
-    
+
+    # Test 81: Empty, malformed and unexpected API answers are failed frames, not board text
+    @patch('requests.Session.post')
+    @patch('process_frames.NVIDIA_API_KEY', 'valid_nvidia_key')
+    def test_nvidia_bad_answers_are_failures(self, mock_post):
+        # Test that every error message of the remote call is classified as a failure, whatever its wording
+        from process_frames import FrameResult, OCRFailure, transcribe_image_remote
+        mock_response = Mock()
+        mock_response.raise_for_status.return_value = None
+        mock_post.return_value = mock_response
+        test_image = Image.new('RGB', (100, 100), color='white')
+
+        answers = [lambda: {"choices": []}, Mock(side_effect=json.JSONDecodeError("bad", "", 0)), Mock(side_effect=KeyError("choices"))]
+        for answer in answers:
+            mock_response.json.side_effect = answer
+            result = transcribe_image_remote(test_image)
+            assert isinstance(result, OCRFailure)
+            assert not FrameResult.from_text(1, "0:00:00", result).ok
+        assert FrameResult.from_text(1, "0:00:00", "No transcription result.").ok
+
     # Test 9: NVIDIA API with no API key
     @patch('process_frames.NVIDIA_API_KEY', 'ADD_KEY_HERE')
     def test_nvidia_transcribe_image_no_api_key(self):
@@ -164,6 +185,49 @@ class TestFrameProcessing:
             assert text == "Test text"
             assert timestamp.startswith("0:0")
 
+    # Test 55: Failed frames are retried once and reported when they still fail
+    @patch('app.transcribe_image')
+    def test_failed_frames_are_retried_and_reported(self, mock_transcribe):
+        # Test that a transient failure is recovered and a persistent one is listed with its timestamp and error
+        attempts = {}
+
+        def flaky(image):
+            color = image.getpixel((0, 0))[0]
+            attempts[color] = attempts.get(color, 0) + 1
+            if color == 1 and attempts[color] == 1:
+                return "API request failed: 503 Server Error"
+            if color == 2:
+                raise TimeoutError("read timed out")
+            return f"text {color}"
+
+        mock_transcribe.side_effect = flaky
+        frames = [(i, Image.new('RGB', (10, 10), (i, 0, 0)), f"0:00:{i:02d}") for i in range(4)]
+        reported = []
+        missing = []
+
+        results = process_video_frames_parallel(frames, max_workers=2, max_retries=1, missing=missing,
+                                                on_result=lambda n, text, ts: reported.append(n))
+
+        assert results == [("text 0", "0:00:00"), ("text 1", "0:00:01"), ("text 3", "0:00:03")]
+        assert sorted(reported) == [0, 1, 2, 3]
+        assert attempts == {0: 1, 1: 2, 2: 2, 3: 1}
+        assert len(missing) == 1
+        assert missing[0]['timestamp'] == "0:00:02" and missing[0]['retries'] == 1
+        assert missing[0]['status'] == 'failed' and "read timed out" in missing[0]['error']
+
+    # Test 56: Frame results are compact records
+    def test_frame_result_classifies_text(self):
+        # Test that error texts become failed records and records carry no per-instance dict
+        from process_frames import FrameResult
+        ok = FrameResult.from_text(3, "0:01:30", "x = 1", latency=0.5)
+        failed = FrameResult.from_text(4, "0:02:00", "Failed to process image: broken")
+
+        assert ok.ok and ok.output == "x = 1" and ok.error is None
+        assert not failed.ok and failed.text == "" and failed.output == "Failed to process image: broken"
+        assert not hasattr(ok, '__dict__')
+        assert ok.to_dict() == {'frame_number': 3, 'timestamp': "0:01:30", 'status': 'ok', 'text': "x = 1",
+                                'error': None, 'latency': 0.5, 'retries': 0}
+
 
 class TestVideoProcessing:
     # Test video processing with Gemini API
@@ -224,6 +288,10 @@ class TestFlaskRoutes:
 
 class TestDependencyManagement:
     # Test system dependency checks
+
+    def setup_method(self):
+        # Every test probes the tools again
+        clear_capabilities()
     
     # Test 16: Valid dependencies
     @patch('subprocess.run')
@@ -249,6 +317,27 @@ class TestDependencyManagement:
             check_dependencies()
         assert "Missing system packages" in str(exc_info.value)
 
+    # Test 49: Tools are probed once and their capabilities cached
+    @patch('subprocess.run')
+    def test_capabilities_probed_once(self, mock_subprocess):
+        # Test that repeated dependency checks reuse the cached probe including decoders and filters
+        from video_utils import get_capabilities
+        listings = {
+            '-version': "ffmpeg version 6.0 Copyright (c) 2000-2023\nbuilt with gcc",
+            '-decoders': "Decoders:\n V..... = Video\n ------\n V....D h264                 H.264\n A....D aac                  AAC\n",
+            '-filters': "Filters:\n  T.. = Timeline support\n ... scale             V->V       Scale the input video size\n",
+        }
+        mock_subprocess.side_effect = lambda cmd, **kwargs: Mock(stdout=listings[cmd[-1]], returncode=0)
+
+        for _ in range(3):
+            check_dependencies()
+        capabilities = get_capabilities()
+
+        assert mock_subprocess.call_count == 4  # ffmpeg -version/-decoders/-filters and ffprobe -version
+        assert capabilities['ffmpeg']['version'] == "ffmpeg version 6.0 Copyright (c) 2000-2023"
+        assert capabilities['ffmpeg']['decoders'] == ['h264', 'aac']
+        assert capabilities['ffmpeg']['filters'] == ['scale']
+
 
 class TestAPIRetryLogic:
     # Test API retry mechanism
@@ -272,6 +361,1758 @@ class TestAPIRetryLogic:
         assert result == "Success"
         mock_client.models.generate_content_stream.assert_called_once()
 
+class TestResultCache:
+    # Test the persistent whole-video result store
+
+    # Test 26: Streaming hash and settings dependent keys
+    def test_cache_key_depends_on_content_and_settings(self, tmp_path):
+        # Test that the key changes with the file content and with the pipeline settings
+        from result_cache import hash_file, make_cache_key, pipeline_settings
+        video = tmp_path / "lecture.mp4"
+        video.write_bytes(b"frame-data" * 1000)
+
+        content_hash = hash_file(video, chunk_size=7)
+        assert content_hash == hash_file(video)
+
+        settings = pipeline_settings()
+        changed = {**settings, 'extract_every_sec': settings['extract_every_sec'] + 1}
+        assert make_cache_key(content_hash, settings) == make_cache_key(content_hash)
+        assert make_cache_key(content_hash, settings) != make_cache_key(content_hash, changed)
+        # Editing a prompt text changes the key without a PROMPT_VERSION bump
+        with patch('result_cache.ROLLING_INSTRUCTIONS', "Refine the notes."):
+            assert make_cache_key(content_hash) != make_cache_key(content_hash, settings)
+
+    # Test 27: Size based eviction of least recently used entries
+    def test_disk_cache_evicts_least_recently_used(self, tmp_path):
+        # Test that the oldest untouched entry is evicted once the store is full
+        from result_cache import DiskCache
+        cache = DiskCache(tmp_path, max_bytes=10_000)
+        cache.put('aa', {'text': 'x' * 4000})
+        cache.put('bb', {'text': 'y' * 4000})
+        os.utime(tmp_path / 'aa.json', (1, 1))
+        os.utime(tmp_path / 'bb.json', (2, 2))
+        assert cache.get('aa') == {'text': 'x' * 4000}  # Refreshes 'aa'
+        cache.put('cc', {'text': 'z' * 4000})
+
+        assert cache.get('bb') is None
+        assert cache.get('aa') is not None
+        assert cache.stats()['evictions'] == 1
+
+    # Test 28: Upload returns the stored transcript on a hit
+    @patch('app.check_api_keys', return_value=(True, ''))
+    @patch('app.extract_frames_to_memory')
+    def test_upload_returns_cached_result(self, mock_extract, mock_keys, tmp_path):
+        # Test that a repeated video upload is answered from the store without reprocessing
+        from result_cache import DiskCache
+        from stage_store import StageStore
+        from checkpoints import CheckpointStore
+        from search_index import SearchIndex
+        cache = DiskCache(tmp_path / "results", max_bytes=1_000_000)
+        app.config['TESTING'] = True
+        with patch('app.get_result_cache', return_value=cache), \
+             patch('app.get_search_index', return_value=SearchIndex(tmp_path / "search.db")), \
+             patch('app.get_stage_store', return_value=StageStore(tmp_path / "stages", max_bytes=1_000_000)), \
+             patch('app.get_checkpoints', return_value=CheckpointStore(tmp_path / "checkpoints.db")), \
+             patch('checkpoints.SPOOL_DIR', tmp_path / "spool"), \
+             patch('app.process_video_frames_parallel', return_value=[("x = 1", "0:00:00")]), \
+             patch('app.process_frames_with_gemini', return_value="[0:00:00] x = 1"), \
+             patch('app.ADMIN_TOKEN', 'secret'):
+            mock_extract.return_value = [(0, Image.new('RGB', (10, 10)), "0:00:00")]
+            with app.test_client() as client:
+                first = client.post('/upload', data={'file': (io.BytesIO(b'video'), 'a.mp4')})
+                second = client.post('/upload', data={'file': (io.BytesIO(b'video'), 'b.mp4')})
+                listing = client.get('/admin/cache', headers={'X-Admin-Token': 'secret'})
+
+        assert first.status_code == 200 and 'cached' not in first.get_json()
+        assert second.get_json()['cached'] is True
+        assert second.get_json()['text'] == first.get_json()['text'] == "[0:00:00] x = 1"
+        assert mock_extract.call_count == 1
+        assert listing.get_json()['stats']['entries'] == 1
+
+    # Test 74: Admin endpoints are disabled without a token and a failed Gemini pass is not stored
+    @patch('app.check_api_keys', return_value=(True, ''))
+    def test_admin_endpoints_fail_closed(self, mock_keys, tmp_path):
+        # Test the admin responses with and without ADMIN_TOKEN, and that a Gemini error never reaches the result cache
+        from result_cache import DiskCache
+        from stage_store import StageStore
+        from checkpoints import CheckpointStore
+        cache = DiskCache(tmp_path / "results", max_bytes=1_000_000)
+        cache.put('aa', {'text': 'x'})
+        app.config['TESTING'] = True
+        with patch('app.get_result_cache', return_value=cache), app.test_client() as client:
+            with patch('app.ADMIN_TOKEN', ''):
+                assert client.get('/admin/cache').status_code == 404
+                assert client.delete('/admin/cache', headers={'X-Admin-Token': ''}).status_code == 404
+            with patch('app.ADMIN_TOKEN', 'secret'):
+                assert client.delete('/admin/cache', headers={'X-Admin-Token': 'wrong'}).status_code == 401
+                assert cache.stats()['entries'] == 1
+                assert client.delete('/admin/cache', headers={'X-Admin-Token': 'secret'}).get_json() == {'removed': 1}
+
+            with patch('app.get_stage_store', return_value=StageStore(tmp_path / "stages", max_bytes=1_000_000)), \
+                 patch('app.get_checkpoints', return_value=CheckpointStore(tmp_path / "checkpoints.db")), \
+                 patch('checkpoints.SPOOL_DIR', tmp_path / "spool"), \
+                 patch('app.extract_frames_to_memory', return_value=[(0, Image.new('RGB', (10, 10)), "0:00:00")]), \
+                 patch('app.process_video_frames_parallel', return_value=[("x = 1", "0:00:00")]), \
+                 patch('app.REFINE_FALLBACK', False), \
+                 patch('app.process_frames_with_gemini', return_value="An unexpected error occurred: 503 UNAVAILABLE"):
+                response = client.post('/upload', data={'file': (io.BytesIO(b'video'), 'a.mp4')})
+        assert response.get_json()['text'].startswith("An unexpected error occurred")
+        assert cache.stats()['entries'] == 0
+
+class TestStageStore:
+    # Test incremental re-processing with stored stage artifacts
+
+    def run_pipeline(self, store, frames, ocr_results, refined):
+        # Run the video stages against a temporary store, returns the mocks for each stage
+        from app import load_video_frames, ocr_video_frames, refine_frame_data
+        with patch('app.get_stage_store', return_value=store), \
+             patch('app.extract_frames_to_memory', return_value=frames) as mock_extract, \
+             patch('app.process_video_frames_parallel', side_effect=lambda pending, **kwargs: [r for r in ocr_results if r[1] in {f[2] for f in pending}]) as mock_ocr, \
+             patch('app.process_frames_with_gemini', return_value=refined) as mock_gemini:
+            loaded = load_video_frames(Path('lecture.mp4'), 'abc')
+            frame_data = ocr_video_frames(Path('lecture.mp4'), 'abc', loaded)
+            text = refine_frame_data(frame_data)
+        return text, mock_extract, mock_ocr, mock_gemini
+
+    # Test 29: Prompt change only reruns the Gemini pass
+    def test_prompt_change_reuses_frames_and_ocr(self, tmp_path):
+        # Test that a changed Gemini prompt reuses the stored frames and OCR texts
+        from stage_store import StageStore
+        store = StageStore(tmp_path, max_bytes=10_000_000)
+        frames = [(i, Image.new('RGB', (20, 20)), f"0:00:{i * 30:02d}") for i in range(2)]
+        ocr_results = [("a", "0:00:00"), ("b", "0:00:30")]
+
+        text, mock_extract, mock_ocr, _ = self.run_pipeline(store, frames, ocr_results, "v1")
+        assert text == "v1" and mock_extract.call_count == 1 and mock_ocr.call_count == 1
+
+        with patch('stage_store.GEMINI_INSTRUCTIONS', 'changed prompt'):
+            text, mock_extract, mock_ocr, mock_gemini = self.run_pipeline(store, frames, ocr_results, "v2")
+        assert text == "v2"
+        mock_extract.assert_not_called()
+        mock_ocr.assert_not_called()
+        mock_gemini.assert_called_once_with(ocr_results)
+
+    # Test 30: Sampling interval change only OCRs the new timestamps
+    def test_interval_change_reuses_matching_timestamps(self, tmp_path):
+        # Test that frames on timestamps already transcribed are not sent to the OCR API again
+        from stage_store import StageStore
+        store = StageStore(tmp_path, max_bytes=10_000_000)
+        frames = [(0, Image.new('RGB', (20, 20)), "0:00:00"), (1, Image.new('RGB', (20, 20)), "0:00:30")]
+        self.run_pipeline(store, frames, [("a", "0:00:00"), ("b", "0:00:30")], "v1")
+
+        denser = [(i, Image.new('RGB', (20, 20)), f"0:00:{i * 15:02d}") for i in range(3)]
+        with patch('stage_store.EXTRACT_EVERY_SEC', 15):
+            _, mock_extract, mock_ocr, _ = self.run_pipeline(
+                store, denser, [("a", "0:00:00"), ("a2", "0:00:15"), ("b", "0:00:30")], "v2")
+        mock_extract.assert_called_once()
+        assert [f[2] for f in mock_ocr.call_args[0][0]] == ["0:00:15"]
+
+class TestLiveStream:
+    # Test live source ingestion with incremental transcription
+
+    # Test 31: Unchanged frames are skipped and latency is reported
+    def test_live_session_dedups_and_reports_latency(self):
+        # Test that a repeated board frame is not transcribed and every update carries its latency
+        from live_stream import LiveSession, sse_events
+        board_a = Image.new('RGB', (100, 100), color='white')
+        board_b = Image.new('RGB', (100, 100), color='black')
+
+        def frames():
+            for image in (board_a, board_a, board_b):
+                yield image
+                time.sleep(0.05)
+
+        session = LiveSession("board.mp4", every_sec=5, frame_source=frames,
+                              transcribe=lambda image: "x" if image.getpixel((0, 0)) == (255, 255, 255) else "y")
+        session.start()
+        events = list(sse_events(session))
+        session.join(timeout=5)
+
+        status = session.status()
+        assert status['frames_captured'] == 3
+        assert status['duplicates_skipped'] == 1
+        assert [u['text'] for u in session.updates] == ["x", "y"]
+        assert [u['timestamp'] for u in session.updates] == ["0:00:00", "0:00:10"]
+        assert status['latency']['samples'] == 2 and status['latency']['max_sec'] >= 0
+        assert events[-1].startswith("event: end")
+
+    # Test 32: ffmpeg reads raw frames from a looping source
+    @patch('live_stream.subprocess.Popen')
+    def test_iter_stream_frames_reads_raw_frames(self, mock_popen):
+        # Test that fixed size raw frames are cut from the ffmpeg pipe and looping replays in real time
+        from live_stream import iter_stream_frames
+        from video_utils import FRAME_SIZE
+        process = Mock()
+        process.stdout = io.BytesIO(bytes(FRAME_SIZE * FRAME_SIZE * 3) * 2)
+        process.stderr = io.BytesIO(b"")
+        process.poll.return_value = 0
+        process.returncode = 0
+        mock_popen.return_value = process
+
+        frames = list(iter_stream_frames("board.mp4", every_sec=2, loop=True))
+
+        assert len(frames) == 2 and frames[0].size == (FRAME_SIZE, FRAME_SIZE)
+        cmd = mock_popen.call_args[0][0]
+        assert cmd[cmd.index("-stream_loop") + 1] == "-1" and "-re" in cmd
+        assert "fps=1/2" in cmd[cmd.index("-vf") + 1]
+
+    # Test 75: Only allowed stream URLs are ingested, ffmpeg errors are reported and sessions are bounded
+    @patch('live_stream.LIVE_ALLOWED_HOSTS', {'media.example.edu'})
+    @patch('live_stream.subprocess.Popen')
+    def test_live_sources_are_restricted_and_bounded(self, mock_popen):
+        # Test the source allowlist, the admin guard, the ffmpeg error tail and the session and update limits
+        from admission import AdmissionRejected
+        from live_stream import validate_live_source, LiveSession, LiveSessionRegistry
+        assert validate_live_source("rtmp://media.example.edu/live/board") == "rtmp://media.example.edu/live/board"
+        for source in ("/etc/passwd", "file:///etc/passwd", "concat:a.mp4|b.mp4", "lavfi:testsrc",
+                       "http://169.254.169.254/latest", "https://media.example.edu.evil.com/x.m3u8"):
+            with pytest.raises(ValueError):
+                validate_live_source(source)
+
+        with app.test_client() as client:
+            with patch('app.ADMIN_TOKEN', ''):
+                assert client.post('/live/start', json={'source': "rtmp://media.example.edu/x"}).status_code == 404
+            with patch('app.ADMIN_TOKEN', 'secret'), patch('app.check_api_keys', return_value=(True, '')):
+                response = client.post('/live/start', json={'source': "/dev/video0"}, headers={'X-Admin-Token': 'secret'})
+                assert response.status_code == 400
+
+        process = Mock()
+        process.stdout = io.BytesIO(b"")
+        process.stderr = io.BytesIO(b"rtmp://media.example.edu/x: Connection refused\n")
+        process.poll.return_value = 1
+        process.returncode = 1
+        mock_popen.return_value = process
+        session = LiveSession("rtmp://media.example.edu/x", transcribe=lambda image: "x")
+        session.start()
+        session.join(timeout=5)
+        assert "Connection refused" in session.status()['error']
+        assert "-protocol_whitelist" in mock_popen.call_args[0][0]
+
+        def boards():
+            for i in range(4):
+                yield Image.new('RGB', (20, 20), (i * 60, 0, 0))
+                time.sleep(0.05)
+
+        session = LiveSession("board", frame_source=boards, transcribe=lambda image: "x", max_updates=2)
+        registry = LiveSessionRegistry(max_running=1, ttl_sec=0)
+        registry.add(session)
+        with pytest.raises(AdmissionRejected):
+            registry.add(LiveSession("other", frame_source=lambda: iter([])))
+        session.start()
+        session.join(timeout=5)
+        assert session.status()['updates'] == 4 and len(session.updates) == 2
+        assert session.updates[-1]['seq'] == session.status()['updates'] - 1
+        time.sleep(0.01)
+        assert registry.get(session.session_id) is None
+
+    # Test 88: A live session over the session limit is refused like an overloaded upload
+    @patch('live_stream.LIVE_ALLOWED_HOSTS', {'media.example.edu'})
+    @patch('live_stream.check_dependencies')
+    def test_live_session_limit_answers_503(self, mock_dependencies):
+        # Test that a full registry gives 503 with Retry-After instead of a server error
+        from live_stream import LiveSessionRegistry
+        with app.test_client() as client, patch('live_stream.live_sessions', LiveSessionRegistry(max_running=0)), \
+             patch('app.ADMIN_TOKEN', 'secret'), patch('app.check_api_keys', return_value=(True, '')):
+            response = client.post('/live/start', json={'source': "rtmp://media.example.edu/x"}, headers={'X-Admin-Token': 'secret'})
+
+        assert response.status_code == 503 and response.headers['Retry-After'] == "60"
+        assert 'Too many live sessions' in response.get_json()['error']
+
+class TestRollingRefinement:
+    # Test rolling Gemini refinement while frames are still being transcribed
+
+    # Test 33: Each batch only carries a bounded tail of the notes
+    @patch('process_video_text.GEMINI_API_KEY', 'valid_key')
+    def test_rolling_refiner_bounds_context(self):
+        # Test that prompts stay bounded while the transcript keeps growing
+        from process_video_text import RollingRefiner
+        prompts = []
+
+        def fake_request(prompt):
+            prompts.append(prompt)
+            return f"[0:00:{len(prompts):02d}] " + "note " * 20
+
+        refiner = RollingRefiner(batch_frames=2, context_chars=120, request=fake_request)
+        for i in range(7):
+            refiner.add_frames([(f"line {i}", f"0:00:{i:02d}")])
+        assert len(prompts) == 3  # Three full batches, one frame still pending
+        final = refiner.flush()
+
+        assert len(prompts) == 4
+        assert final.count("note") == 80
+        assert "Frame 7 [Timestamp: 0:00:06]" in prompts[-1]
+        # The existing notes section never grows past the context limit
+        tails = [p.split("**Existing Notes (end):**\n")[1].split("\n\n**New OCR Frames:**")[0] for p in prompts]
+        assert all(len(tail) <= 120 for tail in tails)
+
+    # Test 34: Out of order frames reach the refiner in chronological order
+    @patch('process_video_text.GEMINI_API_KEY', 'valid_key')
+    def test_frame_progress_feeds_refiner_in_order(self):
+        # Test that partial notes are published as soon as a chronological prefix of frames is done
+        from app import track_frame_progress
+        from jobs import Job
+        from process_video_text import RollingRefiner
+        refiner = RollingRefiner(batch_frames=1, request=lambda prompt: prompt.rsplit("]:\n", 1)[1].split("\n")[0])
+        job = Job("job-1")
+        frames = [(i, None, f"0:00:{i:02d}") for i in range(3)]
+        on_result = track_frame_progress(frames, job, refiner)
+
+        on_result(1, "second", "0:00:01")
+        assert job.partial_text == "" and job.frames_done == 1
+        on_result(0, "first", "0:00:00")
+        assert job.partial_text == "first\n\nsecond"
+        on_result(2, "API request failed: timeout", "0:00:02")
+        assert job.partial_text == "first\n\nsecond" and job.frames_done == 3
+
+class FakeEngine:
+    # OCR engine stub returning a fixed text
+    def __init__(self, name, text, local):
+        self.name, self.text, self.local, self.calls = name, text, local, 0
+
+    def available(self):
+        return True
+
+    def transcribe(self, image_input):
+        self.calls += 1
+        return self.text
+
+
+class TestOCREngines:
+    # Test pluggable OCR backends and routing policies
+
+    # Test 35: Local-first falls back to the remote engine on an empty local result
+    def test_local_first_falls_back_to_remote(self):
+        # Test that an almost empty local result is retried with the remote engine
+        from ocr_engines import OCRRouter
+        local = FakeEngine('tesseract', ' ', local=True)
+        remote = FakeEngine('nvidia', 'x^2 + 1', local=False)
+        router = OCRRouter({'nvidia': remote, 'tesseract': local}, policy='local-first')
+
+        assert router.transcribe(Image.new('RGB', (10, 10))) == 'x^2 + 1'
+        stats = router.stats()['engines']
+        assert stats['tesseract']['failures'] == 1
+        assert stats['nvidia']['fallbacks'] == 1
+
+    # Test 36: Remote-first keeps working offline through the local engine
+    @patch('requests.Session.post', side_effect=requests.exceptions.ConnectionError("Network is unreachable"))
+    @patch('process_frames.NVIDIA_API_KEY', 'valid_nvidia_key')
+    def test_remote_first_falls_back_to_local_when_offline(self, mock_post):
+        # Test that transcribe_image returns the local text when the NVIDIA API cannot be reached
+        from ocr_engines import OCRRouter, NvidiaEngine
+        local = FakeEngine('tesseract', 'lim x->0', local=True)
+        router = OCRRouter({'nvidia': NvidiaEngine(), 'tesseract': local}, policy='remote-first')
+
+        with patch('ocr_engines.ocr_router', router):
+            assert transcribe_image(Image.new('RGB', (10, 10))) == 'lim x->0'
+        mock_post.assert_called_once()
+        assert local.calls == 1
+
+    # Test 76: Stored OCR texts and transcripts are kept apart per engine policy, offline fallbacks are not stored
+    @patch('app.QUALITY_GATING', False)
+    def test_engine_policy_keys_and_fallback_texts(self, tmp_path):
+        # Test the OCR stage key per policy, the abstract engine interface and that fallback texts skip both stores
+        from ocr_engines import OCRRouter, OCREngine
+        from app import process_video_upload
+        from jobs import Job
+        from result_cache import DiskCache, pipeline_settings
+        from stage_store import StageStore
+        with pytest.raises(TypeError):
+            OCREngine()
+
+        store = StageStore(tmp_path / "stages", max_bytes=10_000_000)
+        remote_key = store._ocr_key('abc', "0:00:00")
+        remote_settings = pipeline_settings()
+        offline = OCRRouter({'nvidia': FakeEngine('nvidia', 'API request failed: offline', local=False),
+                             'tesseract': FakeEngine('tesseract', 'lim x->0', local=True)}, policy='remote-first')
+        with patch('ocr_engines.ocr_router', offline):
+            assert store._ocr_key('abc', "0:00:00") != remote_key
+            assert pipeline_settings() != remote_settings
+            assert transcribe_image(Image.new('RGB', (10, 10))).engine == 'tesseract'
+
+            video = tmp_path / "lecture.mp4"
+            video.write_bytes(b"video")
+            cache = DiskCache(tmp_path / "results", max_bytes=1_000_000)
+            with patch('app.get_result_cache', return_value=cache), patch('app.get_stage_store', return_value=store), patch('app.index_transcript'), \
+                 patch('app.extract_frames_to_memory', return_value=[(0, Image.new('RGB', (10, 10)), "0:00:00")]), \
+                 patch('app.process_frames_with_gemini', return_value="notes"):
+                payload, status = process_video_upload(video, "lecture.mp4", Job(f"policy-{time.time_ns()}"), "full", "hash-offline")
+            assert status == 200 and payload['fallback_frames'] == 1
+            assert cache.stats()['entries'] == 0
+            assert store.load_ocr("hash-offline", "0:00:00") is None
+
+    @staticmethod
+    def board_frame(lines: int) -> Image.Image:
+        # Whiteboard frame with the given number of written lines
+        from PIL import ImageDraw, ImageFont
+        image = Image.new('RGB', (800, 800), 'white')
+        draw = ImageDraw.Draw(image)
+        for row in range(lines):
+            draw.text((20, 20 + row * 42), "f(x) = (x^2 + 3x - 1) / (2x + 5) + y" if lines > 1 else "x = 2",
+                      fill='black', font=ImageFont.load_default(size=40))
+        return image
+
+    # Test 68: Simple frames use the fast model, complex frames the large one, with per-route cost
+    def test_routed_policy_by_complexity(self):
+        # Test that the route follows the ink and edge density of the frame
+        from ocr_engines import OCRRouter
+        from process_frames import frame_complexity, choose_route
+        simple, dense = self.board_frame(1), self.board_frame(18)
+        assert choose_route(frame_complexity(simple)) == 'simple' and choose_route(frame_complexity(dense)) == 'complex'
+
+        fast = FakeEngine('nvidia-fast', 'x = 2', local=False)
+        fast.cost = 0.25
+        large = FakeEngine('nvidia', 'dense notes', local=False)
+        router = OCRRouter({'nvidia': large}, policy='routed', fast_engine=fast)
+
+        assert router.transcribe(simple) == 'x = 2'
+        assert router.transcribe(dense) == 'dense notes'
+        assert fast.calls == 1 and large.calls == 1
+        routes = router.stats()['routes']
+        assert routes['simple']['frames'] == 1 and routes['simple']['cost'] == 0.25 and routes['simple']['escalations'] == 0
+        assert routes['complex']['cost'] == 1.0
+
+    # Test 69: Empty or low-confidence fast results are escalated to the large model
+    @patch('process_frames.ROUTE_MIN_CHARS_PER_INK', 100000)
+    def test_routed_policy_escalates(self):
+        # Test that a too short fast answer for the ink on the frame is retried with the large model
+        from ocr_engines import OCRRouter
+        fast = FakeEngine('nvidia-fast', 'x', local=False)
+        large = FakeEngine('nvidia', 'x = 2', local=False)
+        router = OCRRouter({'nvidia': large}, policy='routed', fast_engine=fast)
+
+        assert router.transcribe(self.board_frame(1)) == 'x = 2'
+        fast.text = 'Failed to process image: timeout'
+        assert router.transcribe(self.board_frame(1)) == 'x = 2'
+        stats = router.stats()
+        assert stats['routes']['simple']['escalations'] == 2 and stats['routes']['simple']['cost'] == 4.0
+        assert stats['engines']['nvidia-fast']['failures'] == 2 and stats['engines']['nvidia']['fallbacks'] == 2
+
+    # Test 86: Routed texts are stored per fast model and routing thresholds
+    def test_routed_settings_key_the_texts(self, tmp_path):
+        # Test that changing the route thresholds or the fast model gives new OCR stage and result cache keys
+        from ocr_engines import OCRRouter, ocr_settings
+        from result_cache import pipeline_settings
+        from stage_store import StageStore
+        store = StageStore(tmp_path / "stages", max_bytes=1_000_000)
+        router = OCRRouter({'nvidia': FakeEngine('nvidia', 'x', local=False)}, policy='routed',
+                           fast_engine=FakeEngine('nvidia-fast', 'x', local=False))
+        with patch('ocr_engines.ocr_router', router):
+            key, settings = store._ocr_key("abc", "0:00:00"), pipeline_settings()
+            assert ocr_settings()['routing']['simple_engine'] == 'fast-model'
+            for name, value in (('ROUTE_SIMPLE_MAX_INK', 0.5), ('ROUTE_SIMPLE_MAX_EDGES', 0.5),
+                                ('ROUTE_MIN_CHARS_PER_INK', 1), ('FAST_MODEL_NAME', 'other/model')):
+                with patch(f'process_frames.{name}', value):
+                    assert store._ocr_key("abc", "0:00:00") != key and pipeline_settings() != settings
+            with patch('ocr_engines.ROUTE_SIMPLE_ENGINE', 'local'):
+                assert store._ocr_key("abc", "0:00:00") != key
+
+class TestHedging:
+    # Test hedged OCR requests for slow frames
+
+    # Test 38: A slow request is duplicated and the faster answer wins
+    def test_slow_request_is_hedged(self):
+        # Test that a duplicate request is sent after the percentile deadline and its answer is returned
+        from hedging import Hedger, HedgeBudget
+        hedger = Hedger(max_workers=4, min_samples=3, min_delay=0.01, budget=HedgeBudget(ratio=0, burst=1))
+        for latency in (0.01, 0.01, 0.02):
+            hedger.request_latencies.record(latency)
+        calls = []
+
+        def ocr(image):
+            calls.append(image)
+            if len(calls) == 1:
+                time.sleep(0.5)
+                return "slow"
+            return "fast"
+
+        start = time.perf_counter()
+        assert hedger.call(ocr, "frame") == "fast"
+        assert time.perf_counter() - start < 0.4
+        stats = hedger.stats()
+        assert stats['hedged_requests'] == 1 and stats['hedge_wins'] == 1
+
+    # Test 39: The global budget caps duplicate requests
+    def test_hedge_budget_caps_extra_requests(self):
+        # Test that once the budget is used up slow requests are simply awaited
+        from hedging import Hedger, HedgeBudget
+        hedger = Hedger(max_workers=4, min_samples=1, min_delay=0.01, budget=HedgeBudget(ratio=0, burst=1))
+        for _ in range(100):
+            hedger.request_latencies.record(0.01)
+        slow_ocr = lambda image: time.sleep(0.05) or "text"
+
+        results = [hedger.call(slow_ocr, i) for i in range(3)]
+
+        assert results == ["text"] * 3
+        stats = hedger.stats()
+        assert stats['hedged_requests'] == 1 and stats['budget_denied'] == 2
+        assert stats['extra_request_rate'] == pytest.approx(1 / 3)
+
+    # Test 77: Queue time does not count towards the deadline and a cancelled job stops waiting
+    def test_hedge_deadline_starts_with_the_request(self):
+        # Test that primaries queued behind each other are not hedged, and that cancellation ends a hedged call
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        from hedging import Hedger, HedgeBudget
+        from jobs import JobCancelled
+        hedger = Hedger(max_workers=1, min_samples=1, min_delay=0.15, budget=HedgeBudget(ratio=1, burst=10))
+        hedger.request_latencies.record(0.01)
+        steady_ocr = lambda image: time.sleep(0.1) or "text"
+
+        with ThreadPoolExecutor(max_workers=3) as callers:
+            results = list(callers.map(lambda i: hedger.call(steady_ocr, i), range(3)))
+        assert results == ["text"] * 3
+        assert hedger.stats()['hedged_requests'] == 0
+
+        cancel_event = threading.Event()
+        threading.Timer(0.05, cancel_event.set).start()
+        start = time.perf_counter()
+        with pytest.raises(JobCancelled):
+            hedger.call(lambda image: time.sleep(1) or "late", "frame", cancel_event)
+        assert time.perf_counter() - start < 0.8
+
+class TestCancellation:
+    # Test cooperative cancellation of running jobs
+
+    # Test 40: Cancelling drops frames that have not started
+    @patch('app.transcribe_image')
+    def test_cancel_stops_pending_frames(self, mock_transcribe):
+        # Test that a cancelled job stops without transcribing the queued frames
+        import threading
+        from jobs import JobCancelled
+        cancel_event = threading.Event()
+
+        def slow_transcribe(image):
+            cancel_event.set()
+            time.sleep(0.1)
+            return "text"
+
+        mock_transcribe.side_effect = slow_transcribe
+        frames = [(i, Image.new('RGB', (10, 10)), f"0:00:{i:02d}") for i in range(20)]
+
+        start = time.perf_counter()
+        with pytest.raises(JobCancelled):
+            process_video_frames_parallel(frames, max_workers=2, cancel_event=cancel_event)
+        assert time.perf_counter() - start < 2.0
+        time.sleep(0.3)
+        assert mock_transcribe.call_count <= 4
+
+    # Test 41: A closed client connection cancels the job
+    def test_client_disconnect_cancels_job(self):
+        # Test that the disconnect watcher cancels the job once the client socket is closed
+        import socket
+        import threading
+        from jobs import Job, watch_client_disconnect
+        server_side, client_side = socket.socketpair()
+        job = Job("upload-1")
+        done = threading.Event()
+        watcher = watch_client_disconnect(server_side, job, done, interval=0.05)
+
+        time.sleep(0.1)
+        assert not job.cancelled
+        client_side.close()
+        watcher.join(timeout=2)
+        server_side.close()
+
+        assert job.cancelled and job.cancel_reason == 'client disconnected'
+        job.finish(error='Job cancelled')
+        assert job.status == 'cancelled'
+
+def make_board_image(lines=8):
+    # Whiteboard frame with dark handwriting-like text lines
+    from PIL import ImageDraw, ImageFont
+    img = Image.new('RGB', (800, 800), (235, 235, 230))
+    draw = ImageDraw.Draw(img)
+    font = ImageFont.load_default(size=28)
+    for i in range(lines):
+        draw.text((40, 40 + i * 60), f"f(x) = x^{i} + 3x - {i}", fill=(20, 20, 60), font=font)
+    return img
+
+
+class TestFrameQuality:
+    # Test frame quality gating before OCR
+
+    # Test 42: Blank, blurred and occluded frames are recognized
+    def test_classify_frames(self):
+        # Test the quality labels of typical lecture frames
+        from PIL import ImageDraw, ImageFilter
+        from frame_quality import score_frame, classify_frame
+        board = make_board_image()
+        occluded = board.copy()
+        ImageDraw.Draw(occluded).rectangle((200, 100, 600, 800), fill=(60, 40, 30))
+
+        assert classify_frame(score_frame(board)) == 'ok'
+        assert classify_frame(score_frame(Image.new('RGB', (800, 800), (235, 235, 230)))) == 'blank'
+        assert classify_frame(score_frame(board.filter(ImageFilter.GaussianBlur(5)))) == 'blurred'
+        assert classify_frame(score_frame(occluded)) == 'occluded'
+
+    # Test 43: Bad frames are deferred to the next good frame
+    def test_gate_frames_defers_to_good_neighbor(self):
+        # Test that bad frames before a good one are skipped, trailing blanks dropped, and stats reported
+        from PIL import ImageFilter
+        board = make_board_image()
+        blank = Image.new('RGB', (800, 800), (235, 235, 230))
+        blurred = board.filter(ImageFilter.GaussianBlur(5))
+        frames = [(0, blank, "0:00:00"), (1, blurred, "0:00:30"), (2, board, "0:01:00"),
+                  (3, blurred, "0:01:30"), (4, blank, "0:02:00")]
+
+        from frame_quality import gate_frames
+        kept, stats = gate_frames(frames)
+
+        assert [f[0] for f in kept] == [2, 3]
+        assert stats['deferred'] == 1 and stats['dropped'] == 2
+        assert stats['blank'] == 2 and stats['blurred'] == 2 and stats['kept'] == 2
+
+    # Test 78: A bad frame is only deferred to a close good frame and gating is part of the cache keys
+    def test_gate_frames_defers_only_to_close_neighbor(self):
+        # Test that soft frames far from the only sharp frame are kept, and that enabling gating changes the keys
+        from PIL import ImageFilter
+        from frame_quality import gate_frames
+        from result_cache import pipeline_settings
+        from stage_store import StageStore
+        board = make_board_image()
+        soft = board.filter(ImageFilter.GaussianBlur(5))
+        frames = [(i, soft, f"0:0{i}:00") for i in range(4)] + [(4, board, "0:04:00")]
+
+        kept, stats = gate_frames(frames)
+        assert [f[0] for f in kept] == [0, 1, 2, 4] and stats['deferred'] == 1
+        assert [f[0] for f in gate_frames(frames, defer_frames=2)[0]] == [0, 1, 4]
+
+        store = StageStore(Path(tempfile.mkdtemp()), max_bytes=1_000_000)
+        ungated_key, ungated_settings = store._ocr_key('abc', "0:00:00"), pipeline_settings()
+        with patch('frame_quality.QUALITY_GATING', True):
+            assert store._ocr_key('abc', "0:00:00") != ungated_key
+            assert pipeline_settings()['quality_gating']['defer_frames'] == 1
+        assert ungated_settings['quality_gating'] == {}
+
+class TestCheckpoints:
+    # Test checkpointed jobs that resume after a restart
+
+    # Test 44: Checkpointed frames and unfinished jobs survive a reopen
+    def test_checkpoint_store_roundtrip(self, tmp_path):
+        # Test that frames and running jobs are read back from a new connection and dropped once the job finishes
+        from checkpoints import CheckpointStore
+        store = CheckpointStore(tmp_path / "checkpoints.db")
+        store.start_job("job-1", tmp_path / "job-1.mp4", "lecture.mp4", "full")
+        store.save_frame("job-1", "video-1", 0, "0:00:00", "x = 1")
+        store.save_frame("job-1", "video-1", 2, "0:00:10", "y = 2")
+
+        reopened = CheckpointStore(tmp_path / "checkpoints.db")
+        assert reopened.load_frames("job-1", "video-1") == {0: ("x = 1", "0:00:00"), 2: ("y = 2", "0:00:10")}
+        assert reopened.load_frames("job-1", "video-2") == {}
+        assert [entry['job_id'] for entry in reopened.unfinished_jobs()] == ["job-1"]
+
+        reopened.finish_job("job-1", "done")
+        assert reopened.load_frames("job-1", "video-1") == {}
+        assert reopened.unfinished_jobs() == []
+
+    # Test 45: A resumed job only transcribes the frames it had not finished
+    @patch('app.extract_frames_to_memory')
+    def test_resumed_job_skips_checkpointed_frames(self, mock_extract, tmp_path):
+        # Test that a job interrupted after two frames only sends the third frame to OCR
+        from checkpoints import CheckpointStore
+        from result_cache import DiskCache
+        from stage_store import StageStore
+        from jobs import Job
+        store = CheckpointStore(tmp_path / "checkpoints.db")
+        video = tmp_path / "job-2.mp4"
+        video.write_bytes(b'video')
+        store.start_job("job-2", video, "lecture.mp4", "full")
+        from result_cache import hash_file
+        store.save_frame("job-2", hash_file(video), 0, "0:00:00", "a")
+        store.save_frame("job-2", hash_file(video), 1, "0:00:05", "b")
+        mock_extract.return_value = [(i, Image.new('RGB', (10, 10)), f"0:00:{i * 5:02d}") for i in range(3)]
+
+        def fake_parallel(pending, on_result=None, **kwargs):
+            on_result(2, "c", "0:00:10")
+            return [("c", "0:00:10")]
+
+        job = Job("job-2")
+        with patch('app.get_checkpoints', return_value=store), \
+             patch('app.get_stage_store', return_value=StageStore(tmp_path / "stages", max_bytes=1_000_000)), \
+             patch('app.get_result_cache', return_value=DiskCache(tmp_path / "results", max_bytes=1_000_000)), \
+             patch('app.index_transcript'), \
+             patch('app.QUALITY_GATING', False), \
+             patch('app.process_video_frames_parallel', side_effect=fake_parallel) as mock_parallel, \
+             patch('app.process_frames_with_gemini', side_effect=lambda frame_data: " ".join(t for t, _ in frame_data)):
+            payload, status = run_video_job(video, "lecture.mp4", job, "full")
+
+        assert status == 200 and payload['text'] == "a b c"
+        assert [frame[0] for frame in mock_parallel.call_args[0][0]] == [2]
+        assert job.status == 'done' and job.frames_done == 3
+        assert store.unfinished_jobs() == [] and not video.exists()
+
+    # Test 79: Checkpoints never leak into another video, an uncheckpointed run or the job table forever
+    @patch('app.QUALITY_GATING', False)
+    def test_checkpoints_are_scoped_to_the_video(self, tmp_path):
+        # Test a reused job id with a new video, a direct process_video_upload call and the pruning of finished jobs
+        from checkpoints import CheckpointStore
+        from result_cache import DiskCache
+        from stage_store import StageStore
+        from app import process_video_upload
+        from jobs import Job
+        store = CheckpointStore(tmp_path / "checkpoints.db", job_ttl_sec=0)
+        video = tmp_path / "job-3.mp4"
+        video.write_bytes(b'second video')
+        # A crashed job of another video left a frame under the same id
+        store.start_job("job-3", tmp_path / "old.mp4", "old.mp4", "full")
+        store.save_frame("job-3", "hash-of-old-video", 0, "0:00:00", "stale text")
+
+        frames = [(0, Image.new('RGB', (10, 10)), "0:00:00")]
+        with patch('app.get_checkpoints', return_value=store), \
+             patch('app.get_stage_store', return_value=StageStore(tmp_path / "stages", max_bytes=1_000_000)), \
+             patch('app.get_result_cache', return_value=DiskCache(tmp_path / "results", max_bytes=1_000_000)), \
+             patch('app.extract_frames_to_memory', return_value=frames), \
+             patch('app.transcribe_image', return_value="fresh text"), \
+             patch('app.index_transcript'), \
+             patch('app.process_frames_with_gemini', side_effect=lambda frame_data: " ".join(t for t, _ in frame_data)):
+            direct, _ = process_video_upload(video, "lecture.mp4", Job("job-4"), "full", "hash-direct")
+            assert store.stats()['checkpointed_frames'] == 1
+            payload, status = run_video_job(video, "lecture.mp4", Job("job-3"), "full")
+
+        assert direct['text'] == "fresh text"
+        assert status == 200 and payload['text'] == "fresh text"
+        assert store.stats() == {'jobs': {'done': 1}, 'checkpointed_frames': 0}
+        # Once past the TTL of 0 seconds the row of the finished job is deleted when the next job finishes
+        time.sleep(0.01)
+        store.finish_job("job-4", "done")
+        assert store.stats() == {'jobs': {}, 'checkpointed_frames': 0}
+
+    # Test 89: Importing the backend creates no stores, they are opened on first use
+    def test_backend_import_creates_no_files(self, tmp_path):
+        # Test that the checkpoint, result, stage and search stores only touch the disk once a request needs them
+        import subprocess
+        cache = tmp_path / "cache"
+        env = dict(os.environ, CHECKPOINT_DB=str(cache / "checkpoints.db"), SPOOL_DIR=str(cache / "spool"),
+                   RESULT_CACHE_DIR=str(cache / "results"), STAGE_CACHE_DIR=str(cache / "stages"),
+                   SEARCH_DB=str(cache / "search.db"))
+        script = "import app; print(app.get_checkpoints().stats()['checkpointed_frames'])"
+        subprocess.run([sys.executable, "-c", "import app"], env=env, cwd=Path(__file__).parent.parent, check=True)
+        assert not cache.exists()
+
+        output = subprocess.run([sys.executable, "-c", script], env=env, capture_output=True, text=True,
+                                cwd=Path(__file__).parent.parent, check=True).stdout
+        assert output.strip() == "0" and (cache / "checkpoints.db").exists() and not (cache / "results").exists()
+
+class TestSingleFlight:
+    # Test coalescing of identical concurrent uploads
+
+    # Test 46: Concurrent calls with the same key run once
+    def test_concurrent_calls_share_one_run(self):
+        # Test that callers arriving during a running call wait for it instead of running again
+        import threading
+        from singleflight import SingleFlight
+        flights = SingleFlight()
+        calls = []
+        started = threading.Event()
+
+        def work():
+            calls.append(1)
+            started.set()
+            time.sleep(0.2)
+            return "notes"
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flights.do("key", work, owner="job-a")))
+        leader.start()
+        started.wait(1)
+        followers = [threading.Thread(target=lambda: results.append(flights.do("key", work, owner="job-b"))) for _ in range(3)]
+        for thread in followers:
+            thread.start()
+        for thread in [leader] + followers:
+            thread.join(2)
+
+        assert len(calls) == 1
+        assert sorted(results, key=lambda r: r[1] or "") == [("notes", None)] + [("notes", "job-a")] * 3
+        assert flights.stats() == {'in_flight': 0, 'waiting': 0, 'leaders': 1, 'coalesced': 3}
+
+    # Test 47: Identical uploads cost one pipeline run
+    @patch('app.extract_frames_to_memory')
+    def test_identical_uploads_are_coalesced(self, mock_extract, tmp_path):
+        # Test that a second job for the same video attaches to the running job and gets its result
+        import threading
+        from result_cache import DiskCache
+        from stage_store import StageStore
+        from search_index import SearchIndex
+        from jobs import Job
+        from app import process_video_upload
+        video = tmp_path / "lecture.mp4"
+        video.write_bytes(b'video')
+        mock_extract.return_value = [(0, Image.new('RGB', (10, 10)), "0:00:00")]
+
+        def slow_parallel(pending, **kwargs):
+            time.sleep(0.3)
+            return [("x = 1", "0:00:00")]
+
+        results = {}
+        with patch('app.get_result_cache', return_value=DiskCache(tmp_path / "results", max_bytes=1_000_000)), \
+             patch('app.get_stage_store', return_value=StageStore(tmp_path / "stages", max_bytes=1_000_000)), \
+             patch('app.QUALITY_GATING', False), \
+             patch('app.get_search_index', return_value=SearchIndex(tmp_path / "search.db")), \
+             patch('app.process_video_frames_parallel', side_effect=slow_parallel) as mock_parallel, \
+             patch('app.process_frames_with_gemini', return_value="[0:00:00] x = 1") as mock_gemini:
+            threads = [threading.Thread(target=lambda job_id=job_id: results.update(
+                {job_id: process_video_upload(video, "lecture.mp4", Job(job_id), "full")})) for job_id in ("first", "second")]
+            threads[0].start()
+            time.sleep(0.1)
+            threads[1].start()
+            for thread in threads:
+                thread.join(3)
+
+        assert mock_parallel.call_count == 1 and mock_gemini.call_count == 1
+        assert results["first"] == ({'text': "[0:00:00] x = 1", 'frames_processed': 1, 'total_frames': 1}, 200)
+        payload, status = results["second"]
+        assert status == 200 and payload['coalesced_with'] == "first" and payload['text'] == "[0:00:00] x = 1"
+
+class TestWarmUp:
+    # Test the backend warm-up used by the launcher
+
+    # Test 48: Warm-up runs every step once and reports its timings
+    @patch('app.warm_up_connection', return_value=True)
+    @patch('app.check_dependencies', side_effect=RuntimeError("Missing system packages: ffmpeg"))
+    def test_warmup_reports_steps(self, mock_deps, mock_connection):
+        # Test that /warmup reports each step and a failed ffmpeg check marks the backend as not ready
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            report = client.post('/warmup').get_json()
+            info = client.get('/system-info').get_json()
+
+        assert set(report['steps']) == {'ffmpeg', 'imports', 'ocr_connection'}
+        assert report['steps']['ffmpeg'] == {'ok': False, 'sec': report['steps']['ffmpeg']['sec'],
+                                             'error': "Missing system packages: ffmpeg"}
+        assert report['steps']['imports']['ok'] and report['steps']['ocr_connection']['ok']
+        assert report['ready'] is False and info['warm_up'] == report
+        mock_connection.assert_called_once()
+
+class TestSearchIndex:
+    # Test the full-text search over finished transcripts
+
+    # Test 51: Sections are found by formula text with their timestamp
+    def test_search_finds_timestamped_sections(self, tmp_path):
+        # Test that notes are split at their [h:mm:ss] markers, ranked, and replaced when a lecture is indexed again
+        from search_index import SearchIndex, split_transcript
+        notes = "Intro\n[0:00:30] Definition of a derivative\n[0:01:30] f(x) = x^2 + 3x\nf'(x) = 2x + 3"
+        assert split_transcript(notes) == [("0:00:00", "Intro"), ("0:00:30", "Definition of a derivative"),
+                                           ("0:01:30", "f(x) = x^2 + 3x\nf'(x) = 2x + 3")]
+
+        index = SearchIndex(tmp_path / "search.db")
+        index.index_lecture("lecture-a", "calculus.mp4", notes, [("f(x) = x^2", "0:01:00")])
+        index.index_lecture("lecture-b", "algebra.mp4", "[0:02:00] x^2 - 1 = (x - 1)(x + 1)")
+
+        results = index.search("x^2 + 3x")
+        assert [(r['lecture_id'], r['source'], r['timestamp'], r['seconds']) for r in results] == [("lecture-a", "notes", "0:01:30", 90)]
+        assert len(index.search("x^2")) == 3
+        assert [r['source'] for r in index.search("x^2", lecture_id="lecture-a", source="ocr")] == ["ocr"]
+
+        index.index_lecture("lecture-a", "calculus.mp4", "[0:00:10] Limits")
+        assert index.search("derivative") == []
+        assert index.stats() == {'lectures': 2, 'sections': 2}
+
+    # Test 52: A finished job is searchable through /search
+    @patch('app.extract_frames_to_memory')
+    def test_finished_job_is_searchable(self, mock_extract, tmp_path):
+        # Test that the pipeline indexes its notes and the endpoint answers with the jump-to timestamp
+        from result_cache import DiskCache
+        from stage_store import StageStore
+        from search_index import SearchIndex
+        from jobs import Job
+        from app import process_video_upload
+        video = tmp_path / "lecture.mp4"
+        video.write_bytes(b'lecture video')
+        mock_extract.return_value = [(0, Image.new('RGB', (10, 10)), "0:00:45")]
+        index = SearchIndex(tmp_path / "search.db")
+
+        app.config['TESTING'] = True
+        with patch('app.get_search_index', return_value=index), \
+             patch('app.get_result_cache', return_value=DiskCache(tmp_path / "results", max_bytes=1_000_000)), \
+             patch('app.get_stage_store', return_value=StageStore(tmp_path / "stages", max_bytes=1_000_000)), \
+             patch('app.QUALITY_GATING', False), \
+             patch('app.process_video_frames_parallel', return_value=[("E = mc^2", "0:00:45")]), \
+             patch('app.process_frames_with_gemini', return_value="[0:00:45] Energy: E = mc^2"):
+            payload, status = process_video_upload(video, "physics.mp4", Job("search-job"), "full")
+            with app.test_client() as client:
+                found = client.get('/search', query_string={'q': 'mc^2', 'source': 'notes'}).get_json()
+                missing = client.get('/search')
+
+        assert status == 200
+        assert [(r['filename'], r['timestamp']) for r in found['results']] == [("physics.mp4", "0:00:45")]
+        assert missing.status_code == 400
+
+class TestBatchUpload:
+    # Test the batch image upload endpoint
+
+    # Test 53: Every image of a batch streams back, then the merged notes
+    @patch('app.check_api_keys', return_value=(True, ''))
+    @patch('app.transcribe_image')
+    def test_batch_streams_results_per_image(self, mock_transcribe, mock_keys, tmp_path):
+        # Test that loose images and zipped images are transcribed and reported line by line
+        import zipfile
+        from stage_store import StageStore
+
+        def png(color):
+            buffer = io.BytesIO()
+            Image.new('RGB', (20, 20), color).save(buffer, format='PNG')
+            return buffer.getvalue()
+
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.writestr('side.png', png('blue'))
+            zf.writestr('notes.txt', 'ignored')
+        archive.seek(0)
+        mock_transcribe.side_effect = lambda image: f"board {image.getpixel((0, 0))[2]}"
+
+        app.config['TESTING'] = True
+        with patch('app.get_stage_store', return_value=StageStore(tmp_path / "stages", max_bytes=1_000_000)), \
+             patch('app.process_frames_with_gemini', return_value="merged notes") as mock_gemini:
+            with app.test_client() as client:
+                response = client.post('/upload/batch', data={
+                    'files': [(io.BytesIO(png('white')), 'front.png'), (io.BytesIO(png('black')), 'left.png'), (archive, 'more.zip')],
+                    'merge': 'true', 'job_id': 'batch-1'}, content_type='multipart/form-data')
+                lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+                job = client.get('/jobs/batch-1').get_json()
+
+        assert response.mimetype == 'application/x-ndjson'
+        images = sorted((line for line in lines if line['type'] == 'image'), key=lambda line: line['index'])
+        assert [(line['name'], line['text']) for line in images] == [
+            ('front.png', 'board 255'), ('left.png', 'board 0'), ('more.zip/side.png', 'board 255')]
+        assert lines[-2] == {'type': 'merged', 'text': 'merged notes', 'error': False}
+        assert lines[-1]['type'] == 'done' and lines[-1]['images'] == 3 and lines[-1]['failed'] == 0
+        assert mock_gemini.call_args[0][0] == [('board 255', 'front.png'), ('board 0', 'left.png'), ('board 255', 'more.zip/side.png')]
+        assert job['status'] == 'done' and job['frames_done'] == 3
+
+    # Test 54: Files that are not images are rejected before any OCR
+    @patch('app.check_api_keys', return_value=(True, ''))
+    @patch('app.transcribe_image')
+    def test_batch_rejects_non_images(self, mock_transcribe, mock_keys):
+        # Test that a batch containing an unsupported file fails fast
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            response = client.post('/upload/batch', data={'files': [(io.BytesIO(b'video'), 'clip.mp4')]},
+                                   content_type='multipart/form-data')
+
+        assert response.status_code == 400
+        assert 'Unsupported file' in response.get_json()['error']
+        mock_transcribe.assert_not_called()
+
+    # Test 80: Oversized uploads, archives and images are refused before they are decoded
+    @patch('app.check_api_keys', return_value=(True, ''))
+    @patch('app.transcribe_image')
+    def test_batch_size_limits(self, mock_transcribe, mock_keys):
+        # Test the request cap, the real unpacked size of zip entries, the batch total and the pixel count
+        import zipfile
+        from werkzeug.datastructures import FileStorage
+        from app import load_batch_images
+
+        def png(size):
+            buffer = io.BytesIO()
+            Image.new('L', size).save(buffer, format='PNG')
+            return buffer.getvalue()
+
+        def post(files):
+            with app.test_client() as client:
+                return client.post('/upload/batch', data={'files': files}, content_type='multipart/form-data')
+
+        bomb = io.BytesIO()
+        with zipfile.ZipFile(bomb, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr('big.png', b'\0' * 200_000)
+        bomb.seek(0)
+
+        app.config['TESTING'] = True
+        with patch('app.BATCH_MAX_IMAGE_BYTES', 100_000):
+            response = post([(bomb, 'bomb.zip')])
+        assert response.status_code == 400 and 'Image too large' in response.get_json()['error']
+
+        with patch('app.BATCH_MAX_TOTAL_BYTES', 1_000):
+            response = post([(io.BytesIO(png((10, 10))), f'{i}.png') for i in range(20)])
+        assert response.status_code == 413
+
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for i in range(10):
+                zf.writestr(f'{i}.png', b'\0' * 50_000)
+        archive.seek(0)
+        with patch('app.BATCH_MAX_TOTAL_BYTES', 200_000):
+            with pytest.raises(ValueError, match='Batch too large'):
+                load_batch_images([FileStorage(archive, 'slides.zip')])
+
+        with patch.object(Image, 'MAX_IMAGE_PIXELS', 1_000):
+            response = post([(io.BytesIO(png((50, 50))), 'wide.png')])
+        assert response.status_code == 400 and 'too many pixels' in response.get_json()['error']
+
+        with patch.dict(app.config, {'MAX_CONTENT_LENGTH': 1_000}):
+            response = post([(io.BytesIO(png((10, 10))), f'{i}.png') for i in range(20)])
+        assert response.status_code == 413 and 'Upload too large' in response.get_json()['error']
+        mock_transcribe.assert_not_called()
+
+def sleepy_ocr_handler(payload):
+    # Stand-in for handle_ocr with a fixed API latency
+    time.sleep(0.1)
+    return {'text': f"frame {payload['frame_number']}"}
+
+def run_queue_worker(db_path, stop_event):
+    # Worker process of the scaling test
+    from task_queue import SQLiteTaskQueue
+    from worker import run_worker
+    run_worker(SQLiteTaskQueue(db_path), handlers={'ocr': sleepy_ocr_handler}, stop_event=stop_event)
+
+
+class TestTaskQueue:
+    # Test the shared task queue of the worker mode
+
+    # Test 57: Failed and abandoned tasks are retried until their attempts are used
+    def test_leases_and_retries(self, tmp_path):
+        # Test that a failed attempt is requeued, an expired lease is taken over and the last attempt ends as failed
+        from task_queue import SQLiteTaskQueue
+        task_queue = SQLiteTaskQueue(tmp_path / "tasks.db")
+        first, second = task_queue.enqueue('ocr', [{'n': 1}, {'n': 2}], "group-1", max_attempts=2)
+
+        task = task_queue.claim("worker-a", ['ocr'], lease_sec=0.05)
+        assert task.task_id == first and task.attempts == 1
+        task_queue.fail(task, "API request failed: 503")
+        retried = task_queue.claim("worker-a", ['ocr'], lease_sec=0.05)
+        assert retried.task_id == first and retried.attempts == 2
+
+        # worker-a crashes with the task leased
+        time.sleep(0.1)
+        task = task_queue.claim("worker-b", ['ocr'])
+        assert task.task_id == second and task.payload == {'n': 2}
+        task_queue.complete(task, {'text': "two"})
+
+        status = task_queue.group_status("group-1")
+        assert status[first]['status'] == 'failed' and status[first]['error'] == 'lease expired'
+        assert status[second] == {'status': 'done', 'result': {'text': "two"}, 'error': None, 'attempts': 1}
+        assert task_queue.claim("worker-b", ['ocr']) is None
+
+    # Test 58: Queued frames are shared by every worker process and assembled in order
+    def test_worker_processes_scale(self, tmp_path):
+        # Test that frames queued by the API node come back in order and each of four workers takes some of them
+        import multiprocessing
+        from collections import Counter
+        import worker  # noqa: F401 - imported before forking so the poll interval can be patched
+        from task_queue import SQLiteTaskQueue
+        from app import process_frames_queued
+        context = multiprocessing.get_context('fork')
+        frames = [(i, Image.new('RGB', (10, 10)), f"0:00:{i:02d}") for i in range(16)]
+
+        class RecordingQueue(SQLiteTaskQueue):
+            # Counts the tasks of each worker before the finished group is deleted
+            def delete_group(self, group_id):
+                self.per_worker = Counter(row[0] for row in self._connect().execute(
+                    "SELECT worker FROM tasks WHERE group_id = ?", (group_id,)))
+                super().delete_group(group_id)
+
+        for workers in (1, 4):
+            db_path = tmp_path / f"tasks-{workers}.db"
+            shared_queue = RecordingQueue(db_path)
+            stop_event = context.Event()
+            processes = [context.Process(target=run_queue_worker, args=(db_path, stop_event)) for _ in range(workers)]
+            # Forked workers inherit the shorter idle poll
+            with patch('worker.WORKER_POLL_SEC', 0.02):
+                for process in processes:
+                    process.start()
+            try:
+                with patch('app.get_task_queue', return_value=shared_queue), patch('app.QUEUE_POLL_SEC', 0.02):
+                    results = process_frames_queued(frames)
+            finally:
+                stop_event.set()
+                for process in processes:
+                    process.join(5)
+            assert results == [(f"frame {i}", f"0:00:{i:02d}") for i in range(16)]
+            assert sum(shared_queue.per_worker.values()) == 16
+            assert len(shared_queue.per_worker) == workers and min(shared_queue.per_worker.values()) >= 1
+
+    # Test 82: Groups their API node stopped renewing expire, their tasks are never claimed
+    def test_abandoned_groups_expire(self, tmp_path):
+        # Test that a claim drops expired groups, a renewed group survives and the waiting node sees expired tasks as failed
+        from task_queue import SQLiteTaskQueue
+        from app import wait_for_tasks
+        task_queue = SQLiteTaskQueue(tmp_path / "tasks.db")
+        task_queue.enqueue('ocr', [{'n': 1}, {'n': 2}], "dead-node", ttl_sec=0.05)
+        alive, = task_queue.enqueue('ocr', [{'n': 3}], "live-node", ttl_sec=0.05)
+        task_queue.renew_group("live-node", ttl_sec=60)
+        time.sleep(0.1)
+
+        task = task_queue.claim("worker-a", ['ocr'])
+        assert task.task_id == alive
+        assert task_queue.group_status("dead-node") == {}
+        assert task_queue.claim("worker-a", ['ocr']) is None
+
+        stalled = task_queue.enqueue('ocr', [{'n': 4}], "stalled-node", ttl_sec=0.05)
+        time.sleep(0.1)
+        task_queue.claim("worker-a", ['ocr'])
+        outcome = {}
+        with patch('app.get_task_queue', return_value=task_queue):
+            wait_for_tasks("stalled-node", stalled, outcome.__setitem__, timeout=5)
+        assert outcome[stalled[0]]['status'] == 'failed' and 'expired' in outcome[stalled[0]]['error']
+
+    # Test 90: The queue interface is abstract and a Redis claim or cancel is one atomic script call
+    def test_redis_claim_is_atomic(self):
+        # Test that an incomplete queue cannot be built and that claim and cancel_group never split their steps into separate commands
+        from task_queue import TaskQueue, RedisTaskQueue, REDIS_CLAIM_SCRIPT, REDIS_CANCEL_SCRIPT
+        with pytest.raises(TypeError):
+            TaskQueue()
+
+        client = MagicMock()
+        client.zrangebyscore.return_value = []
+        client.smembers.return_value = {"t1", "t2"}
+        scripts = {REDIS_CLAIM_SCRIPT: Mock(side_effect=[None, ["t1", "g1", '{"n": 1}', 2]]), REDIS_CANCEL_SCRIPT: Mock()}
+        client.register_script.side_effect = scripts.get
+        redis_module = types.SimpleNamespace(Redis=Mock(from_url=Mock(return_value=client)))
+        with patch.dict(sys.modules, {'redis': redis_module}):
+            task_queue = RedisTaskQueue("redis://localhost:6379/0")
+
+        task = task_queue.claim("worker-a", ['refine', 'ocr'], lease_sec=30)
+        assert (task.task_id, task.group_id, task.kind, task.payload, task.attempts) == ("t1", "g1", 'ocr', {'n': 1}, 2)
+        claim_call = scripts[REDIS_CLAIM_SCRIPT].call_args
+        assert claim_call.kwargs['keys'] == ["boardcast:queued:ocr", "boardcast:leased:ocr"]
+        assert claim_call.kwargs['args'][0] == "boardcast:task:" and claim_call.kwargs['args'][2] == "worker-a"
+        assert not client.lpop.called and not client.hset.called
+
+        task_queue.cancel_group("g1")
+        assert scripts[REDIS_CANCEL_SCRIPT].call_count == 2 and not client.hset.called
+
+class TestAdmission:
+    # Test admission control and load shedding
+
+    # Test 59: Jobs run, wait in line or are shed
+    def test_admission_limits(self):
+        # Test the running slot, the bounded waiting line, the per-client limit and the counters
+        import threading
+        from admission import AdmissionController, AdmissionRejected
+        controller = AdmissionController(max_running=1, max_pending=1, per_client=1, max_wait_sec=60)
+
+        first = controller.admit("client-a")
+        with pytest.raises(AdmissionRejected) as same_client:
+            controller.admit("client-a")
+        assert same_client.value.status == 429
+
+        admitted = threading.Event()
+        waiter = threading.Thread(target=lambda: controller.admit("client-b") and admitted.set())
+        waiter.start()
+        time.sleep(0.05)
+        assert not admitted.is_set() and controller.stats()['pending'] == 1
+
+        with pytest.raises(AdmissionRejected) as overloaded:
+            controller.admit("client-c")
+        assert overloaded.value.status == 503 and int(overloaded.value.retry_after_header) >= 1
+
+        first.release()
+        waiter.join(1)
+        assert admitted.is_set()
+        stats = controller.stats()
+        assert stats['running'] == 1 and stats['pending'] == 0
+        assert (stats['admitted'], stats['queued'], stats['rejected_client_limit'], stats['rejected_queue_full']) == (2, 1, 1, 1)
+
+    # Test 60: A rejected upload is answered at once with Retry-After
+    @patch('app.check_api_keys', return_value=(True, ''))
+    @patch('app.transcribe_image', return_value="text")
+    def test_upload_rejected_with_retry_after(self, mock_transcribe, mock_keys):
+        # Test that an upload over the client limit gets 429 and the slot of a finished upload is freed
+        from admission import AdmissionController
+        controller = AdmissionController(max_running=2, max_pending=0, per_client=1, max_wait_sec=60)
+        app.config['TESTING'] = True
+        with patch('app.admission', controller), patch('app.TRUSTED_PROXIES', {'127.0.0.1'}), app.test_client() as client:
+            held = controller.admit("busy-client")
+            rejected = client.post('/upload', data={'file': (io.BytesIO(b'img'), 'board.png')},
+                                   headers={'X-Client-Id': 'busy-client'})
+            held.release()
+            accepted = client.post('/upload', data={'file': (io.BytesIO(b'img'), 'board.png')},
+                                   headers={'X-Client-Id': 'busy-client'})
+
+        assert rejected.status_code == 429 and rejected.headers['Retry-After'] == "30"
+        assert 'Too many jobs' in rejected.get_json()['error']
+        assert accepted.status_code == 200 and accepted.get_json() == {'text': "text"}
+        assert controller.stats()['running'] == 0
+        mock_transcribe.assert_called_once()
+
+    # Test 83: Waiting uploads time out or give up their place when the client leaves, client ids need a trusted proxy
+    def test_waiting_uploads_leave_the_line(self):
+        # Test the wait timeout, a disconnected waiter, a client gone once its slot arrives and the X-Client-Id trust
+        import threading
+        from admission import AdmissionController, AdmissionRejected
+        from app import client_id
+        controller = AdmissionController(max_running=1, max_pending=2, per_client=2, max_wait_sec=60, wait_timeout_sec=0.1)
+        first = controller.admit("client-a")
+
+        with pytest.raises(AdmissionRejected) as timed_out:
+            controller.admit("client-b")
+        assert timed_out.value.status == 503 and 'no slot' in timed_out.value.reason
+
+        controller.wait_timeout_sec = 60
+        with patch('admission.WAIT_POLL_SEC', 0.01):
+            with pytest.raises(AdmissionRejected) as left:
+                controller.admit("client-b", gone=lambda: True)
+            assert 'disconnected' in left.value.reason
+
+            leaving = threading.Event()
+            outcome = []
+
+            def wait_then_leave():
+                try:
+                    controller.admit("client-c", gone=leaving.is_set)
+                except AdmissionRejected as e:
+                    outcome.append(e.reason)
+
+            waiter = threading.Thread(target=wait_then_leave)
+            waiter.start()
+            time.sleep(0.05)
+            leaving.set()
+            first.release()
+            waiter.join(1)
+        assert outcome == ["Client disconnected while waiting"]
+        stats = controller.stats()
+        assert (stats['running'], stats['pending'], stats['timed_out'], stats['abandoned']) == (0, 0, 1, 2)
+        assert controller.admit("client-b").client_id == "client-b"
+
+        with app.test_request_context(headers={'X-Client-Id': 'someone-else'}, environ_base={'REMOTE_ADDR': '10.0.0.5'}):
+            assert client_id() == '10.0.0.5'
+            with patch('app.TRUSTED_PROXIES', {'10.0.0.5'}):
+                assert client_id() == 'someone-else'
+
+    # Test 92: A client that leaves during its upload is noticed once the body was read
+    @patch('app.check_api_keys', return_value=(True, ''))
+    @patch('app.transcribe_image', return_value="x = 1")
+    def test_client_gone_after_body_is_read(self, mock_transcribe, mock_keys):
+        # Test that unread body bytes hide a closed connection and that the upload routes probe again after parsing the body
+        import socket
+        from jobs import client_disconnected
+        from admission import admission
+        server_side, client_side = socket.socketpair()
+        client_side.sendall(b"part of the upload body")
+        client_side.close()
+        assert not client_disconnected(server_side)
+        server_side.recv(1024)
+        assert client_disconnected(server_side)
+
+        running = admission.stats()['running']
+        app.config['TESTING'] = True
+        with app.test_client() as client:
+            response = client.post('/upload', data={'file': (io.BytesIO(b'img'), 'board.png')},
+                                   environ_base={'werkzeug.socket': server_side})
+            batch = client.post('/upload/batch', data={'files': [(io.BytesIO(b'img'), 'board.png')]},
+                                environ_base={'werkzeug.socket': server_side})
+        server_side.close()
+
+        assert response.status_code == 503 and 'before the job started' in response.get_json()['error']
+        assert batch.status_code == 503
+        assert mock_transcribe.call_count == 0 and admission.stats()['running'] == running
+
+class TestPromptBudget:
+    # Test cached Gemini instructions and the prompt token budget
+
+    class StubClient:
+        # Local stand-in for genai.Client recording cache and generate calls
+        def __init__(self, api_key=None, cache_error=None):
+            self.cache_error = cache_error
+            self.created, self.updated, self.configs, self.prompts = [], [], [], []
+            self.caches = Mock(create=self._create, update=self._update)
+            self.models = Mock(generate_content_stream=self._generate)
+
+        def _create(self, model, config):
+            if self.cache_error:
+                raise RuntimeError(self.cache_error)
+            self.created.append(config)
+            return types.SimpleNamespace(name=f"cachedContents/{len(self.created)}")
+
+        def _update(self, name, config):
+            self.updated.append(name)
+
+        def _generate(self, model, contents, config):
+            self.configs.append(config)
+            self.prompts.append(contents[0].parts[0].text)
+            return [Mock(text="notes")]
+
+    # Test 61: Instructions are cached once, refreshed before expiry and sent inline when caching is refused
+    @patch('process_video_text.GEMINI_API_KEY', 'valid_key')
+    def test_instructions_cached_and_refreshed(self):
+        # Test that requests reference the cache by name and only carry the frame texts
+        import process_video_text
+        stub = self.StubClient()
+        session = process_video_text.GeminiSession(client_factory=lambda api_key: stub, ttl_sec=600, refresh_sec=60)
+
+        with patch.object(process_video_text, 'gemini', session), patch('time.monotonic', return_value=1000.0):
+            make_api_request_with_retry("Frame 1 text", instructions="Fixed instructions")
+            make_api_request_with_retry("Frame 2 text", instructions="Fixed instructions")
+        assert len(stub.created) == 1 and stub.created[0].system_instruction == "Fixed instructions"
+        cache_name = "cachedContents/1"
+        assert stub.prompts == ["Frame 1 text", "Frame 2 text"]
+        assert all(config.cached_content == cache_name and config.system_instruction is None
+                   for config in stub.configs)
+
+        # Close to expiry the same cache gets a new lifetime instead of being uploaded again
+        with patch.object(process_video_text, 'gemini', session), patch('time.monotonic', return_value=1550.0):
+            make_api_request_with_retry("Frame 3 text", instructions="Fixed instructions")
+        assert len(stub.created) == 1 and stub.updated == [cache_name]
+        assert session.stats()['cache_hits'] == 1 and session.stats()['requests'] == 3
+
+        refused = self.StubClient(cache_error="content is too small")
+        fallback = process_video_text.GeminiSession(client_factory=lambda api_key: refused)
+        with patch.object(process_video_text, 'gemini', fallback):
+            assert make_api_request_with_retry("Frame 1 text", instructions="Fixed instructions") == "notes"
+        assert refused.configs[0].system_instruction == "Fixed instructions" and refused.configs[0].cached_content is None
+        assert fallback.stats()['cache_unavailable'] == 1
+
+    # Test 62: Long lectures are split into windows that fit the budget
+    @patch('process_video_text.make_api_request_with_retry')
+    @patch('process_video_text.GEMINI_API_KEY', 'valid_key')
+    def test_prompt_budget_windows_and_trims(self, mock_api_request):
+        # Test that every request fits the budget, no frame is lost and runaway OCR text is cut
+        from process_video_text import estimate_tokens, GEMINI_INSTRUCTIONS, GEMINI_FRAME_MAX_TOKENS
+        mock_api_request.side_effect = lambda prompt, instructions=None: f"part {mock_api_request.call_count}"
+        budget = estimate_tokens(GEMINI_INSTRUCTIONS) + 200
+        frame_data = [(f"formula {i} " * 10, f"0:00:{i:02d}") for i in range(10)]
+        frame_data.append(("loop " * 10000, "0:00:10"))
+
+        result = process_frames_with_gemini(frame_data, budget_tokens=budget)
+
+        prompts = [c.args[0] for c in mock_api_request.call_args_list]
+        assert len(prompts) > 1 and result == "\n\n".join(f"part {i}" for i in range(1, len(prompts) + 1))
+        assert all(c.kwargs['instructions'] == GEMINI_INSTRUCTIONS for c in mock_api_request.call_args_list)
+        # Only the oversized last frame may exceed the window budget on its own, and it is cut to the frame limit
+        assert all(estimate_tokens(p) <= 200 for p in prompts[:-1])
+        assert estimate_tokens(prompts[-1]) <= GEMINI_FRAME_MAX_TOKENS + 50
+        joined = "".join(prompts)
+        assert all(f"Frame {i + 1} [Timestamp: 0:00:{i:02d}]" in joined for i in range(11))
+
+    # Test 84: Windows overlap at their seams, repeated seam notes are dropped and the window settings key the stored texts
+    @patch('process_video_text.GEMINI_API_KEY', 'valid_key')
+    def test_window_seams_and_cache_invalidation(self, tmp_path):
+        # Test the shared seam frame, the seam dedup, the refined key per budget and the 404 cache invalidation
+        import process_video_text
+        from google.genai import errors
+        from process_video_text import fit_frames_to_budget, estimate_tokens, combine_frame_texts
+        from stage_store import StageStore
+        frame_data = [(f"line {i} " * 10, f"0:00:{i:02d}") for i in range(6)]
+        cost = estimate_tokens(combine_frame_texts(frame_data[:1]))
+
+        windows, _ = fit_frames_to_budget(frame_data, 3 * cost, overlap_frames=1)
+        assert [start for start, _ in windows] == [0, 2, 4]
+        assert [window[0] for _, window in windows[1:]] == [frame_data[2], frame_data[4]]
+        assert fit_frames_to_budget(frame_data, 3 * cost, overlap_frames=0)[0] == [(0, frame_data[:3]), (3, frame_data[3:])]
+
+        answers = iter(["[0:00:00] a = 1\n[0:00:02] b = 2", "[0:00:02]  b = 2\n\n[0:00:03] c = 3", "[0:00:05] d = 4"])
+        with patch('process_video_text.make_api_request_with_retry', side_effect=lambda prompt, instructions=None: next(answers)):
+            result = process_video_text.process_frames_with_gemini(
+                frame_data, budget_tokens=estimate_tokens(process_video_text.GEMINI_INSTRUCTIONS) + 3 * cost)
+        assert result == "[0:00:00] a = 1\n[0:00:02] b = 2\n\n[0:00:03] c = 3\n\n[0:00:05] d = 4"
+
+        store = StageStore(tmp_path / "stages", max_bytes=1_000_000)
+        key = store._refined_key(frame_data)
+        with patch('process_video_text.GEMINI_PROMPT_BUDGET_TOKENS', 1000):
+            assert store._refined_key(frame_data) != key
+
+        class ExpiringClient(self.StubClient):
+            # The cache of the first request is gone on the Gemini side
+            def _generate(self, model, contents, config):
+                if not self.configs:
+                    self.configs.append(config)
+                    raise errors.ClientError(404, {'error': {'message': 'CachedContent not found', 'status': 'NOT_FOUND'}})
+                return super()._generate(model, contents, config)
+
+        stub = ExpiringClient()
+        session = process_video_text.GeminiSession(client_factory=lambda api_key: stub)
+        with patch.object(process_video_text, 'gemini', session), patch('time.sleep'):
+            assert make_api_request_with_retry("Frame 1 text", instructions="Fixed instructions") == "notes"
+        assert len(stub.created) == 2
+
+        unrelated = self.StubClient()
+        unrelated.models = Mock(generate_content_stream=Mock(side_effect=[RuntimeError("cache of the proxy is full"), [Mock(text="notes")]]))
+        session = process_video_text.GeminiSession(client_factory=lambda api_key: unrelated)
+        with patch.object(process_video_text, 'gemini', session), patch('time.sleep'):
+            assert make_api_request_with_retry("Frame 1 text", instructions="Fixed instructions") == "notes"
+        assert len(unrelated.created) == 1
+
+    # Test 91: Gemini counters are updated under the session lock
+    def test_gemini_counters_hold_the_lock(self):
+        # Test that a counter update waits for the session lock and that concurrent requests lose no counts
+        import threading
+        import process_video_text
+        session = process_video_text.GeminiSession(client_factory=lambda api_key: self.StubClient())
+        with session._lock:
+            recorder = threading.Thread(target=session.record, args=("abcd" * 10, "instructions"))
+            recorder.start()
+            recorder.join(0.1)
+            assert recorder.is_alive() and session.counters['requests'] == 0
+        recorder.join(1)
+        assert session.counters['requests'] == 1
+
+        threads = [threading.Thread(target=lambda: [session.record("abcd" * 10) for _ in range(2000)]) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = session.stats()
+        assert stats['requests'] == 16001 and stats['prompt_tokens'] == 16001 * process_video_text.estimate_tokens("abcd" * 10)
+
+
+class TestStreamingOCR:
+    # Test the streamed NVIDIA OCR client and its runaway output cutoff
+
+    @staticmethod
+    def sse(*deltas):
+        # Server-sent event lines of a completion streamed one delta per event
+        lines = []
+        for delta in deltas:
+            lines += [f"data: {json.dumps({'choices': [{'delta': {'content': delta}}]})}", ""]
+        return lines + ["data: [DONE]"]
+
+    # Test 63: Repetition loops and overlong outputs end the stream early
+    def test_stream_reader_cuts_runaway_output(self):
+        # Test that a looping completion is reduced to one copy and stops being read
+        from process_frames import read_ocr_stream
+        consumed = []
+
+        def lines(items):
+            for item in items:
+                consumed.append(item)
+                yield item
+
+        looping = self.sse("f(x) = x^2\n", "f'(x) = 2x\n", *["= 0\n"] * 50)
+        text, tokens, cutoff = read_ocr_stream(lines(looping))
+        assert text == "f(x) = x^2\nf'(x) = 2x\n= 0" and cutoff == 'repetition'
+        assert tokens == 10 and len(consumed) < 30
+
+        first, second = "the quick brown fox and the dog\n", "jumps over the lazy dog"
+        assert read_ocr_stream(self.sse(first, second), max_chars=40) == ((first + second)[:40], 2, 'length')
+        # Numbers and normal text are not taken for loops
+        assert read_ocr_stream(self.sse("x = 1000000\n", "y = x + 1")) == ("x = 1000000\ny = x + 1", 2, None)
+
+    # Test 85: Board content that repeats a few times is kept whole, streamed texts get their own OCR stage key
+    def test_repeated_board_rows_are_not_loops(self, tmp_path):
+        # Test the zero matrix, a full length answer under the character limit and the streaming settings in the keys
+        from process_frames import read_ocr_stream, find_repetition, OCR_MAX_TOKENS
+        from result_cache import pipeline_settings
+        from stage_store import StageStore
+        matrix = "A = \\begin{pmatrix}\n0 0 0\n0 0 0\n0 0 0\n\\end{pmatrix}\n"
+        assert find_repetition(matrix) == -1
+        assert read_ocr_stream(self.sse(*matrix.splitlines(keepends=True))) == (matrix, 5, None)
+        assert find_repetition("0 0 0\n" * 8) == len("0 0 0\n")
+
+        full_answer = [f"w{i} " for i in range(OCR_MAX_TOKENS)]
+        assert read_ocr_stream(self.sse(*full_answer))[2] is None
+
+        store = StageStore(tmp_path / "stages", max_bytes=1_000_000)
+        key, settings = store._ocr_key("abc", "0:00:00"), pipeline_settings()
+        with patch('process_frames.OCR_STREAMING', True):
+            assert store._ocr_key("abc", "0:00:00") != key and pipeline_settings() != settings
+
+    # Test 64: Streaming mode closes the response as soon as the loop is seen and records the saved tokens
+    @patch('requests.Session.post')
+    @patch('process_frames.OCR_STREAMING', True)
+    @patch('process_frames.NVIDIA_API_KEY', 'valid_nvidia_key')
+    def test_streaming_transcription_closes_early(self, mock_post):
+        # Test that the request is streamed and the connection closed without reading the rest of the loop
+        from process_frames import stream_stats
+        mock_response = Mock()
+        mock_response.raise_for_status.return_value = None
+        mock_response.iter_lines.return_value = iter(self.sse("Theorem 1\n", *["x\n"] * 200))
+        mock_post.return_value = mock_response
+        saved_before = stream_stats.stats()['tokens_saved']
+
+        result = transcribe_image(Image.new('RGB', (100, 100), color='white'))
+
+        assert result == "Theorem 1\nx"
+        assert mock_post.call_args.kwargs['stream'] is True and mock_post.call_args.kwargs['json']['stream'] is True
+        mock_response.close.assert_called_once()
+        stats = stream_stats.stats()
+        assert stats['cut_repetition'] >= 1 and stats['tokens_saved'] - saved_before == 512 - 9
+
+
+class TestPreviewPass:
+    # Test the sparse preview pass that runs before the full transcription
+
+    # Test 65: The preview is published first and its OCR texts are reused by the full pass
+    @patch('app.QUALITY_GATING', False)
+    @patch('app.get_duration', return_value=400.0)
+    def test_preview_published_then_replaced(self, mock_duration, tmp_path):
+        # Test that only the missing frames are transcribed in the full pass and the result replaces the preview
+        from result_cache import DiskCache
+        from stage_store import StageStore
+        from checkpoints import CheckpointStore
+        from video_utils import format_timestamp
+        from jobs import Job
+        video = tmp_path / "lecture.mp4"
+        video.write_bytes(b"video")
+        job = Job("preview-job")
+        transcribed = []
+        seen = {}
+
+        def frame(seconds):
+            return (seconds // 30, Image.new('RGB', (10, 10), (seconds % 256, 0, 0)), format_timestamp(seconds))
+
+        def ocr(image):
+            transcribed.append(image.getpixel((0, 0))[0])
+            return f"board {image.getpixel((0, 0))[0]}"
+
+        def refine(frame_data):
+            seen['preview'] = job.to_dict()['preview']
+            return "[0:00:00] notes"
+
+        with patch('app.get_stage_store', return_value=StageStore(tmp_path / "stages", max_bytes=10_000_000)), \
+             patch('app.get_result_cache', return_value=DiskCache(tmp_path / "results", max_bytes=1_000_000)), \
+             patch('app.get_checkpoints', return_value=CheckpointStore(tmp_path / "checkpoints.db")), \
+             patch('app.extract_frames_at', side_effect=lambda path, seconds, cancel: [frame(s) for s in seconds]) as mock_at, \
+             patch('app.extract_frames_to_memory', return_value=[frame(s) for s in range(0, 400, 30)]), \
+             patch('app.transcribe_image', side_effect=ocr), \
+             patch('app.process_frames_with_gemini', side_effect=refine), \
+             patch('app.index_transcript'):
+            payload, status = run_video_job(video, "lecture.mp4", job, "full", "hash-1", preview=True)
+
+        assert status == 200 and payload['total_frames'] == 14
+        assert mock_at.call_args.args[1] == [0, 180, 360]
+        assert seen['preview']['frames'] == 3
+        assert seen['preview']['text'] == "[0:00:00] board 0\n\n[0:03:00] board 180\n\n[0:06:00] board 104"
+        # Every frame is transcribed exactly once across both passes
+        assert sorted(transcribed) == sorted(s % 256 for s in range(0, 400, 30))
+        assert job.status == 'done' and job.preview is None
+
+
+class TestBoardMosaic:
+    # Test the board mosaic stage for panning cameras
+
+    @staticmethod
+    def wide_board(seed: int = 1, width: int = 2000) -> Image.Image:
+        # Whiteboard wider than one frame, covered with formula-like strokes
+        import random
+        from PIL import ImageDraw
+        rng = random.Random(seed)
+        board = Image.new('RGB', (width, 800), 'white')
+        draw = ImageDraw.Draw(board)
+        for _ in range(40):
+            x, y = rng.randint(0, width - 300), rng.randint(0, 760)
+            draw.rectangle((x, y, x + rng.randint(80, 280), y + rng.randint(4, 12)), fill='black')
+            draw.text((x, y + 15), "".join(rng.choice("abxyz=+-") for _ in range(20)), fill='black')
+        return board
+
+    def panned_frames(self):
+        # Camera panning right in 200px steps, resting once, then new writing and a cut to another board
+        from PIL import ImageDraw
+        board = self.wide_board()
+        views = [board.crop((x, 0, x + 800, 800)) for x in (0, 200, 400, 400)]
+        ImageDraw.Draw(board).rectangle((500, 300, 900, 340), fill='black')
+        views.append(board.crop((400, 0, 1200, 800)))
+        views.append(self.wide_board(seed=9).crop((0, 0, 800, 800)))
+        return [(i, view, f"0:0{i}:00") for i, view in enumerate(views)]
+
+    # Test 66: Panned frames are cropped to the new board, resting frames skipped, new writing and new scenes kept whole
+    def test_plan_mosaic_crops_new_regions(self):
+        # Test registration and the per-frame transcription plan on a synthetic pan
+        pytest.importorskip("numpy")
+        from board_mosaic import plan_mosaic, register_frames, analysis_array
+        frames = self.panned_frames()
+
+        planned, stats = plan_mosaic(frames)
+
+        assert [(n, image.size) for n, image, _ in planned] == [(0, (800, 800)), (1, (216, 800)), (2, (216, 800)),
+                                                                 (4, (800, 800)), (5, (800, 800))]
+        assert stats['scenes'] == 2 and stats['skipped'] == 1 and stats['cropped'] == 2 and stats['ocr_area'] < 0.75
+        scenes = register_frames([analysis_array(image) for _, image, _ in frames])
+        assert [[(index, left) for index, _, left in scene] for scene in scenes] == [[(0, 0), (1, 50), (2, 100), (3, 100), (4, 100)], [(5, 0)]]
+
+    # Test 67: The mosaic stage sends only the planned regions to OCR
+    @patch('app.MOSAIC_ENABLED', True)
+    @patch('app.QUALITY_GATING', False)
+    @patch('app.transcribe_image')
+    def test_mosaic_stage_in_ocr(self, mock_transcribe, tmp_path):
+        # Test that skipped frames are reported without text and the stats reach the job result
+        pytest.importorskip("numpy")
+        from app import ocr_video_frames
+        from stage_store import StageStore
+        mock_transcribe.side_effect = lambda image: f"{image.width}px"
+        reported = {}
+        quality = {}
+
+        with patch('app.get_stage_store', return_value=StageStore(tmp_path, max_bytes=10_000_000)):
+            frame_data = ocr_video_frames(tmp_path / "v.mp4", "pan", self.panned_frames(), quality_stats=quality,
+                                          on_result=lambda n, text, ts: reported.update({n: text}))
+
+        assert mock_transcribe.call_count == 5
+        assert frame_data == [("800px", "0:00:00"), ("216px", "0:01:00"), ("216px", "0:02:00"),
+                              ("800px", "0:04:00"), ("800px", "0:05:00")]
+        assert reported[3] == "" and quality['mosaic']['skipped'] == 1
+
+    # Test 93: The mosaic thresholds and the sampling intervals key the OCR texts and the stored results
+    def test_mosaic_settings_key_ocr_texts(self, tmp_path):
+        # Test that cropped texts are only reused by runs that would crop the same regions
+        pytest.importorskip("numpy")
+        import board_mosaic
+        from stage_store import StageStore
+        from result_cache import pipeline_settings
+        store = StageStore(tmp_path, max_bytes=10_000_000)
+        store.save_ocr("pan", "0:01:00", "whole frame")
+        with patch('board_mosaic.MOSAIC_ENABLED', True):
+            assert store.load_ocr("pan", "0:01:00") is None
+            store.save_ocr("pan", "0:01:00", "cropped region")
+            assert store.load_ocr("pan", "0:01:00") == "cropped region"
+            assert pipeline_settings()['mosaic']['min_peak'] == board_mosaic.MOSAIC_MIN_PEAK
+            for setting, value in (('board_mosaic.MOSAIC_MIN_PEAK', 0.5), ('board_mosaic.MOSAIC_CHANGE_FRACTION', 0.1),
+                                   ('stage_store.EXTRACT_EVERY_SEC', 15), ('stage_store.PREVIEW_EVERY_SEC', 60)):
+                with patch(setting, value):
+                    assert store.load_ocr("pan", "0:01:00") is None
+        assert store.load_ocr("pan", "0:01:00") == "whole frame" and pipeline_settings()['mosaic'] == {}
+
+
+class TestConsolidation:
+    # Test the local consolidation of frame texts without Gemini
+
+    FRAMES = [
+        ("Definition: a group is a set G\nwith an operation", "0:00:00"),
+        ("Definition: a group is a set G\nwith an operation *\nAxioms:\n1. closure", "0:00:30"),
+        ("Defnition: a group is a set G\nwith an operation *\nAxioms:\n1. closure\n2. associativity", "0:01:00"),
+        ("Theorem: the identity is unique", "0:01:30"),
+    ]
+
+    # Test 70: Repeated and evolving lines are merged once with the timestamp of their most complete version
+    def test_consolidate_and_reduce_frames(self):
+        # Test the deduplicated transcript and the reduced frames for the Gemini prompt
+        from consolidate import consolidate_frames, reduce_frames
+
+        assert consolidate_frames(self.FRAMES) == (
+            "[0:00:00] Definition: a group is a set G\n\n"
+            "[0:00:30] with an operation *\nAxioms:\n1. closure\n\n"
+            "[0:01:00] 2. associativity\n\n"
+            "[0:01:30] Theorem: the identity is unique")
+        reduced = reduce_frames(self.FRAMES)
+        assert reduced[1] == ("with an operation *\nAxioms:\n1. closure", "0:00:30")
+        assert [ts for _, ts in reduced] == ["0:00:00", "0:00:30", "0:01:00", "0:01:30"]
+        assert sum(len(text) for text, _ in reduced) < 0.6 * sum(len(text) for text, _ in self.FRAMES)
+
+    # Test 87: A line written twice on the board is kept twice and new lines keep their place between the copies
+    def test_repeated_lines_are_kept(self):
+        # Test that exact repeats are matched by position in reading order instead of collapsing into one line
+        from consolidate import consolidate_frames, reduce_frames, LineTracker
+        frames = [("x = 0\ny = 1\nx = 0", "0:00:00"), ("x = 0\ny = 1\nx = 0", "0:00:30"),
+                  ("x = 0\nz = 5\ny = 1\nx = 0", "0:01:00")]
+
+        assert consolidate_frames(frames) == "[0:00:00] x = 0\n\n[0:01:00] z = 5\n\n[0:00:00] y = 1\nx = 0"
+        assert reduce_frames(frames) == [("x = 0\ny = 1\nx = 0", "0:00:00"), ("z = 5", "0:01:00")]
+
+        tracker = LineTracker()
+        for text, timestamp in frames:
+            tracker.add_frame(text, timestamp)
+        assert all(tracker._positions[id(entry)] == index for index, entry in enumerate(tracker.entries))
+        assert [entry[2] for entry in tracker.entries] == [2, 2, 2, 2]
+
+    # Test 71: Local mode skips Gemini and a failed Gemini call falls back to the local transcript
+    @patch('app.QUALITY_GATING', False)
+    def test_local_mode_and_gemini_fallback(self, tmp_path):
+        # Test that the fallback transcript is returned with the error and not stored in the result cache
+        from app import process_video_upload
+        from checkpoints import CheckpointStore
+        from jobs import Job
+        from result_cache import DiskCache
+        from stage_store import StageStore
+        video = tmp_path / "lecture.mp4"
+        video.write_bytes(b"video")
+        cache = DiskCache(tmp_path / "results", max_bytes=1_000_000)
+        frames = [(i, Image.new('RGB', (10, 10), (i, 0, 0)), ts) for i, (_, ts) in enumerate(self.FRAMES)]
+        texts = {i: text for i, (text, _) in enumerate(self.FRAMES)}
+
+        with patch('app.get_result_cache', return_value=cache), \
+             patch('app.get_stage_store', return_value=StageStore(tmp_path / "stages", max_bytes=10_000_000)), \
+             patch('app.get_checkpoints', return_value=CheckpointStore(tmp_path / "checkpoints.db")), \
+             patch('app.extract_frames_to_memory', return_value=frames), \
+             patch('app.transcribe_image', side_effect=lambda image: texts[image.getpixel((0, 0))[0]]), \
+             patch('app.index_transcript'), \
+             patch('app.process_frames_with_gemini', return_value="An unexpected error occurred: 503 UNAVAILABLE") as gemini:
+            local, local_status = process_video_upload(video, "lecture.mp4", Job(f"local-{time.time_ns()}"), "local", "hash-2")
+            assert gemini.call_count == 0
+            fallback, fallback_status = process_video_upload(video, "lecture.mp4", Job(f"full-{time.time_ns()}"), "full", "hash-2")
+
+        assert local_status == fallback_status == 200
+        assert local['text'] == fallback['text'] and local['text'].startswith("[0:00:00] Definition")
+        assert gemini.call_count == 1 and fallback['refined_by'] == 'local'
+        assert fallback['refinement_error'] == "An unexpected error occurred: 503 UNAVAILABLE"
+        # Only the local mode result is stored, the fallback retries Gemini on the next upload
+        assert cache.stats()['entries'] == 1
+
+class TestTracing:
+    # Test the per-job trace timeline and the sampling profiler
+
+    # Test 72: A job records its stages, frames (with retries) and refinement, also from the worker threads
+    @patch('app.QUALITY_GATING', False)
+    def test_job_trace_timeline(self, tmp_path):
+        # Test the exported Chrome trace events and the trace endpoint
+        from app import process_video_upload
+        from checkpoints import CheckpointStore
+        from jobs import jobs
+        from result_cache import DiskCache
+        from stage_store import StageStore
+        video = tmp_path / "lecture.mp4"
+        video.write_bytes(b"video")
+        frames = [(i, Image.new('RGB', (10, 10), (i, 0, 0)), f"0:00:{i * 30:02d}") for i in range(2)]
+        calls = []
+
+        def transcribe(image):
+            # The second frame fails once and succeeds on its retry
+            calls.append(image)
+            if image.getpixel((0, 0))[0] == 1 and len(calls) <= 2:
+                return "API request failed: 503 Server Error"
+            return f"text {image.getpixel((0, 0))[0]}"
+
+        job = jobs.create(f"trace-{time.time_ns()}")
+        with patch('app.get_result_cache', return_value=DiskCache(tmp_path / "results", max_bytes=1_000_000)), \
+             patch('app.get_stage_store', return_value=StageStore(tmp_path / "stages", max_bytes=10_000_000)), \
+             patch('app.get_checkpoints', return_value=CheckpointStore(tmp_path / "checkpoints.db")), \
+             patch('app.extract_frames_to_memory', return_value=frames), \
+             patch('app.transcribe_image', side_effect=transcribe), \
+             patch('app.index_transcript'), \
+             patch('app.process_frames_with_gemini', return_value="notes"):
+            payload, status = process_video_upload(video, "lecture.mp4", job, "full", "hash-trace")
+        assert status == 200 and payload['text'] == "notes"
+
+        trace = job.trace.to_chrome()
+        spans = [event for event in trace['traceEvents'] if event['ph'] == 'X']
+        names = [event['name'] for event in spans]
+        assert {'extract frames', 'ocr', 'refine'} <= set(names)
+        assert sorted(event['args']['retry'] for event in spans if event['name'] == 'frame 1') == [0, 1]
+        frame_threads = {event['tid'] for event in spans if event['name'].startswith('frame ')}
+        refine = next(event for event in spans if event['name'] == 'refine')
+        assert refine['tid'] not in frame_threads and refine['args']['mode'] == 'full'
+        assert all(event['ts'] >= 0 and event['dur'] >= 0 for event in spans)
+        assert any(event['ph'] == 'M' and event['name'] == 'thread_name' for event in trace['traceEvents'])
+        json.dumps(trace)
+
+        with app.test_client() as client:
+            assert client.get(f'/jobs/{job.job_id}/trace').get_json()['otherData']['spans'] == len(spans)
+            assert client.get('/jobs/unknown-job/trace').status_code == 404
+
+    # Test 73: The profiler samples the stacks of the other threads and guards its endpoint
+    def test_sampling_profiler(self):
+        # Test that a busy thread shows up in the profile, and the admin token, argument and concurrency checks
+        import threading
+        import tracing
+        stop = threading.Event()
+
+        def busy_loop():
+            while not stop.is_set():
+                sum(range(1000))
+
+        worker = threading.Thread(target=busy_loop, daemon=True)
+        worker.start()
+        try:
+            report = tracing.sample_profile(0.2, interval=0.002)
+        finally:
+            stop.set()
+            worker.join()
+        assert report['samples'] > 0 and report['threads'] >= 1
+        assert any(entry['function'].startswith('busy_loop') for entry in report['top'])
+        assert any(stack.split(' ')[0].startswith('_bootstrap') and 'busy_loop' in stack for stack in report['collapsed'])
+
+        with app.test_client() as client, patch('app.ADMIN_TOKEN', ''):
+            # Without a configured token the profiler is disabled, even for a request sending an empty token
+            assert client.get('/admin/profile?seconds=0.05').status_code == 404
+            assert client.get('/admin/profile?seconds=0.05', headers={'X-Admin-Token': ''}).status_code == 404
+
+        with app.test_client() as client, patch('app.ADMIN_TOKEN', 'secret'):
+            assert client.get('/admin/profile?seconds=0.05').status_code == 401
+            headers = {'X-Admin-Token': 'secret'}
+            assert client.get('/admin/profile?seconds=600', headers=headers).status_code == 400
+            response = client.get('/admin/profile?seconds=0.05&format=collapsed', headers=headers)
+            assert response.status_code == 200 and response.mimetype == 'text/plain'
+            with tracing._profile_lock:
+                assert client.get('/admin/profile?seconds=0.05', headers=headers).status_code == 409
+
+
 # INTEGRATION TESTS
 
 @pytest.mark.integration
@@ -388,6 +2229,54 @@ class TestPerformance:
         assert end_time - start_time < 5.0
         assert len(results) == 50
 
+    # Test 37: OCR engine benchmark
+    def test_benchmark_engines_reports_latency_and_throughput(self):
+        # Test that the engine benchmark reports latency and throughput per engine
+        from ocr_engines import benchmark_engines
+        images = [Image.new('RGB', (10, 10)) for _ in range(4)]
+        report = benchmark_engines(images, {'fast': FakeEngine('fast', 'a', local=True),
+                                            'broken': FakeEngine('broken', 'API request failed: 500', local=False)}, repeat=2)
+
+        assert report['fast']['frames'] == 8 and report['fast']['failures'] == 0
+        assert report['broken']['failures'] == 8
+        assert report['fast']['p95_latency_sec'] >= 0
+
+    # Test 50: Importing the backend does not load the Gemini SDK and requests repeat no setup work
+    def test_backend_import_defers_gemini_sdk(self):
+        # Test that the SDK is only imported when a Gemini request needs it, report the import times,
+        # and check that a second request neither probes ffmpeg again nor opens a new HTTP session
+        import subprocess
+        script = ("import sys, time; start = time.perf_counter(); import app; "
+                  "app_sec = time.perf_counter() - start; loaded = 'google.genai' in sys.modules; "
+                  "start = time.perf_counter(); import process_video_text; process_video_text.load_genai(); "
+                  "print(app_sec, time.perf_counter() - start, loaded)")
+        output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True,
+                                cwd=Path(__file__).parent.parent, check=True).stdout.split()
+        app_sec, sdk_sec, loaded = float(output[0]), float(output[1]), output[2]
+
+        print(f"\nBackend import {app_sec:.3f}s, deferred Gemini SDK import {sdk_sec:.3f}s")
+        assert loaded == "False"
+
+        import process_frames
+        answer = Mock(json=Mock(return_value={'choices': [{'message': {'content': "x = 1"}}]}))
+        clear_capabilities()
+        probes, sessions = [], []
+        with patch('subprocess.run', side_effect=lambda cmd, **kwargs: Mock(stdout="ffmpeg version 6.0\n", returncode=0)) as mock_subprocess, \
+             patch('requests.Session', side_effect=AssertionError("new HTTP session per request")), \
+             patch('process_frames.OCR_STREAMING', False), \
+             patch.object(process_frames.api_session, 'post', return_value=answer) as mock_post:
+            for _ in range(2):
+                start = time.perf_counter()
+                check_dependencies()
+                probes.append((mock_subprocess.call_count, time.perf_counter() - start))
+                assert process_frames.transcribe_image_remote(Image.new('RGB', (10, 10))) == "x = 1"
+                sessions.append(process_frames.api_session)
+        clear_capabilities()
+
+        print(f"Dependency check {probes[0][1] * 1000:.2f}ms first, {probes[1][1] * 1000:.2f}ms repeated")
+        assert probes[0][0] > 0 and probes[1][0] == probes[0][0]
+        assert mock_post.call_count == 2 and sessions[0] is sessions[1]
+
 # EDGE CASE TESTS
 
 class TestEdgeCases:
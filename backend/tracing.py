@@ -0,0 +1,170 @@
+import contextvars
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from functools import partial
+from pathlib import Path
+
+# Record per-job spans (frame extraction, image encoding, API requests, retries, refinement)
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() == "true"
+# Spans kept per job - a long lecture stays far below it, the cap bounds memory for pathological jobs
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", "20000"))
+# Sampling profiler: interval between stack samples and longest profile (seconds)
+PROFILE_INTERVAL_SEC = float(os.getenv("PROFILE_INTERVAL_SEC", "0.005"))
+PROFILE_MAX_SEC = 60
+# Innermost frames in these files mean a thread is waiting, not computing
+IDLE_FILES = ('threading.py', 'selectors.py', 'socketserver.py', 'queue.py', 'socket.py', 'ssl.py')
+
+# Trace of the job the current thread works for
+_current_trace = contextvars.ContextVar('trace', default=None)
+
+class Trace:
+
+    # Spans of one job, exported in the Chrome trace-event format (chrome://tracing, ui.perfetto.dev)
+
+    def __init__(self, name: str, max_spans: int = TRACE_MAX_SPANS):
+        self.name = name
+        self.max_spans = max_spans
+        self.start = time.perf_counter()
+        self.dropped = 0
+        self._spans = []
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, category: str, start: float, end: float, args: dict = None):
+        with self._lock:
+            if len(self._spans) >= self.max_spans:
+                self.dropped += 1
+                return
+            thread = threading.current_thread()
+            self._threads[thread.ident] = thread.name
+            self._spans.append((name, category, start, end, thread.ident, args or {}))
+
+    def __len__(self) -> int:
+        return len(self._spans)
+
+    def summary(self) -> dict:
+        # Total seconds per span category, e.g. how much of the job went to requests versus encoding
+        totals = Counter()
+        with self._lock:
+            for _, category, start, end, _, _ in self._spans:
+                totals[category] += end - start
+        return {category: round(seconds, 3) for category, seconds in totals.items()}
+
+    def to_chrome(self) -> dict:
+
+        # Export the spans as complete ("X") trace events
+
+        # Returns: Dict with traceEvents (timestamps in microseconds from the job start) ready for json.dumps
+
+        pid = os.getpid()
+        with self._lock:
+            spans = list(self._spans)
+            threads = dict(self._threads)
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0, 'args': {'name': f"job {self.name}"}}]
+        events += [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': thread_name}}
+                   for tid, thread_name in threads.items()]
+        events += [{
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': round((start - self.start) * 1e6, 1),
+            'dur': round((end - start) * 1e6, 1),
+            'pid': pid,
+            'tid': tid,
+            'args': args,
+        } for name, category, start, end, tid, args in spans]
+        return {'traceEvents': events, 'displayTimeUnit': 'ms',
+                'otherData': {'job_id': self.name, 'spans': len(spans), 'dropped': self.dropped}}
+
+@contextmanager
+def activate(trace: Trace):
+    # Record the spans of the current thread (and of the work it hands to bind()) into the trace
+    token = _current_trace.set(trace if TRACING_ENABLED else None)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+@contextmanager
+def span(name: str, category: str = 'pipeline', **args):
+    # Time the enclosed block as one span of the active trace, a no-op without one
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, category, start, time.perf_counter(), args)
+
+def bind(fn):
+    # Carry the active trace into a thread pool - executors do not copy context variables on their own
+    # Each call gets its own context copy, one context cannot run in two threads at once
+    return partial(contextvars.copy_context().run, fn)
+
+_profile_lock = threading.Lock()
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+def sample_profile(seconds: float, interval: float = PROFILE_INTERVAL_SEC, include_idle: bool = False) -> dict:
+
+    # Sample the Python stacks of every thread of the backend for a while
+
+    # Args: "seconds": Profile duration (at most PROFILE_MAX_SEC), "interval": Seconds between samples,
+    #       "include_idle": Keep samples of threads that are waiting on a lock, socket or queue
+
+    # Returns: Dict with the sample counts, the top functions by self and total samples and the collapsed stacks
+    #          ("outer;inner count" lines for flame graph tools)
+
+    # Raises: RuntimeError when another profile is running
+
+    if not _profile_lock.acquire(blocking=False):
+        raise RuntimeError("A profile is already running")
+    try:
+        own = threading.get_ident()
+        seconds = min(seconds, PROFILE_MAX_SEC)
+        stacks = Counter()
+        self_counts = Counter()
+        total_counts = Counter()
+        samples = idle = 0
+        threads = set()
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                threads.add(thread_id)
+                if not include_idle and Path(frame.f_code.co_filename).name in IDLE_FILES:
+                    idle += 1
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                samples += 1
+                self_counts[stack[0]] += 1
+                for name in set(stack):
+                    total_counts[name] += 1
+                stacks[";".join(reversed(stack))] += 1
+            time.sleep(interval)
+    finally:
+        _profile_lock.release()
+
+    top = [{'function': name, 'self': count, 'total': total_counts[name],
+            'self_pct': round(100 * count / samples, 1)} for name, count in self_counts.most_common(50)]
+    return {
+        'seconds': seconds,
+        'interval': interval,
+        'samples': samples,
+        'idle_samples': idle,
+        'threads': len(threads),
+        'top': top,
+        'collapsed': [f"{stack} {count}" for stack, count in stacks.most_common()],
+    }
@@ -1,32 +1,86 @@
 import os
+import re
 import subprocess
 import tempfile
 from pathlib import Path
 from PIL import Image
 import io
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
+import threading
+from jobs import JobCancelled
 
 FFMPEG  = "ffmpeg" 
 FFPROBE = "ffprobe"
 EXTRACT_EVERY_SEC = 30     # Frame interval (seconds)
 FRAME_SIZE = 800    # Output image size is 800x800 
+# Sampling interval of the preview pass (seconds), rounded to a multiple of EXTRACT_EVERY_SEC so the full pass reuses its frames
+PREVIEW_EVERY_SEC = int(os.getenv("PREVIEW_EVERY_SEC", "180"))
 
 class DependencyError(RuntimeError):
     pass
 
-# Check if the command is available
-def _cmd_ok(cmd):
+# Flag column followed by a name in the "-decoders" and "-filters" listings, e.g. " V....D h264  H.264 ..."
+_LISTING_LINE = re.compile(r'^\s*([A-Z.|]{3,6})\s+(\S+)\s')
+
+# Probed tools, filled on first use - installed tools do not change while the server runs
+_capabilities = {}
+_capabilities_lock = threading.Lock()
+
+def _run_tool(cmd: List[str]) -> str:
+    return subprocess.run(cmd, capture_output=True, check=True, text=True).stdout or ""
+
+def _parse_listing(output: str) -> List[str]:
+    names = []
+    for line in output.splitlines():
+        match = _LISTING_LINE.match(line)
+        if match and match.group(2) != '=':
+            names.append(match.group(2))
+    return names
+
+def probe_tool(cmd: str) -> Optional[dict]:
+
+    # Probe a media tool once
+
+    # Args: cmd: ffmpeg or ffprobe command
+
+    # Returns: Dict with the version line, and for ffmpeg the available decoders and filters, or None if the tool is missing
+
     try:
-        # Run the command and check if it returns a successful exit code
-        subprocess.run([cmd, "-version"], capture_output=True, check=True)
-        return True
+        version = _run_tool([cmd, "-version"]).splitlines()
     except (subprocess.CalledProcessError, FileNotFoundError):
-        return False
+        return None
+    capability = {'version': version[0] if version else ""}
+    if cmd == FFMPEG:
+        try:
+            capability['decoders'] = _parse_listing(_run_tool([cmd, "-hide_banner", "-decoders"]))
+            capability['filters'] = _parse_listing(_run_tool([cmd, "-hide_banner", "-filters"]))
+        except (subprocess.CalledProcessError, FileNotFoundError):
+            capability['decoders'], capability['filters'] = [], []
+    return capability
+
+def get_capabilities() -> Dict[str, Optional[dict]]:
+
+    # Capabilities of ffmpeg and ffprobe, probed on the first call only
+    # A missing tool is probed again on the next call, so installing it does not need a restart
+
+    # Returns: Dict of tool name to its probe result (None if missing)
+
+    with _capabilities_lock:
+        for cmd in (FFMPEG, FFPROBE):
+            if _capabilities.get(cmd) is None:
+                _capabilities[cmd] = probe_tool(cmd)
+        return dict(_capabilities)
+
+def clear_capabilities():
+    # Forget the probe results, e.g. after ffmpeg was replaced
+    with _capabilities_lock:
+        _capabilities.clear()
 
 # Check if the dependencies are installed
 def check_dependencies():
     # Check if the commands are available
-    missing = [c for c in (FFMPEG, FFPROBE) if not _cmd_ok(c)]
+    capabilities = get_capabilities()
+    missing = [c for c in (FFMPEG, FFPROBE) if capabilities[c] is None]
     if missing:
         raise DependencyError(f"Missing system packages: {', '.join(missing)}")
 
@@ -43,10 +97,33 @@ def format_timestamp(seconds: float) -> str:
     seconds_remainder = int(seconds % 60)
     return f"{hours}:{minutes:02d}:{seconds_remainder:02d}"
 
-def extract_frames_to_memory(video_path: Path) -> List[Tuple[int, Image.Image, str]]:
+def run_ffmpeg(cmd: List[str], cancel_event: threading.Event = None):
+
+    # Run an ffmpeg command, killing it as soon as the cancel event is set
+
+    # Args: cmd: The command, cancel_event: Optional event that aborts the command
+
+    if cancel_event is None:
+        subprocess.run(cmd, check=True, capture_output=True)
+        return
+
+    process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    while True:
+        try:
+            _, stderr = process.communicate(timeout=0.5)
+            break
+        except subprocess.TimeoutExpired:
+            if cancel_event.is_set():
+                process.kill()
+                process.communicate()
+                raise JobCancelled("ffmpeg stopped")
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd, stderr=stderr)
+
+def extract_frames_to_memory(video_path: Path, cancel_event: threading.Event = None) -> List[Tuple[int, Image.Image, str]]:
     
     # Extract frames from video directly to memory for immediate processing with timestamps. 
-    # Args: video_path: Path to the video file
+    # Args: video_path: Path to the video file, cancel_event: Optional event that stops ffmpeg
     # Returns: List of tuples containing (frame_number, Image, timestamp_str) ordered chronologically
     
     check_dependencies()
@@ -65,10 +142,7 @@ def extract_frames_to_memory(video_path: Path) -> List[Tuple[int, Image.Image, s
             "-vf", (
                 # One frame per every 30 seconds
                 f"fps=1/{EXTRACT_EVERY_SEC},"
-                # Scale the frame to 800x800
-                f"scale={FRAME_SIZE}:{FRAME_SIZE}:force_original_aspect_ratio=decrease,"
-                # Pad the frame to 800x800
-                f"pad={FRAME_SIZE}:{FRAME_SIZE}:(ow-iw)/2:(oh-ih)/2"
+                + frame_filter()
             ),
             # Quality is 2
             "-q:v", "2",
@@ -78,7 +152,7 @@ def extract_frames_to_memory(video_path: Path) -> List[Tuple[int, Image.Image, s
         
         try:
             # Run the command and check if it returns a successful exit code
-            subprocess.run(cmd, check=True, capture_output=True)
+            run_ffmpeg(cmd, cancel_event)
             
             # Load all frame files into memory
             frames = []
@@ -108,5 +182,47 @@ def extract_frames_to_memory(video_path: Path) -> List[Tuple[int, Image.Image, s
         except subprocess.CalledProcessError as e:
             raise RuntimeError(f"FFmpeg failed: {e}")
 
+def frame_filter() -> str:
+    # Scale the frame to 800x800, then pad it to 800x800
+    return (f"scale={FRAME_SIZE}:{FRAME_SIZE}:force_original_aspect_ratio=decrease,"
+            f"pad={FRAME_SIZE}:{FRAME_SIZE}:(ow-iw)/2:(oh-ih)/2")
+
+def get_duration(video_path: Path) -> float:
+    # Length of the video in seconds, read from the container header without decoding
+    check_dependencies()
+    result = subprocess.run([FFPROBE, "-v", "error", "-show_entries", "format=duration",
+                             "-of", "default=noprint_wrappers=1:nokey=1", str(video_path)],
+                            check=True, capture_output=True, text=True)
+    return float(result.stdout.strip())
+
+def preview_timestamps(duration: float, every_sec: int = PREVIEW_EVERY_SEC) -> List[int]:
+    # Seconds of the preview frames - multiples of EXTRACT_EVERY_SEC so they fall on timestamps of the full pass
+    step = max(1, round(every_sec / EXTRACT_EVERY_SEC)) * EXTRACT_EVERY_SEC
+    return list(range(0, max(1, int(duration + 0.999)), step))
+
+def extract_frames_at(video_path: Path, seconds: List[int], cancel_event: threading.Event = None) -> List[Tuple[int, Image.Image, str]]:
+
+    # Extract single frames at the given seconds, seeking to each instead of decoding the whole video
+
+    # Args: video_path: Path to the video file, seconds: Positions of the frames, cancel_event: Optional event that stops ffmpeg
+
+    # Returns: List of (frame_number, Image, timestamp_str) tuples numbered like the frames of the full pass
+
+    check_dependencies()
+    frames = []
+    with tempfile.TemporaryDirectory(prefix="preview_") as temp_dir:
+        for position in seconds:
+            frame_file = Path(temp_dir) / f"frame_{position}.jpg"
+            cmd = [FFMPEG, "-hide_banner", "-loglevel", "error",
+                   "-ss", str(position), "-i", str(video_path),
+                   "-frames:v", "1", "-vf", frame_filter(), "-q:v", "2", str(frame_file)]
+            try:
+                run_ffmpeg(cmd, cancel_event)
+                with Image.open(frame_file) as image:
+                    frames.append((position // EXTRACT_EVERY_SEC, image.convert('RGB'), format_timestamp(position)))
+            except (subprocess.CalledProcessError, OSError) as e:
+                print(f"Warning: Could not extract preview frame at {format_timestamp(position)}: {e}")
+    return frames
+
 def tmp_dir() -> tempfile.TemporaryDirectory:
     return tempfile.TemporaryDirectory(prefix="video_proc_")
@@ -0,0 +1,90 @@
+import argparse
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Callable, Dict
+
+from process_frames import transcribe_image, FrameResult
+from process_video_text import process_frames_with_gemini
+from task_queue import TaskQueue, Task, make_task_queue, decode_image, TASK_LEASE_SEC
+
+# How long an idle worker waits before it asks the queue again (seconds)
+WORKER_POLL_SEC = float(os.getenv("WORKER_POLL_SEC", "0.2"))
+# Refinement runs one long Gemini call, so its lease is longer than the lease of a frame
+REFINE_LEASE_SEC = float(os.getenv("REFINE_LEASE_SEC", "600"))
+
+def handle_ocr(payload: dict) -> dict:
+    # Transcribe one frame - a failed transcription raises so the queue retries it
+    image = decode_image(payload['image'])
+    result = FrameResult.from_text(payload['frame_number'], payload['timestamp'], transcribe_image(image))
+    if not result.ok:
+        raise RuntimeError(result.error)
+    return {'text': result.text}
+
+def handle_refine(payload: dict) -> dict:
+    # Refine the OCR texts of a job with Gemini
+    text = process_frames_with_gemini([tuple(item) for item in payload['frame_data']])
+    if text.startswith('An unexpected error occurred'):
+        raise RuntimeError(text)
+    return {'text': text}
+
+# Task kind -> handler
+HANDLERS = {'ocr': handle_ocr, 'refine': handle_refine}
+LEASES = {'ocr': TASK_LEASE_SEC, 'refine': REFINE_LEASE_SEC}
+
+def run_worker(queue: TaskQueue, worker_id: str = None, handlers: Dict[str, Callable[[dict], dict]] = None,
+               stop_event: threading.Event = None, exit_when_idle: bool = False) -> int:
+
+    # Claim and run tasks until stopped
+
+    # Args: "queue": Shared task queue, "worker_id": Name of this worker, "handlers": Task kind -> handler (HANDLERS if None),
+    #       "stop_event": Stops the worker when set, "exit_when_idle": Return as soon as the queue is empty
+
+    # Returns: Number of tasks this worker finished
+
+    handlers = handlers or HANDLERS
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    finished = 0
+    while stop_event is None or not stop_event.is_set():
+        task = None
+        for kind in handlers:
+            task = queue.claim(worker_id, [kind], LEASES.get(kind, TASK_LEASE_SEC))
+            if task is not None:
+                break
+        if task is None:
+            if exit_when_idle:
+                break
+            time.sleep(WORKER_POLL_SEC)
+            continue
+        run_task(queue, task, handlers[task.kind])
+        finished += 1
+    return finished
+
+def run_task(queue: TaskQueue, task: Task, handler: Callable[[dict], dict]):
+    try:
+        queue.complete(task, handler(task.payload))
+    except Exception as e:
+        print(f"Task {task.task_id} ({task.kind}) failed on attempt {task.attempts}: {str(e)}")
+        queue.fail(task, str(e))
+
+if __name__ == '__main__':
+    # Start a worker node: python worker.py [--threads N] [--kinds ocr refine]
+    parser = argparse.ArgumentParser(description="BoardCast worker - runs OCR and refinement tasks from the shared queue")
+    parser.add_argument('--threads', type=int, default=int(os.getenv("WORKER_THREADS", "8")),
+                        help="Tasks run at the same time - OCR tasks mostly wait on the API")
+    parser.add_argument('--kinds', nargs='+', default=list(HANDLERS), choices=list(HANDLERS))
+    args = parser.parse_args()
+
+    task_queue = make_task_queue()
+    selected = {kind: HANDLERS[kind] for kind in args.kinds}
+    print(f"Worker started with {args.threads} threads for {', '.join(selected)} tasks")
+    threads = [threading.Thread(target=run_worker, args=(task_queue, None, selected), daemon=True) for _ in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("Worker stopped")
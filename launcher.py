@@ -1,54 +1,84 @@
 import subprocess
 import sys
 import os
+import shutil
 import webbrowser
 import time
-import signal
 import atexit
+from pathlib import Path
 import psutil
-import win32process
-import win32con
+import requests
+
+ROOT = Path(__file__).resolve().parent
+BACKEND_URL = os.getenv("BACKEND_URL", "http://localhost:5000")
+FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:5173")
+# How long to wait for each server before giving up (seconds)
+READY_TIMEOUT_SEC = float(os.getenv("READY_TIMEOUT_SEC", "60"))
+READY_POLL_SEC = 0.25
+
+def start_process(cmd, cwd):
+    # Start a server in its own process group so Ctrl+C in this window is handled by the launcher only
+    if sys.platform == "win32":
+        return subprocess.Popen(cmd, cwd=cwd,
+                                creationflags=subprocess.CREATE_NEW_CONSOLE | subprocess.CREATE_NEW_PROCESS_GROUP)
+    return subprocess.Popen(cmd, cwd=cwd, start_new_session=True)
 
 def run_frontend():
-    os.chdir('Frontend')
-    frontend_process = subprocess.Popen(['npm', 'run', 'dev'], 
-                                      shell=True,
-                                      creationflags=subprocess.CREATE_NEW_CONSOLE | win32con.CREATE_NEW_PROCESS_GROUP)
-    return frontend_process
+    # npm is a .cmd script on Windows, so resolve it instead of going through a shell
+    npm = shutil.which("npm")
+    if npm is None:
+        raise RuntimeError("npm not found - install Node.js to run the frontend")
+    return start_process([npm, 'run', 'dev'], ROOT / 'frontend')
 
 def run_backend():
-    os.chdir('Backend')
-    backend_process = subprocess.Popen([sys.executable, 'app.py'],
-                                     shell=True,
-                                     creationflags=subprocess.CREATE_NEW_CONSOLE | win32con.CREATE_NEW_PROCESS_GROUP)
-    return backend_process
+    return start_process([sys.executable, 'app.py'], ROOT / 'backend')
+
+def wait_until_ready(url, process, timeout=READY_TIMEOUT_SEC):
+
+    # Poll a URL until it answers
+
+    # Args: "url": URL to poll, "process": Server process - waiting stops if it exits, "timeout": Seconds to wait
+
+    # Returns: Seconds until the URL answered
+
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f"Process exited with code {process.returncode} before {url} was ready")
+        try:
+            if requests.get(url, timeout=1).status_code < 500:
+                return time.perf_counter() - start
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(READY_POLL_SEC)
+    raise RuntimeError(f"{url} not ready after {timeout:.0f}s")
 
 def cleanup(processes):
     for process in processes:
         try:
             # Get the process ID
             pid = process.pid
-            
+
             # Get all child processes
             parent = psutil.Process(pid)
             children = parent.children(recursive=True)
-            
+
             # Terminate all child processes
             for child in children:
                 try:
                     child.terminate()
-                except:
+                except psutil.Error:
                     pass
-            
+
             # Terminate the main process
             process.terminate()
-            
+
             # Force kill if still running
             try:
                 process.wait(timeout=3)
-            except:
+            except subprocess.TimeoutExpired:
                 process.kill()
-        except:
+        except psutil.Error:
             pass
 
 def main():
@@ -59,31 +89,42 @@ def main():
     print(f"💻 System: {cpu_cores} CPU Threads detected")
     print("🌐 Starting server...")
     print("=" * 50 + "\n")
-    
-    # Store original directory
-    original_dir = os.getcwd()
-    
-    # Start frontend
-    frontend_process = run_frontend()
-    
-    # Wait a bit for frontend to start
-    
-    # Go back to original directory
-    os.chdir(original_dir)
-    
-    # Start backend
+
+    launch_start = time.perf_counter()
+
+    # Start both servers, they boot in parallel
     backend_process = run_backend()
-    
+    frontend_process = run_frontend()
+
     # Store processes for cleanup
     processes = [frontend_process, backend_process]
     atexit.register(cleanup, processes)
-    
-    # Open browser after a short delay
-    webbrowser.open('http://localhost:5173')
-    
+
+    try:
+        # Wait for the backend, then warm it before any upload reaches it
+        backend_ready = wait_until_ready(f"{BACKEND_URL}/health", backend_process)
+        print(f"✅ Backend ready after {backend_ready:.2f}s")
+        warm_start = time.perf_counter()
+        report = requests.post(f"{BACKEND_URL}/warmup", timeout=READY_TIMEOUT_SEC).json()
+        for name, step in report['steps'].items():
+            status = "ok" if step['ok'] else f"failed ({step.get('error', 'unavailable')})"
+            print(f"   warm-up {name}: {status} in {step['sec']:.2f}s")
+        print(f"🔥 Backend warmed up in {time.perf_counter() - warm_start:.2f}s")
+        print(f"⏱️ Cold start to first request: {time.perf_counter() - launch_start:.2f}s")
+
+        # Only open the browser once the page can actually load
+        frontend_ready = wait_until_ready(FRONTEND_URL, frontend_process)
+        print(f"✅ Frontend ready after {frontend_ready:.2f}s")
+    except (RuntimeError, requests.exceptions.RequestException, KeyError) as e:
+        print(f"❌ Startup failed: {e}")
+        cleanup(processes)
+        sys.exit(1)
+
+    webbrowser.open(FRONTEND_URL)
+
     print("Application Working!")
     print("Press Ctrl+C to stop all server.")
-    
+
     try:
         # Keep the script running
         while True:
@@ -93,4 +134,4 @@ def main():
         cleanup(processes)
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()